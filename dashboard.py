@@ -3,11 +3,25 @@ import pandas as pd
 import plotly.graph_objects as go
 from datetime import datetime
 import numpy as np # Added for np.ceil
+import pyarrow as pa
+import pyarrow.feather as feather
 import re
 import time
 import toml
 import os
-from collections import defaultdict
+import io
+import hashlib
+import importlib
+import queue
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+from contextlib import closing, contextmanager
+
+# 启用Copy-on-Write：缓存的数据集在各次重跑之间共享，派生frame的写操作不会回写到缓存对象（pandas 3 起默认开启）
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option('mode.copy_on_write', True)
 
 # 页面配置
 st.set_page_config(
@@ -69,26 +83,1291 @@ st.title("🏥 临床试验运营数据看板")
 st.markdown("---")
 
 # 数据上传
+REQUIRED_COLS = ["study_number", "study_ctn_plan_date", "study_ctn_actual_date"]
+# 解析结果缓存条目上限（按上传内容哈希淘汰最久未用的数据集）
+DATASET_CACHE_MAX_ENTRIES = 4
+
+# === CSV字段schema ===
+# 看板只读取下列字段（字段名为标准化后的小写下划线形式），其余字段不解析；
+# 类型：category=文本（取值重复度高，按整数编码存储），date=日期，None=按内容推断（site编号等数值字段）
+CSV_TEXT_COLS = [
+    'study_number', 'clintrack_ta_desc', 'sourcing_strategy', 'site_name', 'leading_site_or_not',
+    'ssus', 'site_status', 'crc_contract_type', 'crc_contract_impact_sa'
+]
+CSV_NUMBER_COLS = ['site_no', 'study_site_number']
+CSV_DATE_COLS = [
+    'study_ctn_plan_date', 'study_ctn_actual_date', 'ssus_assignment_date', 'site_select_actual_date',
+    'crc_contract_signoff_actual_date',
+    'study_fsa_actual_date', 'study_fsa_plan_date', 'study_fps_actual_date', 'study_fps_plan_date',
+    'study_imp_ready_actual_date', 'study_imp_ready_plan_date', 'study_sfr_actual_date', 'study_sfr_plan_date',
+    'study_hia_actual_date', 'study_hia_plan_date',
+    'country_package_ready_actual_date', 'country_package_ready_plan_date',
+    'main_contract_tmpl_actual_date', 'main_contract_tmpl_plan_date',
+    'site_sa_actual_date', 'site_sa_plan_date', 'ec_approval_actual_date', 'ec_approval_plan_date',
+    'contract_signoff_actual_date', 'contract_signoff_plan_date', 'site_gcp_actual_date', 'site_gcp_plan_date',
+    'comm_ltr_obt_actual_date', 'comm_ltr_obt_plan_date', 'comm_ltr_sent_actual_date', 'comm_ltr_sent_plan_date',
+    'site_package_actual_date', 'site_package_plan_date', 'ec_sub_actual_date', 'ec_sub_plan_date',
+    'ec_meeting_actual_date', 'ec_meeting_plan_date',
+    'draft_contract_gcp_review_actual_date', 'draft_contract_gcp_review_plan_date',
+    'main_contract_neg_comp_actual_date', 'main_contract_neg_comp_plan_date',
+]
+CSV_SCHEMA = {
+    **{col: 'category' for col in CSV_TEXT_COLS},
+    **{col: None for col in CSV_NUMBER_COLS},
+    **{col: 'date' for col in CSV_DATE_COLS},
+}
+# 日期按显式格式依次解析，都不匹配的少量值再回退到格式推断
+CSV_DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%Y-%m-%d %H:%M:%S', '%Y/%m/%d %H:%M:%S']
+# ClinTrack导出的空值标记（pandas默认的空值标记之外）
+CSV_NULL_VALUES = ['[NULL]', 'NULL']
+# 编码判断只看文件头部字节
+CSV_SNIFF_BYTES = 64 * 1024
+
+def hash_upload(raw_bytes):
+    return hashlib.blake2b(raw_bytes, digest_size=16).hexdigest()
+
+def normalize_column(col):
+    return col.strip().lower().replace(" ", "_")
+
+def sniff_encoding(raw_bytes):
+    # 头部能按utf-8解码（末尾截断的多字节字符不算）即为utf-8，否则按gbk
+    try:
+        raw_bytes[:CSV_SNIFF_BYTES].decode('utf-8')
+    except UnicodeDecodeError as e:
+        if e.reason != 'unexpected end of data':
+            return 'gbk'
+    return 'utf-8'
+
+def parse_date_column(values):
+    # 同一日期在各site行大量重复：只解析去重后的取值再按编码展开
+    codes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques, dtype=object)
+    # 显式格式走快速路径；所有格式都不匹配的少量值，回退到逐值推断
+    parsed = pd.to_datetime(uniques, format=CSV_DATE_FORMATS[0], errors='coerce')
+    for fmt in CSV_DATE_FORMATS[1:] + [None]:
+        rest = parsed.isna()
+        if not rest.any():
+            break
+        parsed[rest] = pd.to_datetime(uniques[rest], format=fmt, errors='coerce')
+    dates = np.append(parsed.to_numpy(dtype='datetime64[ns]'), np.datetime64('NaT'))
+    # 空值编码为-1，正好取到末尾补的NaT
+    return pd.Series(dates[codes], index=values.index, name=values.name)
+
+def apply_csv_schema(df, rename):
+    df = df.rename(columns=rename)
+    for col in df.columns:
+        if CSV_SCHEMA[col] == 'date':
+            df[col] = parse_date_column(df[col])
+        elif CSV_SCHEMA[col] == 'category':
+            df[col] = df[col].astype('category')
+    # leading site标记预先算成布尔列
+    if 'leading_site_or_not' in df.columns:
+        df['leading_site'] = is_leading_site(df)
+    return df
+
+def study_number_codes(values):
+    # study_number统一为字符串（空值为'nan'，与原来astype(str)一致），按整数编码存储
+    return values.astype(str).astype('category')
+
+def concat_chunks(chunks):
+    # 各块的category取值不同，先统一成并集再拼接，否则会退回object列；
+    # 并集按取值排序，与整体读取时astype('category')的取值顺序一致（按category排序时结果与单次读取相同）
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            categories = pd.api.types.union_categoricals([chunk[col] for chunk in chunks], sort_categories=True).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+    return pd.concat(chunks, ignore_index=True)
+
+def read_schema_csv(raw_bytes, encoding, columns, chunksize=None):
+    # 先读表头把原始字段名映射到schema字段，只投影需要的列；日期列先按文本读入再统一解析
+    header = pd.read_csv(io.BytesIO(raw_bytes), encoding=encoding, nrows=0).columns
+    rename = {col: normalize_column(col) for col in header if normalize_column(col) in columns}
+    frames = pd.read_csv(
+        io.BytesIO(raw_bytes), encoding=encoding, chunksize=chunksize, usecols=list(rename),
+        dtype={col: str for col, name in rename.items() if CSV_SCHEMA[name] is not None},
+        na_values=CSV_NULL_VALUES,
+    )
+    if chunksize is None:
+        return apply_csv_schema(frames, rename)
+    return (apply_csv_schema(chunk, rename) for chunk in frames)
+
+@st.cache_resource(max_entries=DATASET_CACHE_MAX_ENTRIES, show_spinner="正在解析CSV...")
+def load_dataset(content_hash, _raw_bytes):
+    # 以content_hash为缓存键（_raw_bytes不参与哈希），同一文件的组件交互重跑直接命中缓存
+    encoding = sniff_encoding(_raw_bytes)
+    try:
+        df = read_schema_csv(_raw_bytes, encoding, CSV_SCHEMA)
+    except UnicodeDecodeError:
+        # 头部是utf-8但后文出现gbk字节
+        df = read_schema_csv(_raw_bytes, "gbk", CSV_SCHEMA)
+    if not all(col in df.columns for col in REQUIRED_COLS):
+        return df
+    df['study_number'] = study_number_codes(df['study_number'])
+    return df
+
+# === Study汇总表：每个study一行，数据集加载后单次groupby构建，各卡片/表格共享 ===
+# 首行取值（与 study_df[...].iloc[0] 语义一致）、ta/sourcing、ctn_base（actual优先，其次plan）、
+# 每个日期字段的最早值（<col>_min）以及leading site首行的EC/Contract日期（lead_<col>）
+LEADING_DATE_COLS = [
+    'ec_approval_actual_date', 'ec_approval_plan_date',
+    'contract_signoff_actual_date', 'contract_signoff_plan_date'
+]
+
+def is_leading_site(df):
+    if 'leading_site' in df.columns:
+        return df['leading_site']
+    return df['leading_site_or_not'].astype(str).str.upper() == 'YES'
+
+def study_summary_parts(df):
+    # 可分块累加的部分：每个study首行、各日期字段最早值、leading site首行（无leading_site_or_not字段时为None）
+    # 汇总表很小，编码存储的字段在这里还原为普通对象列/索引，下游按study取值、排序不受影响
+    def first_rows(rows):
+        rows = rows.drop_duplicates(subset=['study_number'], keep='first')
+        rows = rows.astype({col: object for col in rows.columns if isinstance(rows[col].dtype, pd.CategoricalDtype)})
+        # 逐列astype后的表按列分块，copy合并成整块，后续追加汇总列时不再碎片化
+        return rows.set_index('study_number').copy()
+    first = first_rows(df)
+    date_cols = [col for col in df.columns if col.endswith('_date')]
+    earliest = None
+    if date_cols:
+        earliest = df.groupby('study_number', sort=False, observed=True)[date_cols].min()
+        earliest.index = earliest.index.astype(object)
+    lead_first = None
+    if 'leading_site_or_not' in df.columns:
+        lead_first = first_rows(df[is_leading_site(df)])
+    return first, earliest, lead_first
+
+def merge_study_summary_parts(parts):
+    # 各块按出现顺序拼接：首行保留最先出现的一行，最早日期再取一次min
+    def first_rows(frames):
+        frames = [frame for frame in frames if len(frame)] or frames[:1]
+        merged = pd.concat(frames)
+        return merged[~merged.index.duplicated(keep='first')]
+    firsts, earliests, lead_firsts = zip(*parts)
+    earliest = None if earliests[0] is None else pd.concat(earliests).groupby(level=0, sort=False).min()
+    lead_first = None if lead_firsts[0] is None else first_rows(lead_firsts)
+    return first_rows(firsts), earliest, lead_first
+
+def finish_study_summary(first, earliest, lead_first):
+    summary = first
+    summary['ta'] = summary['clintrack_ta_desc'] if 'clintrack_ta_desc' in summary.columns else ''
+    summary['sourcing'] = summary['sourcing_strategy'] if 'sourcing_strategy' in summary.columns else ''
+    summary['ctn_base'] = summary['study_ctn_actual_date'].fillna(summary['study_ctn_plan_date'])
+    if earliest is not None:
+        summary = summary.join(earliest.add_suffix('_min'))
+    # 没有leading_site_or_not字段时，与原逻辑一致取study首行
+    if lead_first is None:
+        lead_first = summary
+    summary['has_leading'] = summary.index.isin(lead_first.index)
+    for col in LEADING_DATE_COLS:
+        if col in lead_first.columns:
+            summary['lead_' + col] = lead_first[col].reindex(summary.index)
+        else:
+            summary['lead_' + col] = pd.NaT
+    return summary
+
+def build_study_summary(df):
+    return finish_study_summary(*study_summary_parts(df))
+
+@st.cache_resource(max_entries=DATASET_CACHE_MAX_ENTRIES)
+def get_study_summary(dataset_key, _df):
+    # 增量更新得到的数据集：沿用上一版的汇总行，只重算受影响的study
+    lineage = get_dataset_lineage().get(dataset_key)
+    if lineage:
+        base = get_study_summary(lineage['base_key'], lineage['base_df'])
+        fresh = build_study_summary(_df[_df['study_number'].isin(lineage['affected'])])
+        return patch_study_rows(base, fresh, _df, lineage['affected'])
+    return build_study_summary(_df)
+
+# === Site Activation分位引擎 ===
+# 所有study一次分组排序：site_scope内按激活日期（actual优先，无则plan）升序，取前 n_frac = ceil(n_sites*frac) 家site，
+# 返回每个study的 actual/plan 完整性以及第n_frac家site的日期
+SITE_SCOPE_COLS = ['ssus', 'site_status', 'ssus_assignment_date', 'study_fsa_actual_date']
+
+def date_values(df, col):
+    # 取日期列为datetime64[ns]数组，字段不存在时全为NaT
+    if col not in df.columns:
+        return np.full(len(df), np.datetime64('NaT'), dtype='datetime64[ns]')
+    # 已是日期类型的列（加载时已标准化）直接取数组，to_datetime对日期列也会逐个元素检查
+    if df[col].dtype.kind == 'M':
+        return df[col].to_numpy(dtype='datetime64[ns]')
+    return pd.to_datetime(df[col], errors='coerce').to_numpy(dtype='datetime64[ns]')
+
+def site_scope_mask(df, fallback_all=True):
+    # ssus非空 / ssus为空且site_status为Initiating / ssus_assignment_date不晚于study_fsa_actual_date
+    # fallback_all：字段不全时整个study都算作scope；否则缺失字段按空值处理
+    if fallback_all and not all(col in df.columns for col in SITE_SCOPE_COLS):
+        return np.ones(len(df), dtype=bool)
+    ssus = df['ssus'] if 'ssus' in df.columns else pd.Series(np.nan, index=df.index, dtype=object)
+    site_status = df['site_status'] if 'site_status' in df.columns else pd.Series(np.nan, index=df.index, dtype=object)
+    ssus_assign = date_values(df, 'ssus_assignment_date')
+    fsa_actual = date_values(df, 'study_fsa_actual_date')
+    mask = (
+        ssus.notna().to_numpy() |
+        (ssus.isna() & (site_status == 'Initiating')).to_numpy(dtype=bool) |
+        (~np.isnat(ssus_assign) & ~np.isnat(fsa_actual) & (ssus_assign <= fsa_actual))
+    )
+    return mask
+
+def site_activation_quantiles(df, fracs, sort_by='sa_date', scope_fallback=True):
+    # sort_by: 'sa_date'（actual优先，无则plan）或 'sa_plan'；NaT排在最后，study内稳定排序
+    codes, studies = pd.factorize(df['study_number'])
+    studies = np.asarray(studies, dtype=object)
+    n_studies = len(studies)
+    scope = site_scope_mask(df, scope_fallback) & (codes >= 0)
+    codes = codes[scope]
+    sa_actual = date_values(df, 'site_sa_actual_date')[scope]
+    sa_plan = date_values(df, 'site_sa_plan_date')[scope]
+    sa_date = np.where(np.isnat(sa_actual), sa_plan, sa_actual)
+    key = (sa_date if sort_by == 'sa_date' else sa_plan).view('i8').copy()
+    key[key == np.iinfo(np.int64).min] = np.iinfo(np.int64).max
+    order = np.lexsort((key, codes))
+    codes, sa_actual, sa_plan, sa_date = codes[order], sa_actual[order], sa_plan[order], sa_date[order]
+    n_sites = np.bincount(codes, minlength=n_studies)
+    starts = np.concatenate(([0], np.cumsum(n_sites)[:-1]))
+    rank = np.arange(len(codes)) - starts[codes]
+    index = pd.Index(studies, name='study_number')
+    results = {}
+    for frac in fracs:
+        n_frac = np.maximum(1, np.ceil(n_sites * frac)).astype(int)
+        top = rank < n_frac[codes]
+        top_codes = codes[top]
+        def count(flags):
+            return np.bincount(top_codes, weights=flags[top], minlength=n_studies)
+        def top_agg(values, how):
+            return pd.Series(values[top]).groupby(top_codes).agg(how).reindex(range(n_studies)).to_numpy(dtype='datetime64[ns]')
+        n_top = np.minimum(n_frac, n_sites)
+        results[frac] = pd.DataFrame({
+            'n_sites': n_sites,
+            'n_frac': n_frac,
+            'actual_complete': count(np.isnat(sa_actual)) == 0,
+            'date_complete': count(np.isnat(sa_date)) == 0,
+            'no_dates': count(np.isnat(sa_actual) & np.isnat(sa_plan)) == n_top,
+            'actual_max': top_agg(sa_actual, 'max'),
+            'date_max': top_agg(sa_date, 'max'),
+            'plan_min': top_agg(sa_plan, 'min'),
+        }, index=index)
+    return results
+
+@st.cache_resource(max_entries=DATASET_CACHE_MAX_ENTRIES)
+def get_sa_quantiles(dataset_key, _df, fracs=(0.25, 0.75), sort_by='sa_date', scope_fallback=True):
+    # 各study的分位互不影响，增量更新时同汇总表一样只重算受影响的study
+    lineage = get_dataset_lineage().get(dataset_key)
+    if lineage:
+        base = get_sa_quantiles(lineage['base_key'], lineage['base_df'], fracs, sort_by, scope_fallback)
+        fresh = site_activation_quantiles(_df[_df['study_number'].isin(lineage['affected'])], fracs, sort_by=sort_by, scope_fallback=scope_fallback)
+        return {frac: patch_study_rows(base[frac], fresh[frac], _df, lineage['affected']) for frac in fracs}
+    return site_activation_quantiles(_df, fracs, sort_by=sort_by, scope_fallback=scope_fallback)
+
+# === Milestone规则注册表 ===
+# (名称, actual字段, plan字段, 目标=CTN+周数, 取值方式)；顺序即Study Details表格列顺序
+# 取值方式：'leading' 取leading site首行；'study' 取study内最早日期；0.25/0.75 取site activation分位
+MILESTONES = [
+    ("Leading EC Approval", "ec_approval_actual_date", "ec_approval_plan_date", 0, "leading"),
+    ("Leading Contract", "contract_signoff_actual_date", "contract_signoff_plan_date", 0, "leading"),
+    ("Country Package", "country_package_ready_actual_date", "country_package_ready_plan_date", -12, "study"),
+    ("Country Contract", "main_contract_tmpl_actual_date", "main_contract_tmpl_plan_date", -12, "study"),
+    ("IMP", "study_imp_ready_actual_date", "study_imp_ready_plan_date", 8.5, "study"),
+    ("Facility", "study_sfr_actual_date", "study_sfr_plan_date", 8.5, "study"),
+    ("HGRAC", "study_hia_actual_date", "study_hia_plan_date", 8.5, "study"),
+    ("FSA", "study_fsa_actual_date", "study_fsa_plan_date", 9, "study"),
+    ("FPS", "study_fps_actual_date", "study_fps_plan_date", 12, "study"),
+    ("25% SA", "site_sa_actual_date", "site_sa_plan_date", 13, 0.25),
+    ("75% SA", "site_sa_actual_date", "site_sa_plan_date", 19, 0.75),
+]
+MILESTONE_SOURCES = {name: source for name, _, _, _, source in MILESTONES}
+
+# 状态码：无灯 / 按期完成 / 超期完成 / 未完成且已超期 / 计划晚于目标
+STATUS_NONE, STATUS_MET, STATUS_MISSED, STATUS_OVERDUE, STATUS_AT_RISK = range(5)
+COLOR_GREEN = '#43a047'
+COLOR_YELLOW = '#ffb300'
+COLOR_RED = '#e53935'
+STATUS_COLORS = {STATUS_NONE: '', STATUS_MET: COLOR_GREEN, STATUS_MISSED: COLOR_RED, STATUS_OVERDUE: COLOR_RED, STATUS_AT_RISK: COLOR_YELLOW}
+
+def evaluate_milestones(summary, sa_quantiles, now):
+    # 一次计算 study × milestone 的 target/actual/plan 与状态码，各卡片、表格直接按study/milestone取值
+    # SA：前n_frac家site都有actual时取actual_max；否则都有日期时以date_max作为plan
+    names = [m[0] for m in MILESTONES]
+    shape = (len(summary), len(MILESTONES))
+    target = np.empty(shape, dtype='datetime64[ns]')
+    actual = np.empty(shape, dtype='datetime64[ns]')
+    plan = np.empty(shape, dtype='datetime64[ns]')
+    ctn = date_values(summary, 'ctn_base')
+    nat = np.datetime64('NaT', 'ns')
+    for j, (name, actual_col, plan_col, week_offset, source) in enumerate(MILESTONES):
+        target[:, j] = ctn + pd.Timedelta(weeks=week_offset).to_timedelta64()
+        if source == 'leading':
+            actual[:, j] = date_values(summary, 'lead_' + actual_col)
+            plan[:, j] = date_values(summary, 'lead_' + plan_col)
+        elif source == 'study':
+            actual[:, j] = date_values(summary, actual_col + '_min')
+            plan[:, j] = date_values(summary, plan_col + '_min')
+        else:
+            sa = sa_quantiles[source].reindex(summary.index)
+            actual_complete = sa['actual_complete'].fillna(False).to_numpy(dtype=bool)
+            date_complete = sa['date_complete'].fillna(False).to_numpy(dtype=bool)
+            actual[:, j] = np.where(actual_complete, sa['actual_max'].to_numpy(dtype='datetime64[ns]'), nat)
+            plan[:, j] = np.where(~actual_complete & date_complete, sa['date_max'].to_numpy(dtype='datetime64[ns]'), nat)
+    # 与NaT比较恒为False：无CTN时不会判为超期/黄灯
+    now = np.datetime64(pd.Timestamp(now).to_datetime64(), 'ns')
+    has_actual = ~np.isnat(actual)
+    status = np.full(shape, STATUS_NONE, dtype=np.int8)
+    status[has_actual] = STATUS_MET
+    status[has_actual & (actual > target)] = STATUS_MISSED
+    overdue = ~has_actual & (now > target)
+    status[overdue] = STATUS_OVERDUE
+    status[~has_actual & ~overdue & (plan > target)] = STATUS_AT_RISK
+    def frame(values):
+        return pd.DataFrame(values, index=summary.index, columns=names)
+    return {
+        'target': frame(target),
+        'actual': frame(actual),
+        'plan': frame(plan),
+        'status': frame(status),
+    }
+
+def milestones_in_window(target, start, end, left_closed=True):
+    # target落在 [start, end]（left_closed=False时为 (start, end]）内
+    lower = target >= start if left_closed else target > start
+    return lower & (target <= end)
+
+# === Study Details表格单元格高亮 ===
+# 浅黄：milestone（study首行）actual为空且target在未来5周内
+# 亮黄：前25%/75%（按plan排序）site仍有未激活且target在未来5周内；CTN仍为plan且在未来5周内、leading site的actual为空
+HIGHLIGHT_NEXT5 = "background:#fff9e5;"
+HIGHLIGHT_SOON = "background:#fffde7;"
+
+def build_highlight_matrix(summary, sa_by_plan, now):
+    # 返回 study × milestone列 的高亮style后缀（空字符串为不高亮），表格渲染时直接按study查表
+    five_weeks_later = (now + pd.Timedelta(weeks=5)).to_datetime64()
+    now = now.to_datetime64()
+    ctn = date_values(summary, 'ctn_base')
+    ctn_plan_only = np.isnat(date_values(summary, 'study_ctn_actual_date')) & ~np.isnat(ctn)
+    styles = {}
+    for name, actual_col, plan_col, week_offset, source in MILESTONES:
+        target = ctn + pd.Timedelta(weeks=week_offset).to_timedelta64()
+        no_actual = np.isnat(date_values(summary, actual_col))
+        soon = (now < target) & (target <= five_weeks_later)
+        if source == 'leading':
+            soon_flag = soon & ctn_plan_only & no_actual
+        elif source == 'study':
+            soon_flag = np.zeros(len(summary), dtype=bool)
+        else:
+            sa = sa_by_plan[source].reindex(summary.index)
+            soon_flag = soon & (sa['n_sites'].fillna(0).to_numpy() > 0) & ~sa['actual_complete'].fillna(True).to_numpy(dtype=bool)
+        next5_flag = no_actual & (now <= target) & (target <= five_weeks_later)
+        styles[name] = np.char.add(np.where(soon_flag, HIGHLIGHT_SOON, ''), np.where(next5_flag, HIGHLIGHT_NEXT5, ''))
+    return pd.DataFrame(styles, index=summary.index)
+
+# === 筛选索引：每个数据集只构建一次 ===
+# Study/TA/Sourcing取值 -> 汇总表中study位置（posting list）；row_study：每个site行所属study在汇总表中的位置
+# 筛选时各条件得到study位图并求交，再由 row_study 一次取出行位置
+def build_filter_index(df, summary):
+    index = {
+        'row_study': summary.index.get_indexer(df['study_number']),
+        'Study': {study: pos for pos, study in enumerate(summary.index)},
+    }
+    for field, col in [('TA', 'ta'), ('Sourcing', 'sourcing')]:
+        index[field] = summary[col].reset_index(drop=True).groupby(summary[col].to_numpy(), sort=False).indices
+    return index
+
+@st.cache_resource(max_entries=DATASET_CACHE_MAX_ENTRIES)
+def get_filter_index(dataset_key, _df, _summary):
+    return build_filter_index(_df, _summary)
+
+def postings_mask(postings, selected, n):
+    # 选中取值的posting list求并，得到study位图
+    mask = np.zeros(n, dtype=bool)
+    for value in selected:
+        mask[postings.get(value, [])] = True
+    return mask
+
+# === Milestone in Next N weeks 筛选 ===
+NEXT_MILESTONE_WEEKS = 5
+
+def studies_with_upcoming_milestone(df, now, window_weeks=NEXT_MILESTONE_WEEKS):
+    # 按site行判断：该行plan非空、actual为空，且target（该行CTN + 周数）落在 (now, now + window_weeks] 内
+    ctn_actual = date_values(df, 'study_ctn_actual_date')
+    ctn = np.where(np.isnat(ctn_actual), date_values(df, 'study_ctn_plan_date'), ctn_actual)
+    start = now.to_datetime64()
+    end = (now + pd.Timedelta(weeks=window_weeks)).to_datetime64()
+    hit = np.zeros(len(df), dtype=bool)
+    for _, actual_col, plan_col, week_offset, _ in MILESTONES:
+        target = ctn + pd.Timedelta(weeks=week_offset).to_timedelta64()
+        hit |= ~np.isnat(date_values(df, plan_col)) & np.isnat(date_values(df, actual_col)) & (start < target) & (target <= end)
+    return df['study_number'].to_numpy()[hit]
+
+# === Study Details表格分页 ===
+DETAILS_COLUMNS = [
+    'No', 'TA', 'Study', 'Sourcing', 'CTN', 'Leading EC Approval', 'Leading Contract', 'Country Package',
+    'Country Contract', 'IMP', 'Facility', 'HGRAC', 'FSA', 'FPS', '25% SA', '75% SA'
+]
+DETAILS_SORT_OPTIONS = ['CTN', 'Study', 'TA', 'Sourcing']
+DETAILS_PAGE_SIZES = [50, 100, 200, 500]
+
+@st.cache_resource(max_entries=DATASET_CACHE_MAX_ENTRIES)
+def get_details_index(dataset_key, _df, _study_summary):
+    # 表格索引每个数据集只建一次：只含筛选/排序需要的字段，按CTN排序编号；单元格HTML按页生成
+    study_list = _df['study_number'].dropna().unique()
+    details_df = pd.DataFrame({
+        'No': 0,
+        'TA': _study_summary['ta'].reindex(study_list).to_numpy(),
+        # 转为object：按Study排序时按study_number字符串排序，不受category取值顺序（如旧快照）影响
+        'Study': np.asarray(study_list, dtype=object),
+        'Sourcing': _study_summary['sourcing'].reindex(study_list).to_numpy(),
+    })
+    # 增加排序列：优先用actual，无则用plan
+    details_df['ctn_sort'] = details_df['Study'].map(_study_summary['ctn_base'])
+    # 排序后重置序号
+    details_df = details_df.sort_values('ctn_sort', ascending=True, na_position='last').reset_index(drop=True)
+    details_df['No'] = range(1, len(details_df) + 1)
+    details_df = details_df.drop(columns=['ctn_sort'])
+    # 每种排序方式的全表行顺序：稳定排序后再按筛选位图取子集，与先筛选再排序结果相同，翻页时不再排序
+    orders = {}
+    for sort_by in DETAILS_SORT_OPTIONS:
+        # CTN排序即No的顺序；其余列稳定排序，相同值保持CTN顺序
+        sort_col = 'No' if sort_by == 'CTN' else sort_by
+        for desc in (False, True):
+            orders[sort_by, desc] = details_df.sort_values(sort_col, ascending=not desc, kind='stable', na_position='last').index.to_numpy()
+    return {
+        'df': details_df,
+        # 每行study在汇总表中的位置，筛选位图按它取出表格行
+        'summary_pos': _study_summary.index.get_indexer(details_df['Study']),
+        'orders': orders,
+        'options': {col: details_df[col].dropna().unique().tolist() for col in ['Study', 'TA', 'Sourcing']},
+    }
+
+# === CTN-X KPI分类（CTN-FSA / CTN-FPS / CTN-SA 等卡片共用） ===
+# 只统计有CTN的study；取study首行日期，与 (date - ctn).days 向下取整的天数比较 target_days
+def classify_ctn_kpi(summary, actual_col, plan_col, target_days, now, scope=None, track_overdue=True, unplanned_miss=False):
+    # 返回 (纳入统计的study数, {bucket: study_number数组})，bucket为 meet/miss/in_progress_miss/pred_meet/pred_miss
+    # scope：纳入统计的study（默认有CTN的study）；track_overdue：无actual且CTN已超过target_days天时记为进行中超期
+    # unplanned_miss：无CTN或无plan、无法预测的study记为预测超期（默认不计入任何bucket）
+    ctn = date_values(summary, 'ctn_base')
+    actual = date_values(summary, actual_col)
+    plan = date_values(summary, plan_col)
+    day = np.timedelta64(1, 'D')
+    has_ctn = ~np.isnat(ctn)
+    counted = has_ctn if scope is None else np.asarray(scope, dtype=bool)
+    has_actual = counted & has_ctn & ~np.isnat(actual)
+    # NaT参与的整除会告警，结果都会被上面的掩码排除
+    with np.errstate(invalid='ignore'):
+        overdue = counted & has_ctn & ~has_actual & ((np.datetime64(pd.Timestamp(now).to_datetime64(), 'ns') - ctn) // day > target_days)
+        actual_ok = (actual - ctn) // day <= target_days
+        plan_ok = (plan - ctn) // day <= target_days
+    if not track_overdue:
+        overdue = np.zeros(len(summary), dtype=bool)
+    pending = counted & ~has_actual & ~overdue
+    predicted = pending & has_ctn & ~np.isnat(plan)
+    studies = summary.index.to_numpy()
+    buckets = {
+        'meet': studies[has_actual & actual_ok],
+        'miss': studies[has_actual & ~actual_ok],
+        'in_progress_miss': studies[overdue],
+        'pred_meet': studies[predicted & plan_ok],
+        'pred_miss': studies[(pending & ~(predicted & plan_ok)) if unplanned_miss else (predicted & ~plan_ok)],
+    }
+    return int(counted.sum()), buckets
+
+def sa_kpi_frame(summary, sa):
+    # 把site activation分位结果对齐到汇总表，作为classify_ctn_kpi的输入
+    # sa_actual：前n_frac家site都有actual时取actual_max；sa_date：都有日期（actual优先）时取date_max
+    sa = sa.reindex(summary.index)
+    actual_complete = sa['actual_complete'].fillna(False).to_numpy(dtype=bool)
+    date_complete = sa['date_complete'].fillna(False).to_numpy(dtype=bool)
+    nat = np.datetime64('NaT', 'ns')
+    return pd.DataFrame({
+        'ctn_base': date_values(summary, 'ctn_base'),
+        'sa_actual': np.where(actual_complete, sa['actual_max'].to_numpy(dtype='datetime64[ns]'), nat),
+        'sa_date': np.where(date_complete, sa['date_max'].to_numpy(dtype='datetime64[ns]'), nat),
+        'sa_plan_min': sa['plan_min'].to_numpy(dtype='datetime64[ns]'),
+        'in_scope': sa['n_sites'].fillna(0).to_numpy() > 0,
+        'no_dates': sa['no_dates'].fillna(True).to_numpy(dtype=bool),
+    }, index=summary.index)
+
+# === Total Site卡片：各流程完成数 ===
+SSU_FUNNEL_STEPS = [
+    ('GCP', 'site_gcp_actual_date'),
+    ('EC', 'ec_approval_actual_date'),
+    ('Main Contract', 'contract_signoff_actual_date'),
+    ('Commitment Letter', 'comm_ltr_obt_actual_date'),
+    ('SSU Last Step', None),
+    ('Activation', 'site_sa_actual_date')
+]
+SSU_LAST_STEP_COLS = ['ec_approval_actual_date', 'contract_signoff_actual_date', 'comm_ltr_obt_actual_date']
+
+def column_str_equals(df, col, value, upper=False):
+    # str(x).strip()（可选.upper()）是否等于value；只对去重后的取值做字符串处理，字段不存在时视为空串
+    if col not in df.columns:
+        return np.full(len(df), value == '')
+    codes, uniques = pd.factorize(df[col])
+    texts = [str(u).strip() for u in uniques]
+    hit = np.array([(t.upper() if upper else t) == value for t in texts] + [str(np.nan) == value], dtype=bool)
+    return hit[codes]
+
+def ssu_last_step_actual(df):
+    # SSU最后一步日期：EC/主合同/承诺函的最大值，三方且影响SA的CRC合同签署日期也计入（无该字段时不计入）
+    # 已激活的site宽松：只要有一步非空；未激活的严格：计入的步骤必须全部非空
+    steps = [date_values(df, col) for col in SSU_LAST_STEP_COLS]
+    if 'crc_contract_signoff_actual_date' in df.columns:
+        crc_in = column_str_equals(df, 'crc_contract_type', '三方') & column_str_equals(df, 'crc_contract_impact_sa', 'YES', upper=True)
+        crc = date_values(df, 'crc_contract_signoff_actual_date')
+        steps.append(np.where(crc_in, crc, np.datetime64('NaT')))
+        strict_ok = ~crc_in | ~np.isnat(crc)
+    else:
+        strict_ok = np.ones(len(df), dtype=bool)
+    steps = np.column_stack(steps)
+    last_step = np.fmax.reduce(steps, axis=1)
+    strict_ok &= ~np.isnat(steps[:, :len(SSU_LAST_STEP_COLS)]).any(axis=1)
+    activated = ~np.isnat(date_values(df, 'site_sa_actual_date'))
+    return np.where(activated | strict_ok, last_step, np.datetime64('NaT'))
+
+def ssu_funnel_counts(df):
+    # 所有流程日期组成一个矩阵，一次统计各列非空数
+    steps = np.column_stack([ssu_last_step_actual(df) if col is None else date_values(df, col) for _, col in SSU_FUNNEL_STEPS])
+    complete = np.count_nonzero(~np.isnat(steps), axis=0)
+    return [{'step': step_name, 'Complete': int(n)} for (step_name, _), n in zip(SSU_FUNNEL_STEPS, complete)]
+
+# === Site Selection & SSUS Assignment卡片：各site日期相对study的country package ready日期的周数分布 ===
+# 区间右闭：(-inf,0] (0,2] (2,4] (4,8] (8,inf)
+PACKAGE_READY_WEEK_EDGES = [0, 2, 4, 8]
+PACKAGE_READY_WEEK_LABELS = ['Before Package Ready', '≤2w', '2-4w', '4-8w', '>8w']
+
+def package_ready_week_counts(df, cols):
+    # study的package ready日期（actual最早，无则plan最早）按行展开，各列一次算周数并分箱计数
+    study_groups = df.groupby('study_number', sort=False, observed=True)
+    package = study_groups['country_package_ready_actual_date'].transform('min')
+    if 'country_package_ready_plan_date' in df.columns:
+        package = package.fillna(study_groups['country_package_ready_plan_date'].transform('min'))
+    package = package.to_numpy(dtype='datetime64[ns]')
+    counts = []
+    for col in cols:
+        dates = date_values(df, col)
+        valid = ~np.isnat(dates) & ~np.isnat(package)
+        weeks = np.floor_divide(dates[valid] - package[valid], np.timedelta64(1, 'D')) / 7
+        bins = np.searchsorted(PACKAGE_READY_WEEK_EDGES, weeks, side='left')
+        counts.append(np.bincount(bins, minlength=len(PACKAGE_READY_WEEK_LABELS)).tolist())
+    return counts
+
+# === 流程耗时分位引擎：所有flow的天数差组成 行×flow 二维数组，一次排序得到各flow（可按组）的样本数与分位数 ===
+# (名称, 结束字段, 开始字段)
+SITE_DURATION_FLOWS = [
+    ('CTN-GCP', 'site_gcp_actual_date', 'study_ctn_actual_date'),
+    ('CTN-EC', 'ec_approval_actual_date', 'study_ctn_actual_date'),
+    ('CTN-Contract', 'contract_signoff_actual_date', 'study_ctn_actual_date'),
+    ('CTN-SA', 'site_sa_actual_date', 'study_ctn_actual_date'),
+    ('GCP-EC', 'ec_approval_actual_date', 'site_gcp_actual_date'),
+    ('GCP-Contract', 'contract_signoff_actual_date', 'site_gcp_actual_date'),
+    ('Comm Ltr-HGRAC', 'comm_ltr_obt_actual_date', 'study_hia_actual_date'),
+]
+LEADING_DURATION_FLOWS = [
+    ('Package-Country to Site', 'site_package_actual_date', 'country_package_ready_actual_date'),
+    ('Site package-GCP', 'site_gcp_actual_date', 'site_package_actual_date'),
+    ('GCP-EC', 'ec_approval_actual_date', 'site_gcp_actual_date'),
+    ('GCP-Contract', 'contract_signoff_actual_date', 'site_gcp_actual_date'),
+    ('Comm Ltr-CTN', 'comm_ltr_obt_actual_date', 'study_ctn_actual_date'),
+    ('CTN-SA', 'site_sa_actual_date', 'study_ctn_actual_date'),
+]
+DURATION_QUANTILES = [('p25', 0.25), ('p50', 0.5), ('p75', 0.75), ('p90', 0.9)]
+
+def flow_days(df, flows):
+    # 天数差与Timedelta.days一致（向下取整）；缺字段或任一端为空为NaN
+    # 按列存储（order='F'）：逐列写入和按列排序都是连续内存
+    days = np.full((len(df), len(flows)), np.nan, order='F')
+    ns_per_day = np.timedelta64(1, 'D') // np.timedelta64(1, 'ns')
+    dates = {}
+    for j, (_, end_col, start_col) in enumerate(flows):
+        if end_col in df.columns and start_col in df.columns:
+            for col in (end_col, start_col):
+                if col not in dates:
+                    dates[col] = date_values(df, col)
+            delta = dates[end_col] - dates[start_col]
+            days[:, j] = np.where(np.isnat(delta), np.nan, delta.view('i8') // ns_per_day)
+    return days
+
+def duration_stats(df, flows, by=None):
+    # 返回每个flow的count与p25/p50/p75/p90（线性插值，与np.median一致；无样本为NaN）
+    # by给出分组字段（如 clintrack_ta_desc / sourcing_strategy）时按 (组, flow) 返回，所有组在同一次排序中完成
+    days = flow_days(df, flows)
+    names = [flow[0] for flow in flows]
+    if by is None:
+        codes, groups = np.zeros(len(df), dtype=np.intp), pd.Index(['All'])
+    else:
+        codes, groups = pd.factorize(df[by], use_na_sentinel=False)
+    n_groups, n_flows = len(groups), len(flows)
+    valid = ~np.isnan(days)
+    # 每组每个flow的样本数
+    if n_groups == 1:
+        counts = valid.sum(axis=0)[None, :]
+    else:
+        counts = np.bincount((codes[:, None] * n_flows + np.arange(n_flows))[valid], minlength=n_groups * n_flows).reshape(n_groups, n_flows)
+    stats = {'count': counts}
+    low = np.nanmin(days) if valid.any() else 0
+    span = np.nanmax(days) - low + 1 if valid.any() else 1
+    # 排序键 = 组号*span + 天数偏移；NaN排在最后，排序后每列依次是各组的有效样本
+    keys = days - low if n_groups == 1 else codes[:, None] * span + (days - low)
+    keys.sort(axis=0)
+    starts = np.cumsum(counts, axis=0) - counts
+    group_base = np.arange(n_groups)[:, None] * span - low
+    last = max(len(df) - 1, 0)
+    for name, q in DURATION_QUANTILES:
+        pos = starts + q * np.maximum(counts - 1, 0)
+        lo_pos = np.floor(pos).astype(np.intp).clip(0, last)
+        frac = pos - lo_pos
+        if len(df):
+            lo = np.take_along_axis(keys, lo_pos, axis=0) - group_base
+            hi = np.take_along_axis(keys, np.minimum(lo_pos + (frac > 0), last), axis=0) - group_base
+            value = lo + (hi - lo) * frac
+        else:
+            value = np.full(counts.shape, np.nan)
+        stats[name] = np.where(counts > 0, value, np.nan)
+    result = pd.DataFrame({name: values.ravel() for name, values in stats.items()},
+                          index=pd.MultiIndex.from_product([groups, names], names=[by or 'group', 'flow']))
+    return result.loc['All'] if by is None else result
+
+# === 流程耗时分块草图（大文件近似模式）：数据按块累计，每块按 (study, flow, 天数) 累计样本数 ===
+# 耗时均为整天数：按日分桶的稀疏直方图可直接相加合并，内存只与不同 (study, flow, 天数) 组合数有关；
+# 超出±DURATION_SKETCH_MAX_DAYS的样本截到边界：插值用到的两个样本都未截断的分位数与duration_stats完全一致，
+# 用到截断样本的分位数只知道真实值比显示值更极端，逐个分位标记（<分位>_clipped）
+DURATION_SKETCH_MAX_DAYS = 3650
+DURATION_SKETCH_AUTO_BYTES = 200 * 1024 * 1024
+
+def duration_sketch(groups, days):
+    # groups：每行的组（study）；days：flow_days的 行×flow 天数差
+    rows, flows = np.nonzero(~np.isnan(days))
+    values = days[rows, flows]
+    sample = pd.DataFrame({
+        'group': groups[rows],
+        'flow': flows,
+        'day': np.clip(values, -DURATION_SKETCH_MAX_DAYS, DURATION_SKETCH_MAX_DAYS).astype(np.int32),
+        'clipped': np.abs(values) > DURATION_SKETCH_MAX_DAYS,
+    })
+    return sample.groupby(['group', 'flow', 'day'], sort=False).agg(n=('clipped', 'size'), clipped=('clipped', 'sum'))
+
+def merge_duration_sketches(sketches):
+    # 各草图的样本数直接相加；None/空草图跳过
+    sketches = [sketch for sketch in sketches if sketch is not None and not sketch.empty]
+    if not sketches:
+        return duration_sketch(np.array([], dtype=object), np.empty((0, 0)))
+    return pd.concat(sketches).groupby(level=['group', 'flow', 'day'], sort=False).sum()
+
+def sketch_duration_stats(sketch, flows, groups=None):
+    # 与duration_stats同样的输出（count与p25/p50/p75/p90），另附截断样本数clipped及各分位是否用到截断样本；
+    # groups给出时只合并这些组（筛选联动）
+    if groups is not None:
+        sketch = sketch[sketch.index.get_level_values('group').isin(groups)]
+    merged = sketch.groupby(level=['flow', 'day']).sum().sort_index()
+    result = pd.DataFrame(np.nan, index=pd.Index([flow[0] for flow in flows], name='flow'),
+                          columns=['count'] + [name for name, _ in DURATION_QUANTILES] + ['clipped'])
+    result['count'] = 0
+    result['clipped'] = 0
+    for name, _ in DURATION_QUANTILES:
+        result[f'{name}_clipped'] = False
+    for j, flow in enumerate(flows):
+        if j not in merged.index.get_level_values('flow'):
+            continue
+        hist = merged.loc[j]
+        days = hist.index.to_numpy(dtype=float)
+        cum = np.cumsum(hist['n'].to_numpy())
+        n = cum[-1]
+        result.loc[flow[0], ['count', 'clipped']] = [n, hist['clipped'].sum()]
+        # 截断样本都在两端的边界桶里：排名在前low_clipped个或后high_clipped个的样本是截断值
+        low_clipped = hist['clipped'].get(-DURATION_SKETCH_MAX_DAYS, 0)
+        high_clipped = hist['clipped'].get(DURATION_SKETCH_MAX_DAYS, 0)
+        for name, q in DURATION_QUANTILES:
+            # 第r个样本（从0起）的取值：累计数首个超过r的桶
+            pos = q * (n - 1)
+            lo = days[np.searchsorted(cum, np.floor(pos), side='right')]
+            hi = days[np.searchsorted(cum, np.ceil(pos), side='right')]
+            result.loc[flow[0], name] = lo + (hi - lo) * (pos - np.floor(pos))
+            result.loc[flow[0], f'{name}_clipped'] = bool(np.floor(pos) < low_clipped or np.ceil(pos) >= n - high_clipped)
+    return result
+
+def fold_duration_sketches(sketches, chunk):
+    # 每块读完即合并，只保留全部site和leading site的累计草图
+    studies = chunk['study_number'].astype(str).to_numpy()
+    lead = is_leading_site(chunk).to_numpy() if 'leading_site_or_not' in chunk.columns else np.ones(len(chunk), dtype=bool)
+    return {
+        'site': merge_duration_sketches([sketches['site'], duration_sketch(studies, flow_days(chunk, SITE_DURATION_FLOWS))]),
+        'leading': merge_duration_sketches([sketches['leading'], duration_sketch(studies[lead], flow_days(chunk[lead], LEADING_DURATION_FLOWS))]),
+    }
+
+def duration_sketch_note(durations):
+    # 卡片下方的误差说明：卡片展示中位数，没用到截断样本的与精确计算相同，用到的列出flow
+    n, clipped = int(durations['count'].sum()), int(durations['clipped'].sum())
+    affected = durations.index[durations['p50_clipped'].to_numpy(dtype=bool)].tolist()
+    if not clipped:
+        detail = '无截断样本，与精确计算相同'
+    elif affected:
+        detail = f"超出±{DURATION_SKETCH_MAX_DAYS}天的{clipped}个样本截到边界，{'、'.join(affected)}的中位数用到截断样本，真实值比显示值更极端，其余与精确计算相同"
+    else:
+        detail = f"超出±{DURATION_SKETCH_MAX_DAYS}天的{clipped}个样本截到边界，中位数未用到截断样本，与精确计算相同"
+    return f'<div style="text-align:center;color:#888;font-size:12px;">分块草图：{n}个样本，{detail}</div>'
+
+# === 分块流式解析 ===
+# 大文件不整体read_csv：逐块解析投影后的字段，study汇总与流程耗时草图随块累加，分词和类型转换的临时内存只占一块。
+# site行仍全部保留（Site Activation、漏斗、明细表都按site计算），最后拼接时各块与结果短暂并存：
+# 常驻内存照样随文件大小线性增长，降低的只是解析峰值。结果（含category取值顺序）与load_dataset+build_study_summary相同
+INGEST_CHUNK_ROWS = 50000
+INGEST_STREAM_BYTES = 200 * 1024 * 1024
+
+@st.cache_resource(max_entries=DATASET_CACHE_MAX_ENTRIES, show_spinner="正在分块解析CSV...")
+def load_dataset_chunked(content_hash, _raw_bytes):
+    def fold_chunks(chunks):
+        sites, parts, sketches = [], [], {'site': None, 'leading': None}
+        for chunk in chunks:
+            if not all(col in chunk.columns for col in REQUIRED_COLS):
+                return {'df': chunk, 'summary': None, 'sketches': None}
+            chunk['study_number'] = study_number_codes(chunk['study_number'])
+            sites.append(chunk)
+            parts.append(study_summary_parts(chunk))
+            sketches = fold_duration_sketches(sketches, chunk)
+        if not sites:
+            return None
+        return {
+            'df': concat_chunks(sites),
+            'summary': finish_study_summary(*merge_study_summary_parts(parts)),
+            'sketches': {key: merge_duration_sketches([sketch]) for key, sketch in sketches.items()},
+        }
+    encoding = sniff_encoding(_raw_bytes)
+    try:
+        ingested = fold_chunks(read_schema_csv(_raw_bytes, encoding, CSV_SCHEMA, chunksize=INGEST_CHUNK_ROWS))
+    except UnicodeDecodeError:
+        encoding = "gbk"
+        ingested = fold_chunks(read_schema_csv(_raw_bytes, encoding, CSV_SCHEMA, chunksize=INGEST_CHUNK_ROWS))
+    # 只有表头时没有数据块，按整体读取的空表处理
+    return ingested or fold_chunks([read_schema_csv(_raw_bytes, encoding, CSV_SCHEMA)])
+
+# === 数据集快照 ===
+# 每次成功解析的上传按内容哈希存一份Feather（Arrow IPC，不压缩）快照，哈希写入地址栏的dataset参数；
+# 同一地址刷新页面或服务重启后按该参数恢复快照，不必重新上传和解析，其他访问者的页面不受影响。
+# 恢复时快照整表读入内存转成DataFrame，不是零拷贝映射：省去的只是CSV解析，常驻内存与上传时相同
+DATASET_SNAPSHOT_DIR = os.environ.get('DASHBOARD_SNAPSHOT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dataset_snapshots'))
+DATASET_SNAPSHOT_KEEP = DATASET_CACHE_MAX_ENTRIES
+
+def dataset_snapshot_path(content_hash):
+    return os.path.join(DATASET_SNAPSHOT_DIR, f'{content_hash}.feather')
+
+def list_dataset_snapshots():
+    # 按最近使用时间（文件修改时间）从新到旧
+    try:
+        paths = [os.path.join(DATASET_SNAPSHOT_DIR, name) for name in os.listdir(DATASET_SNAPSHOT_DIR) if name.endswith('.feather')]
+    except FileNotFoundError:
+        return []
+    return sorted(paths, key=os.path.getmtime, reverse=True)
+
+def url_snapshot_key():
+    # 地址栏dataset参数指向的快照；只接受内容哈希格式，快照已被清理时返回None
+    key = st.query_params.get('dataset')
+    if key and re.fullmatch(r'[0-9a-f]{32}', key) and os.path.exists(dataset_snapshot_path(key)):
+        return key
+    return None
+
+def save_dataset_snapshot(content_hash, df, upload_bytes):
+    path = dataset_snapshot_path(content_hash)
+    try:
+        if os.path.exists(path):
+            # 已有快照只标记为最近使用
+            os.utime(path)
+            return
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # 原始上传大小随快照保存，恢复时用于大文件相关的默认选项
+        table = table.replace_schema_metadata({**table.schema.metadata, b'upload_bytes': str(upload_bytes).encode()})
+        os.makedirs(DATASET_SNAPSHOT_DIR, exist_ok=True)
+        # 先写临时文件再改名，重启时不会读到写了一半的快照
+        tmp_path = path + '.tmp'
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+        for old_path in list_dataset_snapshots()[DATASET_SNAPSHOT_KEEP:]:
+            os.remove(old_path)
+    except (OSError, pa.ArrowException):
+        # 快照只用于加速重启，写入失败不影响本次使用
+        pass
+
+@st.cache_resource(max_entries=DATASET_CACHE_MAX_ENTRIES, show_spinner="正在加载本页面上次上传的数据...")
+def load_dataset_snapshot(content_hash):
+    # 整表加载：to_pandas把全部数据复制成DataFrame（带空值的日期列、category列无法零拷贝）；
+    # memory_map只让读取时的文件页由页缓存承载，不再另分配一份Arrow缓冲区，降低的是加载峰值
+    table = feather.read_table(dataset_snapshot_path(content_hash), memory_map=True)
+    return {'df': table.to_pandas(), 'upload_bytes': int(table.schema.metadata.get(b'upload_bytes', b'0'))}
+
+# === 增量更新 ===
+# 运维每天多次重新导出全量数据，但每次只有少数study变化。两种增量方式都以本页面的快照（地址栏dataset参数）为上一版，
+# 不会合并到其他访问者上传的数据；本页面没有快照时按新数据集处理：
+#   完整导出：按study比对内容指纹，找出变更/新增/删除的study
+#   增量CSV：只含变更行，按 (study_number, study_site_number) 替换上一版同key的行，新key追加
+# 得到的数据集记下上一版和受影响的study，study汇总表与Site Activation分位只重算这些study；
+# milestone状态每次按当前日期向量化重算，Tab表格按新数据集重建
+UPLOAD_MODES = ['新数据集', '完整导出（与上次数据比对）', '增量CSV（合并到上次数据）']
+DATASET_KEY_COLS = ['study_number', 'study_site_number']
+
+@st.cache_resource
+def get_dataset_lineage():
+    # dataset_key -> {'base_key', 'base_df', 'affected'}；只保留最近几条，缺失时按全量计算
+    return {}
+
+def patch_study_rows(base, fresh, df, affected):
+    # 未受影响的study沿用上一版的行，受影响的用重算结果；行顺序按study在新数据集中首次出现的顺序
+    kept = base[~base.index.isin(affected)]
+    frames = [frame for frame in (kept, fresh) if len(frame)] or [fresh]
+    order = pd.Index(np.asarray(df['study_number'].unique(), dtype=object), name=base.index.name)
+    return pd.concat(frames).reindex(order)
+
+def column_kinds(df):
+    # 字段及类型（category只看类型，不比较取值集合）
+    return [(col, 'category' if isinstance(dtype, pd.CategoricalDtype) else str(dtype)) for col, dtype in df.dtypes.items()]
+
+def study_row_signatures(df):
+    # 每个study的内容指纹：行哈希混入study内行号后求和（uint64溢出回绕），行内容、行顺序、site增删都会改变指纹
+    rows = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    pos = df.groupby('study_number', sort=False, observed=True).cumcount().to_numpy().astype(np.uint64)
+    mixed = pd.util.hash_array(rows ^ (pos * np.uint64(0x9E3779B97F4A7C15)))
+    return pd.Series(mixed).groupby(df['study_number'].to_numpy(dtype=object), sort=False).sum()
+
+def changed_studies(base, df):
+    old_studies = np.asarray(base['study_number'].unique(), dtype=object)
+    new_studies = np.asarray(df['study_number'].unique(), dtype=object)
+    # 字段或类型变了，所有study的汇总都要重算
+    if column_kinds(base) != column_kinds(df):
+        return list(pd.unique(np.concatenate([new_studies, old_studies])))
+    old, new = study_row_signatures(base), study_row_signatures(df)
+    common = new.index.intersection(old.index)
+    changed = common[new[common].to_numpy() != old[common].to_numpy()]
+    return list(changed) + list(new.index.difference(old.index)) + list(old.index.difference(new.index))
+
+def merge_dataset_delta(base, delta):
+    # 上一版中与delta同key的行全部删除，delta行放在该key首行的位置；新key追加在末尾
+    if set(base.columns) != set(delta.columns) or not all(col in delta.columns for col in DATASET_KEY_COLS):
+        raise ValueError(f"增量CSV字段与上次数据不一致: {sorted(set(base.columns) ^ set(delta.columns))}")
+    delta = delta[list(base.columns)]
+    n = len(base)
+    study_codes, _ = pd.factorize(np.concatenate([base['study_number'].to_numpy(dtype=object), delta['study_number'].to_numpy(dtype=object)]), use_na_sentinel=False)
+    site_codes, sites = pd.factorize(np.concatenate([base['study_site_number'].to_numpy(dtype=object), delta['study_site_number'].to_numpy(dtype=object)]), use_na_sentinel=False)
+    keys = study_codes.astype(np.int64) * len(sites) + site_codes
+    base_keys, delta_keys = keys[:n], keys[n:]
+    replaced = np.isin(base_keys, delta_keys)
+    first_pos = pd.Series(np.arange(n)).groupby(base_keys, sort=False).first()
+    delta_pos = pd.Series(delta_keys).map(first_pos).fillna(n).to_numpy()
+    merged = concat_chunks([base[~replaced], delta.copy(deep=False)])
+    order = np.argsort(np.concatenate([np.flatnonzero(~replaced), delta_pos]), kind='stable')
+    affected = list(pd.unique(delta['study_number'].to_numpy(dtype=object)))
+    return merged.take(order).reset_index(drop=True), affected
+
+@st.cache_resource(max_entries=DATASET_CACHE_MAX_ENTRIES, show_spinner="正在与上次的数据比对...")
+def get_dataset_update(upload_key, base_key, delta, _base_df, _upload_df):
+    if delta:
+        df, affected = merge_dataset_delta(_base_df, _upload_df)
+        dataset_key = hash_upload(f'{base_key}+{upload_key}'.encode())
+    else:
+        df, affected = _upload_df, changed_studies(_base_df, _upload_df)
+        dataset_key = upload_key
+    lineage = get_dataset_lineage()
+    lineage[dataset_key] = {'base_key': base_key, 'base_df': _base_df, 'affected': affected}
+    for old_key in list(lineage)[:-DATASET_CACHE_MAX_ENTRIES]:
+        del lineage[old_key]
+    return {'key': dataset_key, 'df': df, 'affected': affected}
+
+# === HGRAC数据源 ===
+# 连接配置从TOML读取（默认脚本同目录的 hgrac_db.toml，可用环境变量 HGRAC_DB_CONFIG 指定），例如：
+#   [hgrac]
+#   driver = "sqlite3"        # DB-API模块名，如 sqlite3 / pymysql / psycopg2 / oracledb
+#   table = "hgrac"
+#   pool_size = 4
+#   chunk_size = 500          # IN (...) 每批study个数
+#   cache_ttl = 600           # 每个study结果的缓存秒数
+#   local_store = "hgrac_local.db"      # 可选：本地SQLite库，配置后Tab只查本地库
+#   watermark_column = "last_modified"  # 本地库增量同步用的上游最后修改时间字段
+#   sync_interval = 300                 # 同步间隔秒数
+#   reconcile_interval = 86400          # 全量对账间隔秒数，上游删除的行在对账时从本地库删除
+#   [hgrac.connect]           # 原样传给 driver.connect(**connect)；sqlite3的相对路径按配置文件所在目录解析
+#   database = "hgrac.db"
+HGRAC_CONFIG_PATH = os.environ.get('HGRAC_DB_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hgrac_db.toml'))
+HGRAC_COLUMNS = [
+    'ta', 'study_number', 'ctn_actual_date', 'ctn_plan_date', 'filling_or_approval',
+    'leading_site_ec_approval_actual_date', 'leading_site_contract_signoff_actual_date',
+    'application_final_date', 'first_science_date', 'official_date', 'public_date', 'publish_date'
+]
+HGRAC_DATE_COLUMNS = [col for col in HGRAC_COLUMNS if col.endswith('_date')]
+HGRAC_POOL_SIZE = 4
+HGRAC_QUERY_CHUNK = 500
+HGRAC_CACHE_TTL = 600
+HGRAC_SYNC_INTERVAL = 300
+HGRAC_RECONCILE_INTERVAL = 86400
+
+def sql_identifier(name):
+    # 表名/字段名来自配置文件，只允许普通标识符
+    if not re.fullmatch(r'[A-Za-z_][\w.]*', name):
+        raise ValueError(f"HGRAC配置中的表名/字段名不合法: {name}")
+    return name
+
+def close_hgrac_pool(pool):
+    # 连接池被淘汰时关闭空闲连接；正在使用的连接归还时发现池已关闭会直接关闭（见hgrac_connection）
+    with pool['lock']:
+        pool['closed'] = True
+        while True:
+            try:
+                conn = pool['idle'].get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+
+@st.cache_resource(max_entries=1, on_release=close_hgrac_pool)
+def get_hgrac_pool(config_path, config_mtime):
+    # 按配置文件路径+修改时间缓存，配置改动后连接池和study缓存一起重建；只保留最新的一个，旧池淘汰时关闭连接
+    config = toml.load(config_path)['hgrac']
+    config_dir = os.path.dirname(os.path.abspath(config_path))
+    driver = importlib.import_module(config.get('driver', 'sqlite3'))
+    connect_kwargs = dict(config.get('connect', {}))
+    if driver is sqlite3:
+        connect_kwargs['database'] = os.path.join(config_dir, connect_kwargs.get('database', 'hgrac.db'))
+        # 脚本重跑不在同一线程，连接由连接池保证同一时间只被一个线程使用
+        connect_kwargs['check_same_thread'] = False
+    store = None
+    if config.get('local_store'):
+        store = os.path.join(config_dir, config['local_store'])
+        init_hgrac_store(store)
+    pool_size = int(config.get('pool_size', HGRAC_POOL_SIZE))
+    return {
+        'config': config,
+        'driver': driver,
+        'connect': connect_kwargs,
+        'slots': threading.BoundedSemaphore(pool_size),
+        'idle': queue.LifoQueue(maxsize=pool_size),
+        'store': store,
+        # 已取数study的HGRAC行及每个study的取数时间，跨会话共享
+        'rows': None,
+        'fetched_at': {},
+        # rows最近一次更新的时间（monotonic），作为HGRAC Tab缓存的数据版本
+        'version': None,
+        # 最近一次后台预取：(dataset_key, Future)
+        'prefetch': (None, None),
+        # 本地库同步状态：上游不可用时error记录原因，Tab降级显示本地数据
+        'sync': {'future': None, 'started': -np.inf, 'last_ok': None, 'error': None},
+        'lock': threading.Lock(),
+        'closed': False,
+    }
+
+@contextmanager
+def hgrac_connection(pool):
+    # 最多pool_size个连接同时使用；空闲连接复用，出错的连接直接关闭不放回
+    with pool['slots']:
+        try:
+            conn = pool['idle'].get_nowait()
+        except queue.Empty:
+            conn = pool['driver'].connect(**pool['connect'])
+        try:
+            yield conn
+        except Exception:
+            conn.close()
+            raise
+        with pool['lock']:
+            if pool['closed']:
+                conn.close()
+            else:
+                pool['idle'].put_nowait(conn)
+
+def hgrac_in_clause(paramstyle, values):
+    # 按驱动的paramstyle生成 IN (...) 占位符和参数
+    if paramstyle == 'qmark':
+        return ', '.join(['?'] * len(values)), list(values)
+    if paramstyle == 'numeric':
+        return ', '.join(f':{i + 1}' for i in range(len(values))), list(values)
+    if paramstyle == 'named':
+        return ', '.join(f':s{i}' for i in range(len(values))), {f's{i}': v for i, v in enumerate(values)}
+    return ', '.join(['%s'] * len(values)), list(values)
+
+def select_hgrac_rows(conn, paramstyle, table, studies, chunk_size):
+    # 一个连接内按chunk_size分批 IN (...) 查询
+    frames = []
+    cursor = conn.cursor()
+    try:
+        for i in range(0, len(studies), chunk_size):
+            placeholders, params = hgrac_in_clause(paramstyle, studies[i:i + chunk_size])
+            cursor.execute(f"SELECT {', '.join(HGRAC_COLUMNS)} FROM {table} WHERE study_number IN ({placeholders})", params)
+            frames.append(pd.DataFrame(cursor.fetchall(), columns=HGRAC_COLUMNS))
+    finally:
+        cursor.close()
+    return pd.concat(frames, ignore_index=True)
+
+def fetch_hgrac_rows(pool, studies):
+    # 配置了本地库时只查本地库，否则直接查上游
+    chunk_size = int(pool['config'].get('chunk_size', HGRAC_QUERY_CHUNK))
+    if pool['store'] is not None:
+        with closing(sqlite3.connect(pool['store'], timeout=30)) as conn:
+            rows = select_hgrac_rows(conn, 'qmark', 'hgrac', studies, chunk_size)
+    else:
+        table = sql_identifier(pool['config'].get('table', 'hgrac'))
+        with hgrac_connection(pool) as conn:
+            rows = select_hgrac_rows(conn, getattr(pool['driver'], 'paramstyle', 'qmark'), table, studies, chunk_size)
+    rows['study_number'] = rows['study_number'].astype(str)
+    for col in HGRAC_DATE_COLUMNS:
+        rows[col] = pd.to_datetime(rows[col], errors='coerce')
+    return rows
+
+# === HGRAC本地库：按study_number建索引，按上游最后修改时间水位增量同步 ===
+def init_hgrac_store(path):
+    with closing(sqlite3.connect(path, timeout=30)) as conn, conn:
+        # WAL：同步写入时Tab仍可并发读
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f"CREATE TABLE IF NOT EXISTS hgrac ({', '.join(HGRAC_COLUMNS)})")
+        conn.execute('CREATE INDEX IF NOT EXISTS hgrac_study_number ON hgrac (study_number)')
+        conn.execute('CREATE TABLE IF NOT EXISTS hgrac_sync (key TEXT PRIMARY KEY, value TEXT)')
+
+def hgrac_store_state(path, key):
+    # hgrac_sync表中的同步状态；从未写入时返回None
+    with closing(sqlite3.connect(path, timeout=30)) as conn:
+        row = conn.execute("SELECT value FROM hgrac_sync WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def hgrac_store_watermark(path):
+    # 从未同步成功时返回None
+    return hgrac_store_state(path, 'watermark')
+
+def study_row_counts(records, study_pos):
+    # study -> 该study各行的计数（多重集合），用于判断study的行是否变化，与行顺序无关
+    counts = {}
+    for record in records:
+        counts.setdefault(record[study_pos], Counter())[record] += 1
+    return counts
+
+def store_value(value):
+    # 上游驱动返回的日期/Decimal等类型转成文本写入SQLite
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+def sync_hgrac_store(pool):
+    # 首次同步及每隔reconcile_interval全量对账：上游已删除的行随之从本地库删除；
+    # 其余时候取水位及之后有改动的study。同一时间戳的行可能在上次同步之后才提交，所以用 >= 而不是 >，
+    # 水位上的study每次都会重新拉取；按study与本地行比对，只替换真正有变化的study，重复拉取不会产生重复行
+    config, store = pool['config'], pool['store']
+    table = sql_identifier(config.get('table', 'hgrac'))
+    watermark_col = sql_identifier(config['watermark_column'])
+    watermark = hgrac_store_watermark(store)
+    reconciled_at = hgrac_store_state(store, 'reconciled_at')
+    full = watermark is None or reconciled_at is None or time.time() - float(reconciled_at) > config.get('reconcile_interval', HGRAC_RECONCILE_INTERVAL)
+    columns = ', '.join(HGRAC_COLUMNS + [watermark_col])
+    with hgrac_connection(pool) as conn:
+        cursor = conn.cursor()
+        try:
+            if full:
+                cursor.execute(f"SELECT {columns} FROM {table}")
+            else:
+                placeholder, params = hgrac_in_clause(getattr(pool['driver'], 'paramstyle', 'qmark'), [watermark])
+                cursor.execute(
+                    f"SELECT {columns} FROM {table} WHERE study_number IN "
+                    f"(SELECT study_number FROM {table} WHERE {watermark_col} >= {placeholder})", params)
+            fetched = cursor.fetchall()
+        finally:
+            cursor.close()
+    study_pos = HGRAC_COLUMNS.index('study_number')
+    records = [tuple(str(v) if i == study_pos else store_value(v) for i, v in enumerate(row[:-1])) for row in fetched]
+    upstream = study_row_counts(records, study_pos)
+    marks = [row[-1] for row in fetched if row[-1] is not None]
+    with closing(sqlite3.connect(store, timeout=30)) as conn, conn:
+        # 本地行按原始值读取（不经DataFrame，避免空值/整数被转成浮点导致误判为变化）
+        if full:
+            local_rows = conn.execute(f"SELECT {', '.join(HGRAC_COLUMNS)} FROM hgrac").fetchall()
+        else:
+            studies, local_rows = list(upstream), []
+            for i in range(0, len(studies), HGRAC_QUERY_CHUNK):
+                chunk = studies[i:i + HGRAC_QUERY_CHUNK]
+                local_rows += conn.execute(f"SELECT {', '.join(HGRAC_COLUMNS)} FROM hgrac WHERE study_number IN ({', '.join(['?'] * len(chunk))})", chunk).fetchall()
+        local = study_row_counts(local_rows, study_pos)
+        # 全量对账时本地有、上游没有的study也算变化（上游已删除）
+        changed = [study for study in upstream.keys() | (local.keys() if full else set()) if upstream.get(study) != local.get(study)]
+        conn.executemany('DELETE FROM hgrac WHERE study_number = ?', [(study,) for study in changed])
+        conn.executemany(
+            f"INSERT INTO hgrac VALUES ({', '.join(['?'] * len(HGRAC_COLUMNS))})",
+            [record for study in changed if study in upstream for record in upstream[study].elements()])
+        if marks:
+            conn.execute("INSERT OR REPLACE INTO hgrac_sync (key, value) VALUES ('watermark', ?)", (str(max(marks)),))
+        if full:
+            conn.execute("INSERT OR REPLACE INTO hgrac_sync (key, value) VALUES ('reconciled_at', ?)", (str(time.time()),))
+    # 内存缓存中有变化的study作废（首次同步时全部作废）
+    with pool['lock']:
+        if watermark is None:
+            pool['fetched_at'].clear()
+        else:
+            for study in changed:
+                pool['fetched_at'].pop(study, None)
+
+def run_hgrac_sync(pool):
+    # 后台执行；上游不可用时记录原因，本地库保持上次同步的数据
+    try:
+        sync_hgrac_store(pool)
+    except Exception as e:
+        with pool['lock']:
+            pool['sync']['error'] = str(e)
+    else:
+        with pool['lock']:
+            pool['sync']['last_ok'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            pool['sync']['error'] = None
+
+def hgrac_pool():
+    # 未配置数据库时返回None
+    if not os.path.exists(HGRAC_CONFIG_PATH):
+        return None
+    return get_hgrac_pool(HGRAC_CONFIG_PATH, os.path.getmtime(HGRAC_CONFIG_PATH))
+
+def load_hgrac_rows(pool, study_numbers):
+    # 未过期的study直接用缓存，其余一次批量查询；不调用streamlit接口，可在后台线程执行
+    # 返回 (这些study的行, 数据版本)；有study重新取数（TTL过期或同步作废）时版本随之变化
+    ttl = pool['config'].get('cache_ttl', HGRAC_CACHE_TTL)
+    studies = list(dict.fromkeys(str(study) for study in study_numbers))
+    now = time.monotonic()
+    with pool['lock']:
+        fetched_at = pool['fetched_at']
+        missing = [study for study in studies if now - fetched_at.get(study, -np.inf) > ttl]
+    if missing:
+        rows = fetch_hgrac_rows(pool, missing)
+        with pool['lock']:
+            # 替换这些study的旧行；数据库中没有的study也记下取数时间，避免重复查询
+            cached = pool['rows']
+            if cached is not None:
+                cached = cached[~cached['study_number'].isin(missing)]
+                rows = pd.concat([cached, rows], ignore_index=True) if not rows.empty else cached
+            pool['rows'] = rows
+            pool['version'] = now
+            fetched_at.update(dict.fromkeys(missing, now))
+    with pool['lock']:
+        cached, version = pool['rows'], pool['version']
+    return cached[cached['study_number'].isin(studies)].reset_index(drop=True), version
+
+def get_hgrac_data(study_numbers):
+    # 按study取HGRAC数据及数据版本；未配置数据库时返回空表
+    pool = hgrac_pool()
+    if pool is None:
+        return pd.DataFrame(columns=HGRAC_COLUMNS), None
+    return load_hgrac_rows(pool, study_numbers)
+
+# === HGRAC后台预取：study列表确定后立即在后台线程取数，数据库等待与卡片/KPI计算重叠 ===
+HGRAC_PREFETCH_WORKERS = 2
+
+@st.cache_resource
+def get_hgrac_executor():
+    return ThreadPoolExecutor(max_workers=HGRAC_PREFETCH_WORKERS, thread_name_prefix='hgrac-prefetch')
+
+def start_hgrac_sync(pool):
+    # 距上次同步超过sync_interval且没有同步在进行时提交后台同步；返回进行中的同步Future
+    interval = pool['config'].get('sync_interval', HGRAC_SYNC_INTERVAL)
+    with pool['lock']:
+        sync = pool['sync']
+        if (sync['future'] is None or sync['future'].done()) and time.monotonic() - sync['started'] > interval:
+            sync['started'] = time.monotonic()
+            sync['future'] = get_hgrac_executor().submit(run_hgrac_sync, pool)
+        return sync['future']
+
+def prefetch_hgrac_rows(pool, study_numbers, first_sync):
+    # 本地库从未同步过时先等首次同步（失败也继续，降级为读本地库）
+    if first_sync is not None:
+        futures_wait([first_sync])
+    return load_hgrac_rows(pool, study_numbers)
+
+def start_hgrac_prefetch(dataset_key, study_numbers):
+    # 返回预取的Future；同一数据集的预取仍在进行时直接复用；未配置数据库时返回None
+    pool = hgrac_pool()
+    if pool is None:
+        return None
+    first_sync = None
+    if pool['store'] is not None:
+        sync_future = start_hgrac_sync(pool)
+        if sync_future is not None and not sync_future.done() and hgrac_store_watermark(pool['store']) is None:
+            first_sync = sync_future
+    with pool['lock']:
+        key, future = pool['prefetch']
+        if key != dataset_key or future.done():
+            future = get_hgrac_executor().submit(prefetch_hgrac_rows, pool, study_numbers, first_sync)
+            pool['prefetch'] = (dataset_key, future)
+    return future
+
+def hgrac_degraded_notice():
+    # 上游同步失败时的提示；正常时返回None
+    pool = hgrac_pool()
+    if pool is None or pool['store'] is None:
+        return None
+    with pool['lock']:
+        error, last_ok = pool['sync']['error'], pool['sync']['last_ok']
+    if error is None:
+        return None
+    return f"HGRAC上游数据库暂不可用（{error}），当前显示本地缓存数据，最近同步成功: {last_ok or '本次启动后尚未成功'}"
+
 uploaded_file = st.file_uploader("请上传包含 study_number, study_ctn_plan_date, study_ctn_actual_date 字段的CSV", type=["csv"])
+upload_mode = st.radio("上传方式", UPLOAD_MODES, horizontal=True, key='upload_mode')
 df = None
+dataset_key = None
+filter_index = None
+study_summary = None
+card_milestones = None
+hgrac_prefetch = None
+duration_sketches = None
+ingested = None
+upload_bytes = 0
 if uploaded_file:
-    try:
-        df = pd.read_csv(uploaded_file, encoding="utf-8")
-    except UnicodeDecodeError:
-        uploaded_file.seek(0)
-        df = pd.read_csv(uploaded_file, encoding="gbk")
-    # 字段名标准化
-    df.columns = [col.strip().lower().replace(" ", "_") for col in df.columns]
-    required_cols = ["study_number", "study_ctn_plan_date", "study_ctn_actual_date"]
-    if not all(col in df.columns for col in required_cols):
-        st.error(f"CSV缺少必要字段: {required_cols}")
+    st.session_state['had_upload'] = True
+    raw_bytes = uploaded_file.getvalue()
+    upload_bytes = len(raw_bytes)
+    dataset_key = hash_upload(raw_bytes)
+    # 大文件分块解析，study汇总与流程耗时草图在解析时一并累加
+    ingested = load_dataset_chunked(dataset_key, raw_bytes) if upload_bytes >= INGEST_STREAM_BYTES else None
+    df = ingested['df'] if ingested else load_dataset(dataset_key, raw_bytes)
+    if upload_mode != UPLOAD_MODES[0] and all(col in df.columns for col in REQUIRED_COLS):
+        # 上一版取本次会话第一次按该方式处理这份上传时本页面的快照（之后地址栏参数会改为本次结果），之后的重跑保持不变
+        base_keys = st.session_state.setdefault('upload_base_keys', {})
+        base_key = base_keys.setdefault((dataset_key, upload_mode), url_snapshot_key())
+        if base_key == dataset_key:
+            base_key = None
+        if not base_key:
+            st.info("本页面没有上一版数据，按新数据集处理")
+        else:
+            try:
+                base = load_dataset_snapshot(base_key)
+                update = get_dataset_update(dataset_key, base_key, upload_mode == UPLOAD_MODES[2], base['df'], df)
+            except (OSError, pa.ArrowException, ValueError) as e:
+                st.error(f"增量更新失败，按新数据集处理: {e}")
+            else:
+                if update['key'] != dataset_key:
+                    # 合并后的数据集不再对应本次上传的原始CSV，解析时的汇总和草图都不能沿用
+                    ingested = None
+                    upload_bytes = base['upload_bytes']
+                df, dataset_key = update['df'], update['key']
+                st.caption(f"与上次数据相比有 {len(update['affected'])} 个study变更，汇总只重算这些study")
+else:
+    # 本会话中移除了上传文件：清除地址栏参数，页面回到空白
+    if st.session_state.pop('had_upload', False):
+        st.query_params.pop('dataset', None)
+    # 否则按地址栏参数恢复本页面上次上传的快照（刷新页面、服务重启后）
+    dataset_key = url_snapshot_key()
+    if dataset_key:
+        try:
+            snapshot = load_dataset_snapshot(dataset_key)
+            df, upload_bytes = snapshot['df'], snapshot['upload_bytes']
+            st.caption("已恢复本页面上次上传的数据，重新上传CSV即可替换")
+        except (OSError, pa.ArrowException):
+            dataset_key = None
+if df is not None:
+    if not all(col in df.columns for col in REQUIRED_COLS):
+        st.error(f"CSV缺少必要字段: {REQUIRED_COLS}")
         df = None
+        dataset_key = None
     else:
-        df['study_number'] = df['study_number'].astype(str)
-        # 对所有以_date结尾的字段做标准化
-        for col in df.columns:
-            if col.endswith('_date'):
-                df[col] = pd.to_datetime(df[col], errors='coerce')
+        if uploaded_file:
+            save_dataset_snapshot(dataset_key, df, upload_bytes)
+            st.query_params['dataset'] = dataset_key
+        study_summary = ingested['summary'] if ingested else get_study_summary(dataset_key, df)
+        # study列表已知，HGRAC数据在后台预取
+        hgrac_prefetch = start_hgrac_prefetch(dataset_key, study_summary.index.tolist())
+        filter_index = get_filter_index(dataset_key, df, study_summary)
+        # 卡片A/B沿用原口径：scope字段不全时SA按全部site统计；字段齐全时两种口径相同，与表格共用同一份分位缓存
+        card_scope_fallback = not all(col in df.columns for col in SITE_SCOPE_COLS)
+        card_milestones = evaluate_milestones(study_summary, get_sa_quantiles(dataset_key, df, scope_fallback=card_scope_fallback), pd.Timestamp.now())
+        # 草图只在分块解析时随解析累计，开关也只在这时提供（大文件默认开启）；
+        # 数据集已整体在内存时（小文件、快照恢复、增量合并）直接精确计算，草图既不省内存又多出截断误差
+        if ingested and st.toggle('流程耗时按分块草图计算（大文件近似模式）', value=upload_bytes >= DURATION_SKETCH_AUTO_BYTES, key='duration_sketch_mode'):
+            duration_sketches = ingested['sketches']
+        # 缓存对象为只读共享数据，页面内使用浅拷贝（新增列、赋值均不影响缓存）
+        df = df.copy(deep=False)
 
 # === 新增：卡片A和卡片B单独一行 ===
 row_top = st.columns(2)
@@ -204,129 +1483,33 @@ with row_top[0]:
         if df is not None:
             now = pd.Timestamp.now()
             five_weeks_ago = now - pd.Timedelta(weeks=5)
-            milestone_defs = [
-                ("FSA", "study_fsa_actual_date", "study_fsa_plan_date", 9),
-                ("FPS", "study_fps_actual_date", "study_fps_plan_date", 12),
-                ("25% SA", "site_sa_actual_date", "site_sa_plan_date", 13, 0.25),
-                ("75% SA", "site_sa_actual_date", "site_sa_plan_date", 19, 0.75),
-                ("IMP", "study_imp_ready_actual_date", "study_imp_ready_plan_date", 8.5),
-                ("Facility", "study_sfr_actual_date", "study_sfr_plan_date", 8.5),
-                ("HGRAC", "study_hia_actual_date", "study_hia_plan_date", 8.5),
-                ("Leading EC Approval", "ec_approval_actual_date", "ec_approval_plan_date", 0, "leading"),
-                ("Leading Contract", "contract_signoff_actual_date", "contract_signoff_plan_date", 0, "leading"),
-                ("Country Package", "country_package_ready_actual_date", "country_package_ready_plan_date", -12)
-            ]
+            # 按优先级排序（Country Contract不纳入统计）
+            priority = ["FSA", "FPS", "25% SA", "75% SA", "IMP", "Facility", "HGRAC", "Leading EC Approval", "Leading Contract", "Country Package"]
+            target = card_milestones['target'][priority]
+            actual = card_milestones['actual'][priority]
+            plan = card_milestones['plan'][priority]
+            is_sa = np.array([isinstance(MILESTONE_SOURCES[m], float) for m in priority])
+            # 超期完成；未完成时，SA看第n_frac家site的plan是否晚于目标，其余看目标是否已过
+            not_done_missed = pd.DataFrame(np.where(is_sa, plan > target, now > target), index=target.index, columns=priority)
+            missed = milestones_in_window(target, five_weeks_ago, now) & ((actual > target) | (actual.isna() & not_done_missed))
+            # leading milestone只看有leading site的study
+            for m in priority:
+                if MILESTONE_SOURCES[m] == 'leading':
+                    missed[m] &= study_summary['has_leading']
             # study维度收集超期milestone
             study_miss = {}
-            for study in df['study_number'].dropna().unique():
-                study_df = df[df['study_number'] == study]
-                # 获取TA/Sourcing
-                ta = study_df['clintrack_ta_desc'].iloc[0] if 'clintrack_ta_desc' in study_df.columns else ''
-                sourcing = study_df['sourcing_strategy'].iloc[0] if 'sourcing_strategy' in study_df.columns else ''
-                # CTN基准
-                ctn_actual = study_df['study_ctn_actual_date'].iloc[0] if 'study_ctn_actual_date' in study_df.columns else pd.NaT
-                ctn_plan = study_df['study_ctn_plan_date'].iloc[0] if 'study_ctn_plan_date' in study_df.columns else pd.NaT
-                ctn_base = pd.to_datetime(ctn_actual) if pd.notna(ctn_actual) else (pd.to_datetime(ctn_plan) if pd.notna(ctn_plan) else None)
-                if ctn_base is None:
-                    continue
-                missed = []
-                for m in milestone_defs:
-                    m_name = m[0]
-                    actual_col = m[1]
-                    plan_col = m[2]
-                    week_offset = m[3]
-                    # 特殊处理25%/75% SA和leading site
-                    if m_name in ["25% SA", "75% SA"]:
-                        # 只统计site_scope
-                        site_scope = study_df[
-                            (study_df['ssus'].notna()) |
-                            ((study_df['ssus'].isna()) & (study_df['site_status'] == 'Initiating')) |
-                            (
-                                (study_df['ssus_assignment_date'].notna()) &
-                                (study_df['study_fsa_actual_date'].notna()) &
-                                (pd.to_datetime(study_df['ssus_assignment_date'], errors='coerce') <= pd.to_datetime(study_df['study_fsa_actual_date'], errors='coerce'))
-                            )
-                        ].copy() if 'ssus' in study_df.columns and 'site_status' in study_df.columns and 'ssus_assignment_date' in study_df.columns and 'study_fsa_actual_date' in study_df.columns else study_df.copy()
-                        n_sites = len(site_scope)
-                        if n_sites == 0:
-                            continue
-                        frac = m[4]
-                        n_frac = max(1, int(np.ceil(n_sites * frac)))
-                        
-                        # 修改：按照正确的75% SA逻辑，与Study Details表格保持一致
-                        site_scope['sa_actual'] = pd.to_datetime(site_scope['site_sa_actual_date'], errors='coerce')
-                        site_scope['sa_plan'] = pd.to_datetime(site_scope['site_sa_plan_date'], errors='coerce')
-                        
-                        # 按actual日期排序，如果actual为空则用plan日期
-                        site_scope['sa_date'] = site_scope['sa_actual'].fillna(site_scope['sa_plan'])
-                        top_sites = site_scope.sort_values('sa_date').head(n_frac)
-                        
-                        # 检查是否有足够的数据量
-                        top_sites_actual = top_sites['sa_actual']
-                        top_sites_plan = top_sites['sa_plan']
-                        target = ctn_base + pd.Timedelta(weeks=week_offset)
-                        
-                        # 只统计目标日期在过去5周内
-                        if target is not None and five_weeks_ago <= target <= now:
-                            # 1. 检查是否有足够数量的actual site activation date（第75分位的site有actual日期）
-                            if top_sites_actual.notna().all():
-                                sa_actual_max = top_sites_actual.max()
-                                if sa_actual_max > target:
-                                    missed.append(m_name)
-                            # 2. 检查是否有足够数量的plan site activation date（第75分位的site有plan日期）
-                            elif top_sites['sa_date'].notna().all():
-                                sa_date_max = top_sites['sa_date'].max()
-                                if sa_date_max > target:
-                                    missed.append(m_name)
-                            # 3. 当数据缺失时，不纳入统计
-                    elif len(m) == 5 and m[4] == "leading":
-                        # 只看leading site
-                        if 'leading_site_or_not' in study_df.columns:
-                            lead_rows = study_df[study_df['leading_site_or_not'].astype(str).str.upper() == 'YES']
-                        else:
-                            lead_rows = study_df
-                        if lead_rows.empty:
-                            continue
-                        actual = lead_rows[actual_col].iloc[0] if actual_col in lead_rows.columns else pd.NaT
-                        plan = lead_rows[plan_col].iloc[0] if plan_col in lead_rows.columns else pd.NaT
-                        target = ctn_base + pd.Timedelta(weeks=week_offset)
-                        # 只统计目标日期在5周内
-                        if target is not None and five_weeks_ago <= target <= now:
-                            # 超期完成
-                            if pd.notna(actual) and actual > target:
-                                missed.append(m_name)
-                            # 超期未完成
-                            elif pd.isna(actual) and now > target:
-                                missed.append(m_name)
-                    else:
-                        actual = study_df[actual_col].dropna().sort_values().iloc[0] if actual_col in study_df.columns and study_df[actual_col].notna().any() else pd.NaT
-                        plan = study_df[plan_col].dropna().sort_values().iloc[0] if plan_col in study_df.columns and study_df[plan_col].notna().any() else pd.NaT
-                        target = ctn_base + pd.Timedelta(weeks=week_offset)
-                        # 只统计目标日期在5周内
-                        if target is not None and five_weeks_ago <= target <= now:
-                            # 超期完成
-                            if pd.notna(actual) and actual > target:
-                                missed.append(m_name)
-                            # 超期未完成
-                            elif pd.isna(actual) and now > target:
-                                missed.append(m_name)
-                if missed:
-                    study_miss[study] = {
-                        'ta': ta,
-                        'sourcing': sourcing,
-                        'milestones': missed
-                    }
-            # 按优先级排序
-            priority = ["FSA", "FPS", "25% SA", "75% SA", "IMP", "Facility", "HGRAC", "Leading EC Approval", "Leading Contract", "Country Package"]
-            def sort_milestones(milestones):
-                return sorted(milestones, key=lambda x: priority.index(x) if x in priority else 99)
+            for study in missed.index[missed.any(axis=1)]:
+                study_miss[study] = {
+                    'ta': study_summary.at[study, 'ta'],
+                    'sourcing': study_summary.at[study, 'sourcing'],
+                    'milestones': [m for m in priority if missed.at[study, m]]
+                }
             # 渲染为bulleted HTML
             html = '<div style="line-height:1.25;">'
             for study, info in study_miss.items():
                 ta = info['ta']
                 sourcing = info['sourcing']
-                ms = sort_milestones(info['milestones'])
-                ms_str = ', '.join(ms)
+                ms_str = ', '.join(info['milestones'])
                 html += f'<div style="margin-bottom:2px;">• <b>{study}</b> '
                 if ta or sourcing:
                     html += f'（{ta + ("/" if ta and sourcing else "") + sourcing}）'
@@ -344,93 +1527,43 @@ with row_top[1]:
         if df is not None:
             now = pd.Timestamp.now()
             five_weeks_later = now + pd.Timedelta(weeks=5)
-            milestone_defs = [
-                ("Leading EC Approval", "ec_approval_plan_date", 0, "Leading EC Approval计划晚于CTN"),
-                ("Leading Contract", "contract_signoff_plan_date", 0, "Leading Contract计划晚于CTN"),
-                ("Country Package", "country_package_ready_plan_date", -12, "Country Package计划晚于CTN-12wks"),
-                ("IMP", "study_imp_ready_plan_date", 8.5, "IMP计划晚于CTN+8.5wks，FSA和FPS可能受影响"),
-                ("Facility", "study_sfr_plan_date", 8.5, "Facility计划晚于CTN+8.5wks，FSA和FPS可能受影响"),
-                ("HGRAC", "study_hia_plan_date", 8.5, "HGRAC计划晚于CTN+8.5wks，FSA和FPS可能受影响"),
-                ("FSA", "study_fsa_plan_date", 9, "FSA计划晚于CTN+9wks"),
-                ("FPS", "study_fps_plan_date", 12, "FPS计划晚于CTN+12wks"),
-                ("25% SA", "site_sa_plan_date", 13, "25% SA计划晚于CTN+13wks", 0.25),
-                ("75% SA", "site_sa_plan_date", 19, "75% SA计划晚于CTN+19wks", 0.75)
-            ]
+            reasons = {
+                "Leading EC Approval": "Leading EC Approval计划晚于CTN",
+                "Leading Contract": "Leading Contract计划晚于CTN",
+                "Country Package": "Country Package计划晚于CTN-12wks",
+                "IMP": "IMP计划晚于CTN+8.5wks，FSA和FPS可能受影响",
+                "Facility": "Facility计划晚于CTN+8.5wks，FSA和FPS可能受影响",
+                "HGRAC": "HGRAC计划晚于CTN+8.5wks，FSA和FPS可能受影响",
+                "FSA": "FSA计划晚于CTN+9wks",
+                "FPS": "FPS计划晚于CTN+12wks",
+                "25% SA": "25% SA计划晚于CTN+13wks",
+                "75% SA": "75% SA计划晚于CTN+19wks"
+            }
+            names = list(reasons)
+            target = card_milestones['target'][names]
+            plan = card_milestones['plan'][names].copy()
+            # leading milestone的plan沿用全部site中的最早plan
+            for name, _, plan_col, _, source in MILESTONES:
+                if source == 'leading':
+                    plan[name] = study_summary[plan_col + '_min'] if plan_col + '_min' in study_summary.columns else pd.NaT
+            late_plan = plan > target
+            risk_next5 = milestones_in_window(target, now, five_weeks_later, left_closed=False) & late_plan
+            risk_later = (target > five_weeks_later) & late_plan
+            # FSA已过目标但未完成，且FPS目标未到
+            fsa_pending = (
+                card_milestones['actual']['FSA'].isna() &
+                (now > card_milestones['target']['FSA']) &
+                (now <= card_milestones['target']['FPS'])
+            )
             results = []  # 未来5周内
             results_later = []  # 未来5周之后
-            study_list = df['study_number'].dropna().unique()
-            for study in study_list:
-                study_df = df[df['study_number'] == study]
-                ta = study_df['clintrack_ta_desc'].iloc[0] if 'clintrack_ta_desc' in study_df.columns else ''
-                sourcing = study_df['sourcing_strategy'].iloc[0] if 'sourcing_strategy' in study_df.columns else ''
-                ctn_actual = study_df['study_ctn_actual_date'].iloc[0] if 'study_ctn_actual_date' in study_df.columns else pd.NaT
-                ctn_plan = study_df['study_ctn_plan_date'].iloc[0] if 'study_ctn_plan_date' in study_df.columns else pd.NaT
-                ctn_base = pd.to_datetime(ctn_actual) if pd.notna(ctn_actual) else (pd.to_datetime(ctn_plan) if pd.notna(ctn_plan) else None)
-                if ctn_base is None:
-                    continue
-                for m in milestone_defs:
-                    m_name = m[0]
-                    plan_col = m[1]
-                    week_offset = m[2]
-                    reason = m[3]
-                    # 25%/75% SA特殊处理
-                    if m_name in ["25% SA", "75% SA"]:
-                        frac = m[4]
-                        site_scope = study_df[
-                            (study_df['ssus'].notna()) |
-                            ((study_df['ssus'].isna()) & (study_df['site_status'] == 'Initiating')) |
-                            (
-                                (study_df['ssus_assignment_date'].notna()) &
-                                (study_df['study_fsa_actual_date'].notna()) &
-                                (pd.to_datetime(study_df['ssus_assignment_date'], errors='coerce') <= pd.to_datetime(study_df['study_fsa_actual_date'], errors='coerce'))
-                            )
-                        ].copy() if 'ssus' in study_df.columns and 'site_status' in study_df.columns and 'ssus_assignment_date' in study_df.columns and 'study_fsa_actual_date' in study_df.columns else study_df.copy()
-                        n_sites = len(site_scope)
-                        if n_sites == 0:
-                            continue
-                        n_frac = max(1, int(np.ceil(n_sites * frac)))
-                        site_scope['sa_plan'] = pd.to_datetime(site_scope['site_sa_plan_date'], errors='coerce')
-                        site_scope['sa_actual'] = pd.to_datetime(site_scope['site_sa_actual_date'], errors='coerce')
-                        
-                        # 按actual日期排序，如果actual为空则用plan日期
-                        site_scope['sa_date'] = site_scope['sa_actual'].fillna(site_scope['sa_plan'])
-                        top_sites = site_scope.sort_values('sa_date').head(n_frac)
-                        
-                        # 修改：按照正确的25%/75% SA逻辑，与Study Details表格保持一致
-                        # 检查是否有足够的数据量
-                        top_sites_actual = top_sites['sa_actual']
-                        top_sites_plan = top_sites['sa_plan']
-                        
-                        # 1. 检查前25%/75分位的site是否都有actual日期
-                        if top_sites_actual.notna().all():
-                            # 如果前25%/75分位的site都有actual日期，说明milestone已完成，跳过风险判断
-                            continue
-                        # 2. 检查前25%/75分位的site是否都有日期（actual或plan）
-                        # 如果某个site没有plan日期，它必须有actual日期
-                        elif top_sites['sa_date'].notna().all():
-                            # 取第25%/75分位那家site的日期（优先actual，没有actual的用plan）
-                            sa_date_max = top_sites['sa_date'].max()
-                            target = ctn_base + pd.Timedelta(weeks=week_offset)
-                            if now < target <= five_weeks_later and sa_date_max > target:
-                                results.append((study, ta, sourcing, reason))
-                            elif target > five_weeks_later and sa_date_max > target:
-                                results_later.append((study, ta, sourcing, reason))
-                        # 3. 当数据缺失时，不纳入风险判断
-                    else:
-                        # 新增：FPS相关逻辑前，判断FSA未完成影响
-                        if m_name == "FPS":
-                            fsa_actual = study_df['study_fsa_actual_date'].dropna() if 'study_fsa_actual_date' in study_df.columns else pd.Series(dtype='datetime64[ns]')
-                            fsa_target = ctn_base + pd.Timedelta(weeks=9)
-                            fps_target = ctn_base + pd.Timedelta(weeks=12)
-                            if now > fsa_target and now <= fps_target and fsa_actual.empty:
-                                results.append((study, ta, sourcing, 'FSA尚未完成，FPS可能受影响'))
-                        plan = study_df[plan_col].dropna().sort_values().iloc[0] if plan_col in study_df.columns and study_df[plan_col].notna().any() else pd.NaT
-                        target = ctn_base + pd.Timedelta(weeks=week_offset)
-                        if pd.notna(plan):
-                            if now < target <= five_weeks_later and plan > target:
-                                results.append((study, ta, sourcing, reason))
-                            elif target > five_weeks_later and plan > target:
-                                results_later.append((study, ta, sourcing, reason))
+            for study in study_summary.index[risk_next5.any(axis=1) | risk_later.any(axis=1) | fsa_pending]:
+                ta = study_summary.at[study, 'ta']
+                sourcing = study_summary.at[study, 'sourcing']
+                if fsa_pending[study]:
+                    results.append((study, ta, sourcing, 'FSA尚未完成，FPS可能受影响'))
+                results.extend((study, ta, sourcing, reasons[m]) for m in names if risk_next5.at[study, m])
+                results_later.extend((study, ta, sourcing, reasons[m]) for m in names if risk_later.at[study, m])
             # 分为左右两列展示
             col_left, col_right = st.columns(2)
             with col_left:
@@ -483,8 +1616,8 @@ for i, col in enumerate(cols):
                 if df is not None:
                     total_study = df['study_number'].nunique()
                     st.markdown(f'<div class="stCardNumber">{total_study}</div>', unsafe_allow_html=True)
-                    # 计算每个study_number的最新一条（去重）
-                    study_df = df.drop_duplicates(subset=['study_number'], keep='first').copy()
+                    # 每个study_number一行（汇总表）
+                    study_df = study_summary
                     now = pd.Timestamp.now()
                     next_3m = now + pd.DateOffset(months=3)
                     # 三种状态分组
@@ -541,64 +1674,17 @@ for i, col in enumerate(cols):
                 st.markdown('<div class="stCardTitle">CTN-FSA</div>', unsafe_allow_html=True)
                 st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">Target: 9 Weeks</div>', unsafe_allow_html=True)
                 if df is not None:
-                    # 修改：包含所有有CTN日期的study，而不仅仅是有FSA计划或实际日期的study
-                    study_df = df.drop_duplicates(subset=['study_number'], keep='first').copy()
-                    # 需要的字段
-                    for colname in ['study_ctn_actual_date', 'study_ctn_plan_date', 'study_fsa_actual_date', 'study_fsa_plan_date']:
-                        if colname not in study_df.columns:
-                            study_df[colname] = pd.NaT
-                    # 计算CTN日期（优先actual）
-                    study_df['ctn_date'] = study_df['study_ctn_actual_date']
-                    study_df.loc[study_df['ctn_date'].isna(), 'ctn_date'] = study_df['study_ctn_plan_date']
-                    # 只保留有CTN日期的study（这样能包含所有需要统计的study，包括那些没有FSA日期但已经超过目标日期的）
-                    study_df = study_df[study_df['ctn_date'].notna()].copy()
+                    # 包含所有有CTN日期的study（包括没有FSA日期但已经超过目标日期的）
                     now = pd.Timestamp.now()
-                    n_total = study_df['study_number'].nunique()
-                    meet = []
-                    miss = []
-                    in_progress_miss = []
-                    in_progress_pred_meet = []
-                    in_progress_pred_miss = []
-                    for idx, row in study_df.iterrows():
-                        ctn = pd.to_datetime(row['ctn_date'], errors='coerce')
-                        fsa_actual = pd.to_datetime(row['study_fsa_actual_date'], errors='coerce')
-                        fsa_plan = pd.to_datetime(row['study_fsa_plan_date'], errors='coerce')
-                        if pd.isna(ctn):
-                            # 没有CTN，只能预测
-                            if pd.notna(fsa_plan):
-                                delta = (fsa_plan - now).days
-                                if delta <= 63:
-                                    in_progress_pred_meet.append(row['study_number'])
-                                else:
-                                    in_progress_pred_miss.append(row['study_number'])
-                            else:
-                                continue
-                        elif pd.notna(fsa_actual) and pd.notna(ctn):
-                            delta = (fsa_actual - ctn).days
-                            if delta <= 63:
-                                meet.append(row['study_number'])
-                            else:
-                                miss.append(row['study_number'])
-                        else:
-                            # 没有FSA actual
-                            if pd.notna(ctn) and (now - ctn).days > 63:
-                                in_progress_miss.append(row['study_number'])
-                            else:
-                                if pd.notna(fsa_plan) and pd.notna(ctn):
-                                    delta = (fsa_plan - ctn).days
-                                    if delta <= 63:
-                                        in_progress_pred_meet.append(row['study_number'])
-                                    else:
-                                        in_progress_pred_miss.append(row['study_number'])
-                                else:
-                                    continue
+                    n_total, buckets = classify_ctn_kpi(study_summary, 'study_fsa_actual_date', 'study_fsa_plan_date', 63, now)
+                    meet_set = buckets['meet']
+                    miss_set = buckets['miss']
+                    in_progress_miss_set = buckets['in_progress_miss']
+                    in_progress_pred_meet_set = buckets['pred_meet']
+                    in_progress_pred_miss_set = buckets['pred_miss']
                     # 统计数量
-                    n_meet = len(set(meet))
-                    n_miss = len(set(miss))
-                    n_in_progress_miss = len(set(in_progress_miss))
-                    n_in_progress_pred_meet = len(set(in_progress_pred_meet))
-                    n_in_progress_pred_miss = len(set(in_progress_pred_miss))
-                    n_sum = n_meet + n_miss + n_in_progress_miss + n_in_progress_pred_meet + n_in_progress_pred_miss
+                    n_meet = len(meet_set)
+                    n_in_progress_pred_meet = len(in_progress_pred_meet_set)
                     # 百分比
                     percent_now = n_meet / n_total * 100 if n_total else 0
                     percent_pred = (n_meet + n_in_progress_pred_meet) / n_total * 100 if n_total else 0
@@ -609,19 +1695,12 @@ for i, col in enumerate(cols):
                     )
 
                     # 饼图展示各状态占比
-                    # 统计各状态的study_number列表
-                    meet_set = set(meet)
-                    miss_set = set(miss)
-                    in_progress_miss_set = set(in_progress_miss)
-                    in_progress_pred_meet_set = set(in_progress_pred_meet)
-                    in_progress_pred_miss_set = set(in_progress_pred_miss)
-
                     labels = [
-                        f"Meet ({', '.join(meet_set)})" if meet_set else "Meet",
-                        f"Miss ({', '.join(miss_set)})" if miss_set else "Miss",
-                        f"In progress-miss ({', '.join(in_progress_miss_set)})" if in_progress_miss_set else "In progress-miss",
-                        f"In progress-prediction meet ({', '.join(in_progress_pred_meet_set)})" if in_progress_pred_meet_set else "In progress-prediction meet",
-                        f"In progress-prediction miss ({', '.join(in_progress_pred_miss_set)})" if in_progress_pred_miss_set else "In progress-prediction miss"
+                        f"Meet ({', '.join(meet_set)})" if len(meet_set) else "Meet",
+                        f"Miss ({', '.join(miss_set)})" if len(miss_set) else "Miss",
+                        f"In progress-miss ({', '.join(in_progress_miss_set)})" if len(in_progress_miss_set) else "In progress-miss",
+                        f"In progress-prediction meet ({', '.join(in_progress_pred_meet_set)})" if len(in_progress_pred_meet_set) else "In progress-prediction meet",
+                        f"In progress-prediction miss ({', '.join(in_progress_pred_miss_set)})" if len(in_progress_pred_miss_set) else "In progress-prediction miss"
                     ]
                     values = [
                         len(meet_set),
@@ -677,69 +1756,17 @@ for i, col in enumerate(cols):
                 st.markdown('<div class="stCardTitle">CTN-FPS</div>', unsafe_allow_html=True)
                 st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">Target: 12 Weeks</div>', unsafe_allow_html=True)
                 if df is not None:
-                    # 修改：包含所有有CTN日期的study，而不仅仅是有FPS计划或实际日期的study
-                    study_df = df.drop_duplicates(subset=['study_number'], keep='first').copy()
-                    # 需要的字段
-                    for colname in ['study_ctn_actual_date', 'study_ctn_plan_date', 'study_fps_actual_date', 'study_fps_plan_date']:
-                        if colname not in study_df.columns:
-                            study_df[colname] = pd.NaT
-                    # 计算CTN日期（优先actual）
-                    study_df['ctn_date'] = study_df['study_ctn_actual_date']
-                    study_df.loc[study_df['ctn_date'].isna(), 'ctn_date'] = study_df['study_ctn_plan_date']
-                    # 只保留有CTN日期的study（这样能包含所有需要统计的study，包括那些没有FPS日期但已经超过目标日期的）
-                    study_df = study_df[study_df['ctn_date'].notna()].copy()
+                    # 包含所有有CTN日期的study（包括没有FPS日期但已经超过目标日期的）
                     now = pd.Timestamp.now()
-                    n_total = study_df['study_number'].nunique()
-                    meet = []
-                    miss = []
-                    in_progress_miss = []
-                    in_progress_pred_meet = []
-                    in_progress_pred_miss = []
-                    for idx, row in study_df.iterrows():
-                        ctn = pd.to_datetime(row['ctn_date'], errors='coerce')
-                        fps_actual = pd.to_datetime(row['study_fps_actual_date'], errors='coerce')
-                        fps_plan = pd.to_datetime(row['study_fps_plan_date'], errors='coerce')
-                        if pd.isna(ctn):
-                            # 没有CTN，只能预测
-                            if pd.notna(fps_plan):
-                                delta = (fps_plan - now).days
-                                if delta <= 84:
-                                    in_progress_pred_meet.append(row['study_number'])
-                                else:
-                                    in_progress_pred_miss.append(row['study_number'])
-                            else:
-                                continue
-                        elif pd.notna(fps_actual) and pd.notna(ctn):
-                            delta = (fps_actual - ctn).days
-                            if delta <= 84:
-                                meet.append(row['study_number'])
-                            else:
-                                miss.append(row['study_number'])
-                        else:
-                            # 没有FPS actual
-                            if pd.notna(ctn) and (now - ctn).days > 12*7:
-                                in_progress_miss.append(row['study_number'])
-                            else:
-                                if pd.notna(fps_plan) and pd.notna(ctn):
-                                    delta = (fps_plan - ctn).days
-                                    if delta <= 84:
-                                        in_progress_pred_meet.append(row['study_number'])
-                                    else:
-                                        in_progress_pred_miss.append(row['study_number'])
-                                else:
-                                    continue
+                    n_total, buckets = classify_ctn_kpi(study_summary, 'study_fps_actual_date', 'study_fps_plan_date', 84, now)
+                    meet_set = buckets['meet']
+                    miss_set = buckets['miss']
+                    in_progress_miss_set = buckets['in_progress_miss']
+                    in_progress_pred_meet_set = buckets['pred_meet']
+                    in_progress_pred_miss_set = buckets['pred_miss']
                     # 统计数量
-                    meet_set = set(meet)
-                    miss_set = set(miss)
-                    in_progress_miss_set = set(in_progress_miss)
-                    in_progress_pred_meet_set = set(in_progress_pred_meet)
-                    in_progress_pred_miss_set = set(in_progress_pred_miss)
                     n_meet = len(meet_set)
-                    n_miss = len(miss_set)
-                    n_in_progress_miss = len(in_progress_miss_set)
                     n_in_progress_pred_meet = len(in_progress_pred_meet_set)
-                    n_in_progress_pred_miss = len(in_progress_pred_miss_set)
-                    n_sum = n_meet + n_miss + n_in_progress_miss + n_in_progress_pred_meet + n_in_progress_pred_miss
                     # 百分比
                     percent_now = n_meet / n_total * 100 if n_total else 0
                     percent_pred = (n_meet + n_in_progress_pred_meet) / n_total * 100 if n_total else 0
@@ -750,18 +1777,18 @@ for i, col in enumerate(cols):
                     )
                     # 饼图
                     labels = [
-                        f"Meet ({', '.join(meet_set)})" if meet_set else "Meet",
-                        f"Miss ({', '.join(miss_set)})" if miss_set else "Miss",
-                        f"In progress-miss ({', '.join(in_progress_miss_set)})" if in_progress_miss_set else "In progress-miss",
-                        f"In progress-prediction meet ({', '.join(in_progress_pred_meet_set)})" if in_progress_pred_meet_set else "In progress-prediction meet",
-                        f"In progress-prediction miss ({', '.join(in_progress_pred_miss_set)})" if in_progress_pred_miss_set else "In progress-prediction miss"
+                        f"Meet ({', '.join(meet_set)})" if len(meet_set) else "Meet",
+                        f"Miss ({', '.join(miss_set)})" if len(miss_set) else "Miss",
+                        f"In progress-miss ({', '.join(in_progress_miss_set)})" if len(in_progress_miss_set) else "In progress-miss",
+                        f"In progress-prediction meet ({', '.join(in_progress_pred_meet_set)})" if len(in_progress_pred_meet_set) else "In progress-prediction meet",
+                        f"In progress-prediction miss ({', '.join(in_progress_pred_miss_set)})" if len(in_progress_pred_miss_set) else "In progress-prediction miss"
                     ]
                     values = [
-                        n_meet,
-                        n_miss,
-                        n_in_progress_miss,
-                        n_in_progress_pred_meet,
-                        n_in_progress_pred_miss
+                        len(meet_set),
+                        len(miss_set),
+                        len(in_progress_miss_set),
+                        len(in_progress_pred_meet_set),
+                        len(in_progress_pred_miss_set)
                     ]
                     colors = ['#43a047', '#e53935', '#ffb300', '#1976d2', '#bdbdbd']
                     fig3 = go.Figure(
@@ -819,84 +1846,16 @@ for i, col in enumerate(cols):
                         df[colname] = pd.NA
 
                 now = pd.Timestamp.now()
-                days_limit = 91
-
-                # Study列表
-                study_list = df['study_number'].dropna().unique()
-                meet, miss, in_progress_miss, in_progress_pred_meet, in_progress_pred_miss = [], [], [], [], []
-
-                for study in study_list:
-                    study_df = df[df['study_number'] == study].copy()
-                    # Site Scope筛选
-                    site_scope = study_df[
-                        (study_df['ssus'].notna()) |
-                        ((study_df['ssus'].isna()) & (study_df['site_status'] == 'Initiating')) |
-                        (
-                            (study_df['ssus_assignment_date'].notna()) &
-                            (study_df['study_fsa_actual_date'].notna()) &
-                            (pd.to_datetime(study_df['ssus_assignment_date'], errors='coerce') <= pd.to_datetime(study_df['study_fsa_actual_date'], errors='coerce'))
-                        )
-                    ].copy()
-                    if site_scope.empty:
-                        continue
-
-                    # 25% site数
-                    n_sites = len(site_scope)
-                    n_25 = max(1, int(np.ceil(n_sites * 0.25)))
-
-                    # 计算CTN日期（优先actual）
-                    ctn_actual = pd.to_datetime(study_df['study_ctn_actual_date'].iloc[0], errors='coerce')
-                    ctn_plan = pd.to_datetime(study_df['study_ctn_plan_date'].iloc[0], errors='coerce')
-                    ctn_date = ctn_actual if pd.notna(ctn_actual) else ctn_plan
-
-                    # 25% site的激活日期（优先actual）
-                    site_scope['sa_date'] = pd.to_datetime(site_scope['site_sa_actual_date'], errors='coerce')
-                    site_scope.loc[site_scope['sa_date'].isna(), 'sa_date'] = pd.to_datetime(site_scope['site_sa_plan_date'], errors='coerce')
-
-                    # 25% site的 site_sa_actual_date
-                    top_sites = site_scope.sort_values('sa_date').head(n_25)
-                    top_sites_actual = pd.to_datetime(top_sites['site_sa_actual_date'], errors='coerce')
-                    top_sites_plan = pd.to_datetime(top_sites['site_sa_plan_date'], errors='coerce')
-
-                    # 新增：如果top_sites的actual和plan都全为NA，则跳过该study
-                    if top_sites_actual.isna().all() and top_sites_plan.isna().all():
-                        continue
-
-                    # Meet/Miss 只有当25% site的 site_sa_actual_date都非空
-                    if top_sites_actual.notna().all() and pd.notna(ctn_date):
-                        delta = (top_sites_actual - ctn_date).dt.days.max()
-                        if delta <= days_limit:
-                            meet.append(study)
-                        else:
-                            miss.append(study)
-                    else:
-                        # 其余逻辑保持不变，进入 in progress/prediction 分组
-                        if pd.notna(ctn_date) and (now - ctn_date).days > days_limit:
-                            in_progress_miss.append(study)
-                        else:
-                            # 预测
-                            top_sites['sa_plan'] = pd.to_datetime(top_sites['site_sa_plan_date'], errors='coerce')
-                            ctn_for_pred = ctn_date if pd.notna(ctn_date) else ctn_plan
-                            if pd.notna(ctn_for_pred):
-                                sa_plan_min = top_sites['sa_plan'].min()
-                                if pd.notna(sa_plan_min):
-                                    delta = (sa_plan_min - ctn_for_pred).days
-                                    if delta <= days_limit:
-                                        in_progress_pred_meet.append(study)
-                                    else:
-                                        in_progress_pred_miss.append(study)
-                                else:
-                                    in_progress_pred_miss.append(study)
-                            else:
-                                in_progress_pred_miss.append(study)
-
-                # 统计数量
-                meet_set = set(meet)
-                miss_set = set(miss)
-                in_progress_miss_set = set(in_progress_miss)
-                in_progress_pred_meet_set = set(in_progress_pred_meet)
-                in_progress_pred_miss_set = set(in_progress_pred_miss)
-                n_total = len(study_list)
+                # scope内无site、或前25% site的actual和plan全为空的study跳过；
+                # 前25% site都有actual时按actual判定，否则CTN已超13周为进行中超期，其余按最早plan预测（无CTN/plan记为预测超期）
+                kpi = sa_kpi_frame(study_summary, get_sa_quantiles(dataset_key, df, scope_fallback=False)[0.25])
+                _, buckets = classify_ctn_kpi(kpi, 'sa_actual', 'sa_plan_min', 91, now, scope=kpi['in_scope'] & ~kpi['no_dates'], unplanned_miss=True)
+                meet_set = buckets['meet']
+                miss_set = buckets['miss']
+                in_progress_miss_set = buckets['in_progress_miss']
+                in_progress_pred_meet_set = buckets['pred_meet']
+                in_progress_pred_miss_set = buckets['pred_miss']
+                n_total = len(study_summary)
                 n_meet = len(meet_set)
                 n_miss = len(miss_set)
                 n_in_progress_miss = len(in_progress_miss_set)
@@ -912,11 +1871,11 @@ for i, col in enumerate(cols):
                 )
                 # 饼图
                 labels = [
-                    f"Meet ({', '.join(meet_set)})" if meet_set else "Meet",
-                    f"Miss ({', '.join(miss_set)})" if miss_set else "Miss",
-                    f"In progress-miss ({', '.join(in_progress_miss_set)})" if in_progress_miss_set else "In progress-miss",
-                    f"In progress-prediction meet ({', '.join(in_progress_pred_meet_set)})" if in_progress_pred_meet_set else "In progress-prediction meet",
-                    f"In progress-prediction miss ({', '.join(in_progress_pred_miss_set)})" if in_progress_pred_miss_set else "In progress-prediction miss"
+                    f"Meet ({', '.join(meet_set)})" if len(meet_set) else "Meet",
+                    f"Miss ({', '.join(miss_set)})" if len(miss_set) else "Miss",
+                    f"In progress-miss ({', '.join(in_progress_miss_set)})" if len(in_progress_miss_set) else "In progress-miss",
+                    f"In progress-prediction meet ({', '.join(in_progress_pred_meet_set)})" if len(in_progress_pred_meet_set) else "In progress-prediction meet",
+                    f"In progress-prediction miss ({', '.join(in_progress_pred_miss_set)})" if len(in_progress_pred_miss_set) else "In progress-prediction miss"
                 ]
                 values = [
                     n_meet,
@@ -979,68 +1938,17 @@ for i, col in enumerate(cols):
                     if colname not in df.columns:
                         df[colname] = pd.NA
                 now = pd.Timestamp.now()
-                days_limit = 133
-                # Study列表
-                study_list = df['study_number'].dropna().unique()
-                meet, miss, in_progress_miss, in_progress_pred_meet, in_progress_pred_miss = [], [], [], [], []
-                for study in study_list:
-                    study_df = df[df['study_number'] == study].copy()
-                    # Site Scope筛选
-                    site_scope = study_df[
-                        (study_df['ssus'].notna()) |
-                        ((study_df['ssus'].isna()) & (study_df['site_status'] == 'Initiating')) |
-                        (
-                            (study_df['ssus_assignment_date'].notna()) &
-                            (study_df['study_fsa_actual_date'].notna()) &
-                            (pd.to_datetime(study_df['ssus_assignment_date'], errors='coerce') <= pd.to_datetime(study_df['study_fsa_actual_date'], errors='coerce'))
-                        )
-                    ].copy()
-                    if site_scope.empty:
-                        continue
-                    # 75% site数
-                    n_sites = len(site_scope)
-                    n_75 = max(1, int(np.ceil(n_sites * 0.75)))
-                    # 计算CTN日期（优先actual）
-                    ctn_actual = pd.to_datetime(study_df['study_ctn_actual_date'].iloc[0], errors='coerce')
-                    ctn_plan = pd.to_datetime(study_df['study_ctn_plan_date'].iloc[0], errors='coerce')
-                    ctn_date = ctn_actual if pd.notna(ctn_actual) else ctn_plan
-                    # 75% site的激活日期（优先actual）
-                    site_scope['sa_date'] = pd.to_datetime(site_scope['site_sa_actual_date'], errors='coerce')
-                    site_scope.loc[site_scope['sa_date'].isna(), 'sa_date'] = pd.to_datetime(site_scope['site_sa_plan_date'], errors='coerce')
-                    # 75% site的 site_sa_actual_date
-                    top_sites = site_scope.sort_values('sa_date').head(n_75)
-                    top_sites_actual = pd.to_datetime(top_sites['site_sa_actual_date'], errors='coerce')
-                    top_sites_plan = pd.to_datetime(top_sites['site_sa_plan_date'], errors='coerce')
-
-                    # 修改：按照正确的75% SA逻辑，与Study Details表格保持一致
-                    # 1. 检查是否有足够数量的actual site activation date（第75分位的site有actual日期）
-                    if top_sites_actual.notna().all() and pd.notna(ctn_date):
-                        # 取第75分位那家site的actual的activation日期
-                        sa_date = top_sites_actual.max()
-                        delta = (sa_date - ctn_date).days
-                        if delta <= days_limit:
-                            meet.append(study)
-                        else:
-                            miss.append(study)
-                    # 2. 检查是否有足够数量的plan site activation date（第75分位的site有plan日期）
-                    elif top_sites['sa_date'].notna().all() and pd.notna(ctn_date):
-                        # 取第75分位那家site的activation日期（优先actual，没有actual的用plan）
-                        sa_date = top_sites['sa_date'].max()
-                        delta = (sa_date - ctn_date).days
-                        if delta <= days_limit:
-                            in_progress_pred_meet.append(study)
-                        else:
-                            in_progress_pred_miss.append(study)
-                    # 3. 当数据缺失时，不纳入统计
-                    else:
-                        continue
-                # 统计数量
-                meet_set = set(meet)
-                miss_set = set(miss)
-                in_progress_miss_set = set(in_progress_miss)
-                in_progress_pred_meet_set = set(in_progress_pred_meet)
-                in_progress_pred_miss_set = set(in_progress_pred_miss)
-                n_total = len(study_list)
+                # 与Study Details表格一致：前75% site都有actual时按actual判定，都有日期（actual优先，无则plan）时按该日期预测；
+                # 无CTN或数据缺失的study不纳入统计，也不判进行中超期
+                kpi = sa_kpi_frame(study_summary, get_sa_quantiles(dataset_key, df, scope_fallback=False)[0.75])
+                in_scope = kpi['in_scope'] & kpi['ctn_base'].notna() & (kpi['sa_actual'].notna() | kpi['sa_date'].notna())
+                _, buckets = classify_ctn_kpi(kpi, 'sa_actual', 'sa_date', 133, now, scope=in_scope, track_overdue=False)
+                meet_set = buckets['meet']
+                miss_set = buckets['miss']
+                in_progress_miss_set = buckets['in_progress_miss']
+                in_progress_pred_meet_set = buckets['pred_meet']
+                in_progress_pred_miss_set = buckets['pred_miss']
+                n_total = len(study_summary)
                 n_meet = len(meet_set)
                 n_miss = len(miss_set)
                 n_in_progress_miss = len(in_progress_miss_set)
@@ -1056,11 +1964,11 @@ for i, col in enumerate(cols):
                 )
                 # 饼图
                 labels = [
-                    f"Meet ({', '.join(meet_set)})" if meet_set else "Meet",
-                    f"Miss ({', '.join(miss_set)})" if miss_set else "Miss",
-                    f"In progress-miss ({', '.join(in_progress_miss_set)})" if in_progress_miss_set else "In progress-miss",
-                    f"In progress-prediction meet ({', '.join(in_progress_pred_meet_set)})" if in_progress_pred_meet_set else "In progress-prediction meet",
-                    f"In progress-prediction miss ({', '.join(in_progress_pred_miss_set)})" if in_progress_pred_miss_set else "In progress-prediction miss"
+                    f"Meet ({', '.join(meet_set)})" if len(meet_set) else "Meet",
+                    f"Miss ({', '.join(miss_set)})" if len(miss_set) else "Miss",
+                    f"In progress-miss ({', '.join(in_progress_miss_set)})" if len(in_progress_miss_set) else "In progress-miss",
+                    f"In progress-prediction meet ({', '.join(in_progress_pred_meet_set)})" if len(in_progress_pred_meet_set) else "In progress-prediction meet",
+                    f"In progress-prediction miss ({', '.join(in_progress_pred_miss_set)})" if len(in_progress_pred_miss_set) else "In progress-prediction miss"
                 ]
                 values = [
                     n_meet,
@@ -1126,528 +2034,370 @@ def safe_date_str(date):
     except Exception:
         return ""
 
-# --- Study Details Table ---
-st.markdown("---")
-if df is not None:
-    # 生成表格数据
-    details = []
-    study_list = df['study_number'].dropna().unique()
-    for idx, study in enumerate(study_list, 1):
-        study_df = df[df['study_number'] == study]
-        # TA
-        ta = study_df['clintrack_ta_desc'].iloc[0] if 'clintrack_ta_desc' in study_df.columns else ''
-        # Study
-        study_no = study
-        # Sourcing
-        sourcing = study_df['sourcing_strategy'].iloc[0] if 'sourcing_strategy' in study_df.columns else ''
-        # CTN
-        ctn_actual = study_df['study_ctn_actual_date'].iloc[0] if 'study_ctn_actual_date' in study_df.columns else pd.NaT
-        ctn_plan = study_df['study_ctn_plan_date'].iloc[0] if 'study_ctn_plan_date' in study_df.columns else pd.NaT
-        ctn_html = ''
+# 与CTN相差的周数，threshold给出时超过阈值标红
+def week_diff_str(date, ctn, threshold=None, reverse=False):
+    if pd.isna(date) or pd.isna(ctn):
+        return '', '#222'
+    try:
+        d1 = pd.to_datetime(date)
+        d2 = pd.to_datetime(ctn)
+        weeks = (d1 - d2).days / 7
+        weeks_str = f"{weeks:.1f}w"
+        # 判断是否超期
+        color = '#222'
+        if threshold is not None:
+            if weeks > threshold:
+                color = 'red'
+        return weeks_str, color
+    except Exception:
+        return '', '#222'
+
+# 状态灯
+def status_light(color):
+    return f"<span style='display:inline-block;width:14px;height:14px;border-radius:50%;background:{color};margin-right:2px;vertical-align:middle;'></span>"
+
+# === Leading Site Details：leading site行与study汇总表连接，日期/状态灯按列整体格式化 ===
+# (列名, actual字段, plan字段, 是否按study CTN加红黄绿灯)
+LEADING_SITE_DATE_COLUMNS = [
+    ('Site Package Ready', 'site_package_actual_date', 'site_package_plan_date', False),
+    ('GCP Acceptance', 'site_gcp_actual_date', 'site_gcp_plan_date', False),
+    ('EC Submission', 'ec_sub_actual_date', 'ec_sub_plan_date', False),
+    ('EC Meeting', 'ec_meeting_actual_date', 'ec_meeting_plan_date', False),
+    ('EC Approval', 'ec_approval_actual_date', 'ec_approval_plan_date', True),
+    ('Contract GCP Review', 'draft_contract_gcp_review_actual_date', 'draft_contract_gcp_review_plan_date', False),
+    ('Contract Neg. Compl.', 'main_contract_neg_comp_actual_date', 'main_contract_neg_comp_plan_date', False),
+    ('Contract Signoff', 'contract_signoff_actual_date', 'contract_signoff_plan_date', True),
+    ('Commt. Ltr Sent', 'comm_ltr_sent_actual_date', 'comm_ltr_sent_plan_date', False),
+    ('Commt. Ltr Obtain', 'comm_ltr_obt_actual_date', 'comm_ltr_obt_plan_date', False),
+    ('SA', 'site_sa_actual_date', 'site_sa_plan_date', False),
+]
+# 状态灯按编号取：0无灯 1绿 2黄 3红
+LIGHT_HTML = np.array([status_light(c) for c in ('', COLOR_GREEN, COLOR_YELLOW, COLOR_RED)], dtype=object)
+
+def site_number_str(site_number):
+    # 去掉小数点，转换为整数；非数字原样保留，空值为空串
+    text = site_number.astype(str)
+    num = pd.to_numeric(site_number, errors='coerce')
+    is_int = np.isfinite(num.to_numpy(dtype=float))
+    out = np.where(site_number.notna() & (text.str.strip() != ''), text, '').astype(object)
+    out[is_int] = num[is_int].astype('int64').astype(str).to_numpy()
+    return out
+
+def date_cells(actual, plan, now, ctn=None):
+    # 有actual显示 A:日期（黑色），否则 P:日期（早于今天红色，否则蓝色），都没有为空
+    # 给出ctn时，ctn非空的行以ctn为目标日期加状态灯，日期后附与CTN相差的周数
+    has_actual = ~np.isnat(actual)
+    has_plan = ~np.isnat(plan)
+    date = np.where(has_actual, actual, plan)
+    has_date = has_actual | has_plan
+    date_color = np.where(has_actual, '#222', np.where(plan < now, 'red', '#1976d2')).astype(object)
+    label = np.where(has_actual, 'A:', 'P:').astype(object) + np.datetime_as_string(date, unit='D').astype(object)
+    head = "<span style='color:" + date_color + ";font-weight:bold'>" + label
+    cells = np.where(has_date, head + '</span>', '')
+    if ctn is None:
+        return cells
+    has_ctn = ~np.isnat(ctn)
+    light = np.select(
+        [has_actual & (actual > ctn), has_actual, now > ctn, has_plan & (plan > ctn)],
+        [3, 1, 3, 2], 0)
+    # 周数 = 相差天数（向下取整）/ 7
+    days = np.floor_divide(np.where(has_date & has_ctn, date - ctn, np.timedelta64(0, 'ns')), np.timedelta64(1, 'D'))
+    weeks = np.char.mod('%.1fw', days / 7).astype(object)
+    weeks_color = np.where(light == 3, 'red', '#888').astype(object)
+    lit = LIGHT_HTML[light] + np.where(has_date, head + " (<span style='color:" + weeks_color + "'>" + weeks + '</span>)</span>', '')
+    return np.where(has_ctn, lit, cells)
+
+# === Leading Site / HGRAC Tab：只在选中时计算，按数据集+筛选结果缓存，切回Tab时不重复计算 ===
+TAB_CACHE_MAX_ENTRIES = 16
+TAB_CACHE_TTL = 600
+
+@st.cache_resource(max_entries=TAB_CACHE_MAX_ENTRIES, ttl=TAB_CACHE_TTL)
+def leading_site_tab_html(dataset_key, filter_key, _df, _study_summary, _filtered_studies):
+    # 返回Leading Site表格HTML；没有leading site时返回None
+    df, study_summary, filtered_studies = _df, _study_summary, _filtered_studies
+    # 获取所有leading site数据
+    leading_sites = df[is_leading_site(df)]
+    if leading_sites.empty:
+        return None
+    # 排序：按study CTN日期升序排列
+    # study_number是category时map结果也是category，排序会按study编号而不是日期，先还原为日期列
+    ctn = leading_sites['study_number'].map(study_summary['ctn_base']).astype('datetime64[ns]')
+    order = ctn.reset_index(drop=True).sort_values(ascending=True, na_position='last').index.to_numpy()
+    # 应用筛选器（与Study Details表格联动）
+    if filtered_studies:
+        order = order[leading_sites['study_number'].iloc[order].isin(filtered_studies).to_numpy()]
+    rows = leading_sites.iloc[order]
+
+    # 生成Leading Site Details表格数据：所有行按列整体格式化
+    now = np.datetime64(pd.Timestamp.now(), 'ns')
+    ctn_rows = ctn.iloc[order].to_numpy(dtype='datetime64[ns]')
+    leading_details_df = pd.DataFrame({
+        'No': np.arange(1, len(rows) + 1),
+        'TA': rows['study_number'].map(study_summary['ta']).to_numpy(),
+        'Study': rows['study_number'].to_numpy(),
+        'Site#': site_number_str(rows['study_site_number']) if 'study_site_number' in rows.columns else '',
+        'Site Name': rows['site_name'].to_numpy() if 'site_name' in rows.columns else '',
+    })
+    for name, actual_col, plan_col, with_light in LEADING_SITE_DATE_COLUMNS:
+        leading_details_df[name] = date_cells(
+            date_values(rows, actual_col), date_values(rows, plan_col), now,
+            ctn_rows if with_light else None)
+
+    # 渲染表格（优化列宽）
+    def render_leading_site_table(df):
+        # 定义列宽
+        column_widths = {
+            'No': '60px',
+            'TA': '80px',
+            'Study': '100px',
+            'Site#': '60px',
+            'Site Name': '220px',
+            'Site Package Ready': '180px',
+            'GCP Acceptance': '180px',
+            'EC Submission': '180px',
+            'EC Meeting': '180px',
+            'EC Approval': '180px',
+            'Contract GCP Review': '180px',
+            'Contract Neg. Compl.': '180px',
+            'Contract Signoff': '180px',
+            'Commt. Ltr Sent': '180px',
+            'Commt. Ltr Obtain': '180px',
+            'SA': '180px'
+        }
+
+        # 前5列固定
+        fixed_columns = ['No', 'TA', 'Study', 'Site#', 'Site Name']
+        fixed_bg = '#fff'
+
+        # 构建表头；单元格样式只与列有关，每列算一次
+        columns = list(df.columns)
+        new_headers = []
+        td_open = []
+        left_offset = 0
+        for idx, col in enumerate(columns):
+            th_style = (
+                f'border:1px solid #ccc;border-bottom:2px solid #ccc;padding:4px 8px;'
+                f'background:#e6f4ea;text-align:center;white-space:nowrap;overflow:hidden;'
+                f'text-overflow:ellipsis;width:{column_widths.get(col, "120px")};'
+                f'max-width:{column_widths.get(col, "120px")};vertical-align:middle;'
+            )
+            style = f"border:1px solid #ccc;padding:4px 8px;text-align:center;width:{column_widths.get(col, '120px')};word-break:break-all;white-space:pre-line;max-height:120px;overflow-y:auto;vertical-align:middle;background:{fixed_bg};"
+            if col in fixed_columns:
+                th_style += (
+                    f'position:sticky;top:0;left:{left_offset}px;z-index:20;'
+                    f'background:#e6f4ea;box-shadow:2px 0 0 #ccc;'
+                )
+                style += f'position:sticky;left:{left_offset}px;z-index:5;background:{fixed_bg};box-shadow:2px 0 0 #ccc;'
+                left_offset += int(column_widths[col][:-2])
+            else:
+                th_style += 'position:sticky;top:0;z-index:10;'
+                style += 'z-index:1;'
+            new_headers.append(f'<th style="{th_style}">{col}</th>')
+
+            if col == 'TA':
+                td_open.append(f'<td style="{style}font-weight:bold;white-space:normal;word-break:break-word;">')
+            elif col in ['Study', 'Site Name']:
+                td_open.append(f'<td style="{style}font-weight:bold;white-space:nowrap;">')
+            else:
+                td_open.append(f'<td style="{style}white-space:nowrap;">')
+
+        html = '<div style="overflow-y:auto; max-height:480px; width:100%; border-top:2px solid #ccc; border-bottom:2px solid #ccc;">'
+        html += '<table style="width:100%;border-collapse:separate;border-spacing:0;table-layout:fixed;">'
+        html += '<thead><tr>' + ''.join(new_headers) + '</tr></thead><tbody>'
+
+        n_rows = len(df)
+        if n_rows:
+            # 按列拼接单元格，最后一行加底边框
+            row_html = np.full(n_rows, '<tr style="">', dtype=object)
+            row_html[-1] = '<tr style="border-bottom:2px solid #ccc;">'
+            for col, td in zip(columns, td_open):
+                row_html = row_html + td + df[col].astype(str).to_numpy(dtype=object) + '</td>'
+            html += ''.join(row_html + '</tr>')
+        html += '</tbody></table></div>'
+        return html
+
+    return render_leading_site_table(leading_details_df)
+
+
+def plain_date_cells(values):
+    # 非空日期显示为黑色加粗的 YYYY-MM-DD，空值为空串
+    return np.where(~np.isnat(values), "<span style='color:#222;font-weight:bold'>" + np.datetime_as_string(values, unit='D').astype(object) + '</span>', '')
+
+# 缓存key含HGRAC数据版本：TTL过期重新取数或后台同步作废后版本变化，不会沿用旧表格
+@st.cache_resource(max_entries=TAB_CACHE_MAX_ENTRIES, ttl=TAB_CACHE_TTL)
+def hgrac_tab_html(dataset_key, filter_key, data_version, _hgrac_df, _filtered_studies):
+    # 返回HGRAC表格HTML；没有HGRAC数据时返回None
+    hgrac_df, filtered_studies = _hgrac_df, _filtered_studies
+    if hgrac_df.empty:
+        return None
+    # 排序：按study首行的CTN日期（actual优先，其次plan）升序排列
+    first = hgrac_df.drop_duplicates('study_number').set_index('study_number')
+    ctn_sort = hgrac_df['study_number'].map(first['ctn_actual_date'].fillna(first['ctn_plan_date']))
+    order = ctn_sort.sort_values(ascending=True, na_position='last').index.to_numpy()
+    # 应用筛选器（与Study Details表格联动）
+    if filtered_studies:
+        order = order[hgrac_df['study_number'].iloc[order].isin(filtered_studies).to_numpy()]
+    rows = hgrac_df.iloc[order]
+
+    # 生成HGRAC表格数据：所有行按列整体格式化
+    now = np.datetime64(pd.Timestamp.now(), 'ns')
+    # 批准：优先取public_date，为空时取publish_date
+    approval = np.where(rows['public_date'].notna(), date_values(rows, 'public_date'), date_values(rows, 'publish_date'))
+    hgrac_details_df = pd.DataFrame({
+        'No': np.arange(1, len(rows) + 1),
+        'TA': rows['ta'].to_numpy(),
+        'Study': rows['study_number'].to_numpy(),
+        'CTN': date_cells(date_values(rows, 'ctn_actual_date'), date_values(rows, 'ctn_plan_date'), now),
+        '审批类型': rows['filling_or_approval'].to_numpy(),
+        'Leading EC Approval': plain_date_cells(date_values(rows, 'leading_site_ec_approval_actual_date')),
+        'Leading Contract': plain_date_cells(date_values(rows, 'leading_site_contract_signoff_actual_date')),
+        '申请书定稿': plain_date_cells(date_values(rows, 'application_final_date')),
+        '线上递交': plain_date_cells(date_values(rows, 'first_science_date')),
+        '受理日期': plain_date_cells(date_values(rows, 'official_date')),
+        '批准': plain_date_cells(approval),
+    })
+
+    # 渲染HGRAC表格
+    def render_hgrac_table(df):
+        # 定义列宽
+        column_widths = {
+            'No': '60px',
+            'TA': '80px',
+            'Study': '100px',
+            'CTN': '120px',
+            '审批类型': '100px',
+            'Leading EC Approval': '160px',
+            'Leading Contract': '160px',
+            '申请书定稿': '120px',
+            '线上递交': '120px',
+            '受理日期': '120px',
+            '批准': '120px'
+        }
+
+        html = '<div style="overflow-x:auto;width:100%;">'
+        html += '<table style="width:100%;border-collapse:collapse;table-layout:fixed;">'
+        html += '<tr>' + ''.join([f'<th style="border:1px solid #ccc;padding:4px 8px;background:#f7f7f7;text-align:center;font-weight:bold;white-space:nowrap;width:{column_widths.get(col, "120px")};">{col}</th>' for col in df.columns]) + '</tr>'
+        if len(df):
+            # 按列拼接单元格，单元格样式只与列有关
+            row_html = np.full(len(df), '<tr>', dtype=object)
+            for col in df.columns:
+                bold = 'font-weight:bold;' if col in ['TA', 'Study'] else ''
+                td = f'<td style="border:1px solid #ccc;padding:4px 8px;text-align:center;{bold}white-space:nowrap;width:{column_widths.get(col, "120px")};">'
+                row_html = row_html + td + df[col].astype(str).to_numpy(dtype=object) + '</td>'
+            html += ''.join(row_html + '</tr>')
+        html += '</table></div>'
+        return html
+
+    return render_hgrac_table(hgrac_details_df)
+
+
+@st.fragment
+def filtered_sections(df, study_summary, dataset_key, filter_index, hgrac_prefetch, duration_sketches):
+    # 筛选控件只影响本片段：筛选变化时只重跑表格、下方卡片和Tab，上方卡片A/B与KPI卡片不重跑
+    # 片段单独重跑时不会重新执行模块代码，所用数据都经参数传入，不读模块全局变量
+    # --- Study Details Table ---
+    st.markdown("---")
+    if df is not None:
+        # 生成表格数据；状态灯、CTN分组、筛选与高亮都用同一个now，片段重跑时一起刷新
         now = pd.Timestamp.now()
+        # milestone状态（milestone_matrix）只为当前页的study计算，见分页处
+        sa_quantiles = get_sa_quantiles(dataset_key, df, scope_fallback=False)
         def ctn_block(ctn_date, color, prefix):
             if pd.isna(ctn_date) or str(ctn_date).strip().upper() in ["", "NAN", "NONE", "NULL", "[NULL]"]:
                 return ''
             try:
                 ctn_dt = pd.to_datetime(ctn_date)
                 weeks = (now - ctn_dt).days / 7
-                weeks_str = f"+{weeks:.1f}" if weeks >= 0 else f"{weeks:.1f}"
                 sign = '+' if weeks >= 0 else ''
                 today_str = f"Today=CTN{sign}{weeks:.1f}w"
                 return f"<div style='color:{color}'><span style='font-weight:bold'>{prefix}{ctn_dt.strftime('%Y-%m-%d')}</span><br><span style='font-size:14px;color:#6D4C41;font-weight:bold'>{today_str}</span></div>"
             except Exception:
                 return ''
-        if pd.notna(ctn_actual):
-            ctn_html = ctn_block(ctn_actual, '#222', 'A:')
-        elif pd.notna(ctn_plan):
-            ctn_html = ctn_block(ctn_plan, '#1976d2', 'P:')
-        else:
-            ctn_html = ''
-        # --- 辅助函数 ---
-        def week_diff_str(date, ctn, threshold=None, reverse=False):
-            if pd.isna(date) or pd.isna(ctn):
-                return '', '#222'
-            try:
-                d1 = pd.to_datetime(date)
-                d2 = pd.to_datetime(ctn)
-                weeks = (d1 - d2).days / 7
-                weeks_str = f"{weeks:.1f}w"
-                # 判断是否超期
-                color = '#222'
-                if threshold is not None:
-                    if reverse:
-                        if weeks > threshold:
-                            color = 'red'
-                    else:
-                        if weeks > threshold:
-                            color = 'red'
-                return weeks_str, color
-            except Exception:
-                return '', '#222'
-
-        # 获取CTN基准日期
-        ctn_base = None
-        if pd.notna(ctn_actual):
-            ctn_base = pd.to_datetime(ctn_actual)
-        elif pd.notna(ctn_plan):
-            ctn_base = pd.to_datetime(ctn_plan)
-        # 移除所有调试输出
-        # （删除所有st.write([CTN调试]...)、st.write([调试]...)等相关行）
-
-        # 状态灯函数
-        def status_light(color):
-            return f"<span style='display:inline-block;width:14px;height:14px;border-radius:50%;background:{color};margin-right:2px;vertical-align:middle;'></span>"
-        # 灯颜色定义
-        COLOR_GREEN = '#43a047'
-        COLOR_YELLOW = '#ffb300'
-        COLOR_RED = '#e53935'
-        # 灯逻辑判断函数
-        def get_status_color(actual, plan, target, now):
-            if pd.notna(actual):
-                if target is not None and actual > target:
-                    return COLOR_RED  # actual超期
-                else:
-                    return COLOR_GREEN  # actual未超期
-            else:
-                if target is not None and now > target:
-                    return COLOR_RED  # 没有actual且已超期
-                elif pd.notna(plan) and plan > target:
-                    return COLOR_YELLOW  # plan大于目标日期且actual为空，黄灯
-                else:
-                    return ''  # 其他情况无灯
-        # Leading EC Approval
-        ec_approval = ''
-        if 'leading_site_or_not' in study_df.columns:
-            lead_rows = study_df[study_df['leading_site_or_not'].astype(str).str.upper() == 'YES']
-            ec_actual = lead_rows['ec_approval_actual_date'].iloc[0] if 'ec_approval_actual_date' in lead_rows.columns and not lead_rows.empty else pd.NaT
-            ec_plan = lead_rows['ec_approval_plan_date'].iloc[0] if 'ec_approval_plan_date' in lead_rows.columns and not lead_rows.empty else pd.NaT
-            ec_target = ctn_base  # threshold=0, target=ctn_base
-            color = get_status_color(ec_actual, ec_plan, ec_target, now)
-            if pd.notna(ec_actual):
-                weeks_str, _ = week_diff_str(ec_actual, ctn_base, threshold=0, reverse=False)
-                date_color = '#222'
-                weeks_color = 'red' if color == COLOR_RED else '#888'
-                ec_approval = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(ec_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-            elif pd.notna(ec_plan):
-                weeks_str, _ = week_diff_str(ec_plan, ctn_base, threshold=0, reverse=False)
-                date_color = 'red' if ec_plan < now else '#1976d2'
-                weeks_color = 'red' if color == COLOR_RED else '#888'
-                ec_approval = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(ec_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-            else:
-                ec_approval = status_light(color)
-        # Leading Contract
-        contract = ''
-        if 'leading_site_or_not' in study_df.columns:
-            lead_rows = study_df[study_df['leading_site_or_not'].astype(str).str.upper() == 'YES']
-            contract_actual = lead_rows['contract_signoff_actual_date'].iloc[0] if 'contract_signoff_actual_date' in lead_rows.columns and not lead_rows.empty else pd.NaT
-            contract_plan = lead_rows['contract_signoff_plan_date'].iloc[0] if 'contract_signoff_plan_date' in lead_rows.columns and not lead_rows.empty else pd.NaT
-            contract_target = ctn_base
-            color = get_status_color(contract_actual, contract_plan, contract_target, now)
-            if pd.notna(contract_actual):
-                weeks_str, _ = week_diff_str(contract_actual, ctn_base, threshold=0, reverse=False)
-                date_color = '#222'
-                weeks_color = 'red' if color == COLOR_RED else '#888'
-                contract = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(contract_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-            elif pd.notna(contract_plan):
-                weeks_str, _ = week_diff_str(contract_plan, ctn_base, threshold=0, reverse=False)
-                date_color = 'red' if contract_plan < now else '#1976d2'
-                weeks_color = 'red' if color == COLOR_RED else '#888'
-                contract = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(contract_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-            else:
-                contract = status_light(color)
-        # Country Package
-        cp_actual = study_df['country_package_ready_actual_date'].dropna().sort_values().iloc[0] if 'country_package_ready_actual_date' in study_df.columns and study_df['country_package_ready_actual_date'].notna().any() else pd.NaT
-        cp_plan = study_df['country_package_ready_plan_date'].dropna().sort_values().iloc[0] if 'country_package_ready_plan_date' in study_df.columns and study_df['country_package_ready_plan_date'].notna().any() else pd.NaT
-        cp_target = ctn_base + pd.Timedelta(weeks=-12) if pd.notna(ctn_base) else None
-        color = get_status_color(cp_actual, cp_plan, cp_target, now)
-        if pd.notna(cp_actual):
-            weeks_str, _ = week_diff_str(cp_actual, ctn_base, threshold=-12, reverse=False)
-            date_color = '#222'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            cp_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(cp_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        elif pd.notna(cp_plan):
-            weeks_str, _ = week_diff_str(cp_plan, ctn_base, threshold=-12, reverse=False)
-            date_color = 'red' if cp_plan < now else '#1976d2'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            cp_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(cp_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        else:
-            cp_line1 = status_light(color)
-        # 新增：Country Package target日期
-        if cp_target:
-            cp_line2 = f"<span style='color:#888;font-size:12px;'>Target: {cp_target.strftime('%Y-%m-%d')}</span>"
-        else:
-            cp_line2 = ""
-        country_package = f"{cp_line1}<br>{cp_line2}"
-        # IMP
-        imp_actual = study_df['study_imp_ready_actual_date'].dropna().sort_values().iloc[0] if 'study_imp_ready_actual_date' in study_df.columns and study_df['study_imp_ready_actual_date'].notna().any() else pd.NaT
-        imp_plan = study_df['study_imp_ready_plan_date'].dropna().sort_values().iloc[0] if 'study_imp_ready_plan_date' in study_df.columns and study_df['study_imp_ready_plan_date'].notna().any() else pd.NaT
-        imp_target = ctn_base + pd.Timedelta(weeks=8.5) if pd.notna(ctn_base) else None
-        color = get_status_color(imp_actual, imp_plan, imp_target, now)
-        if pd.notna(imp_actual):
-            weeks_str, _ = week_diff_str(imp_actual, ctn_base, threshold=8.5, reverse=False)
-            date_color = '#222'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            imp_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(imp_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        elif pd.notna(imp_plan):
-            weeks_str, _ = week_diff_str(imp_plan, ctn_base, threshold=8.5, reverse=False)
-            date_color = 'red' if imp_plan < now else '#1976d2'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            imp_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(imp_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        else:
-            imp_line1 = status_light(color)
-        # 新增：IMP target日期
-        if imp_target:
-            imp_line2 = f"<span style='color:#888;font-size:12px;'>Target: {imp_target.strftime('%Y-%m-%d')}</span>"
-        else:
-            imp_line2 = ""
-        imp_display = f"{imp_line1}<br>{imp_line2}"
-        # Facility
-        sfr_actual = study_df['study_sfr_actual_date'].dropna().sort_values().iloc[0] if 'study_sfr_actual_date' in study_df.columns and study_df['study_sfr_actual_date'].notna().any() else pd.NaT
-        sfr_plan = study_df['study_sfr_plan_date'].dropna().sort_values().iloc[0] if 'study_sfr_plan_date' in study_df.columns and study_df['study_sfr_plan_date'].notna().any() else pd.NaT
-        sfr_target = ctn_base + pd.Timedelta(weeks=8.5) if pd.notna(ctn_base) else None
-        color = get_status_color(sfr_actual, sfr_plan, sfr_target, now)
-        if pd.notna(sfr_actual):
-            weeks_str, _ = week_diff_str(sfr_actual, ctn_base, threshold=8.5, reverse=False)
-            date_color = '#222'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            sfr_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(sfr_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        elif pd.notna(sfr_plan):
-            weeks_str, _ = week_diff_str(sfr_plan, ctn_base, threshold=8.5, reverse=False)
-            date_color = 'red' if sfr_plan < now else '#1976d2'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            sfr_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(sfr_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        else:
-            sfr_line1 = status_light(color)
-        # 新增：Facility target日期
-        if sfr_target:
-            sfr_line2 = f"<span style='color:#888;font-size:12px;'>Target: {sfr_target.strftime('%Y-%m-%d')}</span>"
-        else:
-            sfr_line2 = ""
-        sfr_display = f"{sfr_line1}<br>{sfr_line2}"
-        # HGRAC
-        hia_actual = study_df['study_hia_actual_date'].dropna().sort_values().iloc[0] if 'study_hia_actual_date' in study_df.columns and study_df['study_hia_actual_date'].notna().any() else pd.NaT
-        hia_plan = study_df['study_hia_plan_date'].dropna().sort_values().iloc[0] if 'study_hia_plan_date' in study_df.columns and study_df['study_hia_plan_date'].notna().any() else pd.NaT
-        hia_target = ctn_base + pd.Timedelta(weeks=8.5) if pd.notna(ctn_base) else None
-        color = get_status_color(hia_actual, hia_plan, hia_target, now)
-        if pd.notna(hia_actual):
-            weeks_str, _ = week_diff_str(hia_actual, ctn_base, threshold=8.5, reverse=False)
-            date_color = '#222'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            hia_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(hia_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        elif pd.notna(hia_plan):
-            weeks_str, _ = week_diff_str(hia_plan, ctn_base, threshold=8.5, reverse=False)
-            date_color = 'red' if hia_plan < now else '#1976d2'
+        def target_line(target, suffix=''):
+            return f"<span style='color:#888;font-size:12px;'>Target: {target.strftime('%Y-%m-%d')}{suffix}</span>" if pd.notna(target) else ''
+        def milestone_line(study, name, ctn_base, show_actual=True, show_plan=True):
+            # 第一行：状态灯 + plan/actual日期及与CTN的周数差
+            color = STATUS_COLORS[milestone_matrix['status'].at[study, name]]
             weeks_color = 'red' if color == COLOR_RED else '#888'
-            hia_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(hia_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        else:
-            hia_line1 = status_light(color)
-        # 新增：HGRAC target日期
-        if hia_target:
-            hia_line2 = f"<span style='color:#888;font-size:12px;'>Target: {hia_target.strftime('%Y-%m-%d')}</span>"
-        else:
-            hia_line2 = ""
-        hia_display = f"{hia_line1}<br>{hia_line2}"
-        # FSA
-        fsa_actual = study_df['study_fsa_actual_date'].dropna().sort_values().iloc[0] if 'study_fsa_actual_date' in study_df.columns and study_df['study_fsa_actual_date'].notna().any() else pd.NaT
-        fsa_plan = study_df['study_fsa_plan_date'].dropna().sort_values().iloc[0] if 'study_fsa_plan_date' in study_df.columns and study_df['study_fsa_plan_date'].notna().any() else pd.NaT
-        fsa_target = ctn_base + pd.Timedelta(weeks=9) if pd.notna(ctn_base) else None
-        color = get_status_color(fsa_actual, fsa_plan, fsa_target, now)
-        # 第一行：plan/actual日期及与CTN的周数差
-        if pd.notna(fsa_actual):
-            weeks_str, _ = week_diff_str(fsa_actual, ctn_base, threshold=9, reverse=False)
-            date_color = '#222'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            fsa_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(fsa_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        elif pd.notna(fsa_plan):
-            weeks_str, _ = week_diff_str(fsa_plan, ctn_base, threshold=9, reverse=False)
-            date_color = 'red' if fsa_plan < now else '#1976d2'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            fsa_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(fsa_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        else:
-            fsa_line1 = status_light(color)
-        # 第二行：target日期（CTN+9w）
-        if fsa_target:
-            fsa_line2 = f"<span style='color:#888;font-size:12px;'>Target: {fsa_target.strftime('%Y-%m-%d')}</span>"
-        else:
-            fsa_line2 = ""
-        fsa_display = f"{fsa_line1}<br>{fsa_line2}"
-
-        # FPS
-        fps_actual = study_df['study_fps_actual_date'].dropna().sort_values().iloc[0] if 'study_fps_actual_date' in study_df.columns and study_df['study_fps_actual_date'].notna().any() else pd.NaT
-        fps_plan = study_df['study_fps_plan_date'].dropna().sort_values().iloc[0] if 'study_fps_plan_date' in study_df.columns and study_df['study_fps_plan_date'].notna().any() else pd.NaT
-        fps_target = ctn_base + pd.Timedelta(weeks=12) if pd.notna(ctn_base) else None
-        color = get_status_color(fps_actual, fps_plan, fps_target, now)
-        # 第一行：plan/actual日期及与CTN的周数差
-        if pd.notna(fps_actual):
-            weeks_str, _ = week_diff_str(fps_actual, ctn_base, threshold=21, reverse=False)
-            date_color = '#222'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            fps_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(fps_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        elif pd.notna(fps_plan):
-            weeks_str, _ = week_diff_str(fps_plan, ctn_base, threshold=21, reverse=False)
-            date_color = 'red' if fps_plan < now else '#1976d2'
-            weeks_color = 'red' if color == COLOR_RED else '#888'
-            fps_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(fps_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        else:
-            fps_line1 = status_light(color)
-        if fps_target:
-            fps_line2 = f"<span style='color:#888;font-size:12px;'>Target: {fps_target.strftime('%Y-%m-%d')}</span>"
-        else:
-            fps_line2 = ""
-        fps_display = f"{fps_line1}<br>{fps_line2}"
-
-        # 25% SA
-        sa_25_display = ''
-        sa_75_display = ''
-        if 'site_no' in study_df.columns:
-            # site_scope筛选逻辑与饼图一致
-            site_scope = study_df[
-                (study_df['ssus'].notna()) |
-                ((study_df['ssus'].isna()) & (study_df['site_status'] == 'Initiating')) |
-                (
-                    (study_df['ssus_assignment_date'].notna()) &
-                    (study_df['study_fsa_actual_date'].notna()) &
-                    (pd.to_datetime(study_df['ssus_assignment_date'], errors='coerce') <= pd.to_datetime(study_df['study_fsa_actual_date'], errors='coerce'))
-                )
-            ].copy()
-            n_sites = len(site_scope)
-            # 25% SA
-            n_25 = max(1, int(np.ceil(n_sites * 0.25)))
-            site_scope['sa_date'] = pd.to_datetime(site_scope['site_sa_actual_date'], errors='coerce')
-            site_scope.loc[site_scope['sa_date'].isna(), 'sa_date'] = pd.to_datetime(site_scope['site_sa_plan_date'], errors='coerce')
-            top_sites_25 = site_scope.sort_values('sa_date').head(n_25)
-            top_sites_25_actual = pd.to_datetime(top_sites_25['site_sa_actual_date'], errors='coerce')
-            sa_25_target = ctn_base + pd.Timedelta(weeks=13) if pd.notna(ctn_base) else None
-            if top_sites_25_actual.notna().all() and pd.notna(ctn_base):
-                sa_date = top_sites_25_actual.max()
-                color = get_status_color(sa_date, pd.NaT, sa_25_target, now)
-                weeks_str, _ = week_diff_str(sa_date, ctn_base, threshold=13, reverse=False)
-                date_color = '#222'
-                weeks_color = 'red' if color == COLOR_RED else '#888'
-                sa_25_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(sa_date)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-            elif top_sites_25['sa_date'].notna().all() and pd.notna(ctn_base):
-                sa_date = top_sites_25['sa_date'].max()
-                color = get_status_color(pd.NaT, sa_date, sa_25_target, now)
-                weeks_str, _ = week_diff_str(sa_date, ctn_base, threshold=13, reverse=False)
-                date_color = 'red' if sa_date < now else '#1976d2'
-                weeks_color = 'red' if color == COLOR_RED else '#888'
-                sa_25_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(sa_date)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-            else:
-                color = COLOR_RED if sa_25_target and now > sa_25_target else ''
-                sa_25_line1 = (status_light(color) if color else '') + '<span style="color:#888">No Valid Data</span>'
-            # target
-            if sa_25_target:
-                sa_25_line2 = f"<span style='color:#888;font-size:12px;'>Target: {sa_25_target.strftime('%Y-%m-%d')}, {n_25} sites</span>"
-            else:
-                sa_25_line2 = ''
-            sa_25_display = f"{sa_25_line1}<br>{sa_25_line2}"
-            # 75% SA
-            n_75 = max(1, int(np.ceil(n_sites * 0.75)))
-            top_sites_75 = site_scope.sort_values('sa_date').head(n_75)
-            top_sites_75_actual = pd.to_datetime(top_sites_75['site_sa_actual_date'], errors='coerce')
-            sa_75_target = ctn_base + pd.Timedelta(weeks=19) if pd.notna(ctn_base) else None
-            
-            # 修改：按照正确的75% SA逻辑
-            # 1. 检查是否有足够数量的actual site activation date（第75分位的site有actual日期）
-            if top_sites_75_actual.notna().all() and pd.notna(ctn_base):
-                # 取第75分位那家site的actual的activation日期
-                sa_date = top_sites_75_actual.max()
-                color = get_status_color(sa_date, pd.NaT, sa_75_target, now)
-                weeks_str, _ = week_diff_str(sa_date, ctn_base, threshold=19, reverse=False)
-                date_color = '#222'
-                weeks_color = 'red' if color == COLOR_RED else '#888'
-                sa_75_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(sa_date)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-            # 2. 检查是否有足够数量的plan site activation date（第75分位的site有plan日期）
-            elif top_sites_75['sa_date'].notna().all() and pd.notna(ctn_base):
-                # 取第75分位那家site的activation日期（优先actual，没有actual的用plan）
-                sa_date = top_sites_75['sa_date'].max()
-                color = get_status_color(pd.NaT, sa_date, sa_75_target, now)
-                weeks_str, _ = week_diff_str(sa_date, ctn_base, threshold=19, reverse=False)
-                date_color = 'red' if sa_date < now else '#1976d2'
-                weeks_color = 'red' if color == COLOR_RED else '#888'
-                sa_75_line1 = status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(sa_date)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-            # 3. 当数据缺失时，展示no valid data
-            else:
-                color = COLOR_RED if sa_75_target and now > sa_75_target else ''
-                sa_75_line1 = (status_light(color) if color else '') + '<span style="color:#888">No Valid Data</span>'
-            # target
-            if sa_75_target:
-                sa_75_line2 = f"<span style='color:#888;font-size:12px;'>Target: {sa_75_target.strftime('%Y-%m-%d')}, {n_75} sites</span>"
+            actual = milestone_matrix['actual'].at[study, name]
+            plan = milestone_matrix['plan'].at[study, name]
+            if show_actual and pd.notna(actual):
+                return status_light(color) + f"<span style='color:#222;font-weight:bold'>A:{safe_date_str(actual)} (<span style='color:{weeks_color}'>{week_diff_str(actual, ctn_base)[0]}</span>)</span>"
+            if show_plan and pd.notna(plan):
+                date_color = 'red' if plan < now else '#1976d2'
+                return status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(plan)} (<span style='color:{weeks_color}'>{week_diff_str(plan, ctn_base)[0]}</span>)</span>"
+            return status_light(color)
+        def milestone_cell(study, name, ctn_base):
+            return f"{milestone_line(study, name, ctn_base)}<br>{target_line(milestone_matrix['target'].at[study, name])}"
+        def sa_cell(study, name, frac, ctn_base):
+            # 前n_frac家site都有actual时显示A，都有日期时显示P；无scope内site或数据缺失时No Valid Data
+            sa = sa_quantiles[frac].loc[study]
+            target = milestone_matrix['target'].at[study, name]
+            if pd.notna(ctn_base) and sa['n_sites'] > 0 and (sa['actual_complete'] or sa['date_complete']):
+                line1 = milestone_line(study, name, ctn_base, show_actual=sa['actual_complete'], show_plan=not sa['actual_complete'])
             else:
-                sa_75_line2 = ''
-            sa_75_display = f"{sa_75_line1}<br>{sa_75_line2}"
-        else:
-            color = COLOR_RED if sa_25_target and now > sa_25_target else ''
-            color_75 = COLOR_RED if sa_75_target and now > sa_75_target else ''
-            sa_25_display = (status_light(color) if color else '') + '<span style="color:#888">No Valid Data</span>'
-            sa_75_display = (status_light(color_75) if color_75 else '') + '<span style="color:#888">No Valid Data</span>'
-
-        # Country Contract
-        contract_actual = study_df['main_contract_tmpl_actual_date'].dropna().sort_values().iloc[0] if 'main_contract_tmpl_actual_date' in study_df.columns and study_df['main_contract_tmpl_actual_date'].notna().any() else pd.NaT
-        contract_plan = study_df['main_contract_tmpl_plan_date'].dropna().sort_values().iloc[0] if 'main_contract_tmpl_plan_date' in study_df.columns and study_df['main_contract_tmpl_plan_date'].notna().any() else pd.NaT
-        contract_target = ctn_base + pd.Timedelta(weeks=-12) if pd.notna(ctn_base) else None
-        def get_contract_status_light(actual, plan, target, now):
-            if pd.notna(actual):
-                if target is not None and actual > target:
-                    return COLOR_RED
-                else:
-                    return COLOR_GREEN
-            else:
-                if target is not None and now > target:
-                    return COLOR_RED
-                elif pd.notna(plan) and plan > target:
-                    return COLOR_YELLOW
-                else:
-                    return ''
-        contract_color = get_contract_status_light(contract_actual, contract_plan, contract_target, now)
-        if pd.notna(contract_actual):
-            weeks_str, weeks_color = week_diff_str(contract_actual, ctn_base, threshold=-12, reverse=False)
-            date_color = '#222'
-            weeks_color = 'red' if contract_color == COLOR_RED else '#888'
-            contract_line1 = status_light(contract_color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(contract_actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        elif pd.notna(contract_plan):
-            weeks_str, weeks_color = week_diff_str(contract_plan, ctn_base, threshold=-12, reverse=False)
-            date_color = 'red' if contract_plan < now else '#1976d2'
-            weeks_color = 'red' if contract_color == COLOR_RED else '#888'
-            contract_line1 = status_light(contract_color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(contract_plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        else:
-            contract_line1 = status_light(contract_color)
-        if contract_target:
-            contract_line2 = f"<span style='color:#888;font-size:12px;'>Target: {contract_target.strftime('%Y-%m-%d')}</span>"
-        else:
-            contract_line2 = ''
-        country_contract = f"{contract_line1}<br>{contract_line2}"
-
-        details.append({
-            'No': idx,
-            'TA': ta,
-            'Study': study_no,
-            'Sourcing': sourcing,
-            'CTN': ctn_html,
-            'Leading EC Approval': ec_approval,
-            'Leading Contract': contract,
-            'Country Package': country_package,
-            'Country Contract': country_contract,
-            'IMP': imp_display,
-            'Facility': sfr_display,
-            'HGRAC': hia_display,
-            'FSA': fsa_display,
-            'FPS': fps_display,
-            '25% SA': sa_25_display,
-            '75% SA': sa_75_display
-        })
-    # === Country Contract 列填充 ===
-    def get_country_contract_display(study):
-        study_row = df[df['study_number'] == study]
-        if study_row is None or study_row.empty:
-            return ''
-        actual = study_row['main_contract_tmpl_actual_date'].dropna().sort_values().iloc[0] if 'main_contract_tmpl_actual_date' in study_row.columns and study_row['main_contract_tmpl_actual_date'].notna().any() else pd.NaT
-        plan = study_row['main_contract_tmpl_plan_date'].dropna().sort_values().iloc[0] if 'main_contract_tmpl_plan_date' in study_row.columns and study_row['main_contract_tmpl_plan_date'].notna().any() else pd.NaT
-        # 获取CTN基准
-        ctn_actual = study_row['study_ctn_actual_date'].iloc[0] if 'study_ctn_actual_date' in study_row.columns and not study_row.empty else pd.NaT
-        ctn_plan = study_row['study_ctn_plan_date'].iloc[0] if 'study_ctn_plan_date' in study_row.columns and not study_row.empty else pd.NaT
-        ctn_base = pd.to_datetime(ctn_actual) if pd.notna(ctn_actual) else (pd.to_datetime(ctn_plan) if pd.notna(ctn_plan) else None)
-        now = pd.Timestamp.now()
-        target = ctn_base + pd.Timedelta(weeks=-12) if ctn_base is not None else None
-        COLOR_GREEN = '#43a047'
-        COLOR_YELLOW = '#ffb300'
-        COLOR_RED = '#e53935'
-        def status_light(color):
-            return f"<span style='display:inline-block;width:14px;height:14px;border-radius:50%;background:{color};margin-right:2px;vertical-align:middle;'></span>"
-        def week_diff_str(date, ctn, threshold=None):
-            if pd.isna(date) or pd.isna(ctn):
-                return '', '#222'
-            try:
-                d1 = pd.to_datetime(date)
-                d2 = pd.to_datetime(ctn)
-                weeks = (d1 - d2).days / 7
-                weeks_str = f"{weeks:.1f}w"
-                color = '#222'
-                if threshold is not None:
-                    if weeks > threshold:
-                        color = 'red'
-                return weeks_str, color
-            except Exception:
-                return '', '#222'
-        # actual优先
-        html = ''
-        if pd.notna(actual) and ctn_base is not None:
-            weeks_str, weeks_color = week_diff_str(actual, ctn_base, threshold=-12)
-            if actual > target:
-                color = COLOR_RED
-            else:
-                color = COLOR_GREEN
-            html = status_light(color) + f"<span style='color:#222;font-weight:bold'>A:{safe_date_str(actual)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        elif pd.notna(plan) and ctn_base is not None:
-            weeks_str, weeks_color = week_diff_str(plan, ctn_base, threshold=-12)
-            if plan > target:
-                color = COLOR_YELLOW
-            else:
-                color = ''
-            # 日期颜色
-            if plan < now:
-                date_color = 'red'
-            else:
-                date_color = '#1976d2'
-            html = (status_light(color) if color else '') + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(plan)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-        else:
-            html = ''
-        return html
-    details_df = pd.DataFrame(details)
-    if not details_df.empty and 'Country Contract' in details_df.columns:
-        details_df['Country Contract'] = details_df['Study'].apply(get_country_contract_display)
-    # 转为DataFrame
-    details_df = pd.DataFrame(details)
-
-    # 增加排序列：优先用actual，无则用plan
-    def get_ctn_sort_val(row):
-        study = row['Study']
-        study_row = df[df['study_number'] == study]
-        if study_row is not None and not study_row.empty:
-            study_row = study_row.drop_duplicates(subset=['study_number'], keep='first')
-            ctn_actual = study_row['study_ctn_actual_date'].iloc[0] if study_row is not None and not study_row.empty and 'study_ctn_actual_date' in study_row.columns else pd.NaT
-            ctn_plan = study_row['study_ctn_plan_date'].iloc[0] if study_row is not None and not study_row.empty and 'study_ctn_plan_date' in study_row.columns else pd.NaT
+                color = STATUS_COLORS[milestone_matrix['status'].at[study, name]]
+                line1 = (status_light(color) if color else '') + '<span style="color:#888">No Valid Data</span>'
+            return f"{line1}<br>{target_line(target, ', %d sites' % sa['n_frac'])}"
+        def details_row(idx, study):
+            # 单个study的整行HTML，只为当前页的study生成
+            # CTN
+            ctn_actual = study_summary.at[study, 'study_ctn_actual_date']
+            ctn_plan = study_summary.at[study, 'study_ctn_plan_date']
             if pd.notna(ctn_actual):
-                return pd.to_datetime(ctn_actual, errors='coerce')
+                ctn_html = ctn_block(ctn_actual, '#222', 'A:')
             elif pd.notna(ctn_plan):
-                return pd.to_datetime(ctn_plan, errors='coerce')
-        return pd.NaT
-    details_df['ctn_sort'] = details_df.apply(get_ctn_sort_val, axis=1)
-    # 排序后重置序号
-    details_df = details_df.sort_values('ctn_sort', ascending=True, na_position='last').reset_index(drop=True)
-    details_df['No'] = range(1, len(details_df) + 1)
-    details_df = details_df.drop(columns=['ctn_sort'])
+                ctn_html = ctn_block(ctn_plan, '#1976d2', 'P:')
+            else:
+                ctn_html = ''
+            # 获取CTN基准日期
+            ctn_base = study_summary.at[study, 'ctn_base']
+            row = {
+                'No': idx,
+                'TA': study_summary.at[study, 'ta'],
+                'Study': study,
+                'Sourcing': study_summary.at[study, 'sourcing'],
+                'CTN': ctn_html,
+            }
+            # Leading EC Approval / Leading Contract：只显示第一行
+            for name in ['Leading EC Approval', 'Leading Contract']:
+                row[name] = milestone_line(study, name, ctn_base) if 'leading_site_or_not' in df.columns else ''
+            for name in ['Country Package', 'Country Contract', 'IMP', 'Facility', 'HGRAC', 'FSA', 'FPS']:
+                row[name] = milestone_cell(study, name, ctn_base)
+            # 25% SA / 75% SA：site_scope筛选逻辑与饼图一致
+            for name, frac in [('25% SA', 0.25), ('75% SA', 0.75)]:
+                if 'site_no' in df.columns:
+                    row[name] = sa_cell(study, name, frac, ctn_base)
+                else:
+                    color = STATUS_COLORS[milestone_matrix['status'].at[study, name]]
+                    row[name] = (status_light(color) if color else '') + '<span style="color:#888">No Valid Data</span>'
+            return row
+        # 表格索引按数据集缓存，片段重跑时不再逐study重建
+        details_index = get_details_index(dataset_key, df, study_summary)
+        details_df = details_index['df']
 
-    # ==== 构建CTN分组映射（提前） ====
-    ctn_group_map = {}
-    for idx, row in details_df.iterrows():
-        study = row['Study']
-        study_row = df[df['study_number'] == study].drop_duplicates(subset=['study_number'], keep='first')
-        ctn_actual = study_row['study_ctn_actual_date'].iloc[0] if 'study_ctn_actual_date' in study_row.columns else pd.NaT
-        ctn_plan = study_row['study_ctn_plan_date'].iloc[0] if 'study_ctn_plan_date' in study_row.columns else pd.NaT
-        now = pd.Timestamp.now()
+        # ==== 构建CTN分组映射（提前） ====
         next_3m = now + pd.DateOffset(months=3)
-        if pd.notna(ctn_actual):
-            ctn_group_map[study] = 'CTN obtained'
-        elif pd.notna(ctn_plan):
-            if ctn_plan <= next_3m:
-                ctn_group_map[study] = 'Planned in next 3M'
-            else:
-                ctn_group_map[study] = 'After 3M'
-        else:
-            ctn_group_map[study] = 'After 3M'
-
-    # ==== 全局筛选逻辑（提前到所有卡片之前） ====
-    # 先定义全部选项
-    all_study_options = details_df['Study'].dropna().unique().tolist()
-    all_ta_options = details_df['TA'].dropna().unique().tolist()
-    all_sourcing_options = details_df['Sourcing'].dropna().unique().tolist()
-    ctn_options = ['CTN obtained', 'Planned in next 3M', 'After 3M']
-    
-    # ==== 横向紧凑布局：标题和筛选框同一行 ====
-    col_title, col_study, col_ctn, col_ta, col_sourcing, col_milestone = st.columns([2, 1, 1, 1, 1, 1])
-    with col_title:
-        st.markdown('''
+        ctn_group = pd.Series(
+            np.select(
+                [study_summary['study_ctn_actual_date'].notna(), study_summary['study_ctn_plan_date'] <= next_3m],
+                ['CTN obtained', 'Planned in next 3M'],
+                default='After 3M'
+            ),
+            index=study_summary.index
+        )
+
+        # ==== 全局筛选逻辑（提前到所有卡片之前） ====
+        # 先定义全部选项
+        all_study_options = details_index['options']['Study']
+        all_ta_options = details_index['options']['TA']
+        all_sourcing_options = details_index['options']['Sourcing']
+        ctn_options = ['CTN obtained', 'Planned in next 3M', 'After 3M']
+        
+        # ==== 横向紧凑布局：标题和筛选框同一行 ====
+        col_title, col_study, col_ctn, col_ta, col_sourcing, col_milestone = st.columns([2, 1, 1, 1, 1, 1])
+        with col_title:
+            st.markdown('''
 <style>
 .study-details-btn {
     display: inline-block;
@@ -1774,407 +2524,230 @@ if df is not None:
   </span>
 </div>
 ''', unsafe_allow_html=True)
-    with col_study:
-        study_selected = st.multiselect(
-            '', options=all_study_options, default=[], key='study_multiselect_final',
-            placeholder='Study', label_visibility='collapsed')
-    with col_ctn:
-        ctn_selected = st.multiselect(
-            '', options=ctn_options, default=[], key='ctn_multiselect_final',
-            placeholder='CTN', label_visibility='collapsed')
-    with col_ta:
-        ta_selected = st.multiselect(
-            '', options=all_ta_options, default=[], key='ta_multiselect_final',
-            placeholder='TA', label_visibility='collapsed')
-    with col_sourcing:
-        sourcing_selected = st.multiselect(
-            '', options=all_sourcing_options, default=[], key='sourcing_multiselect_final',
-            placeholder='Sourcing', label_visibility='collapsed')
-    with col_milestone:
-        milestone_next5w = st.checkbox('Milestone in Next 5 weeks', key='milestone_next5w')
-
-    # ==== 根据筛选过滤原始df（全局联动） ====
-    import pandas as pd
-    # 构建筛选mask
-    mask = pd.Series([True] * len(details_df), index=details_df.index)
-    if study_selected:
-        mask &= details_df['Study'].isin(study_selected)
-    if ta_selected:
-        mask &= details_df['TA'].isin(ta_selected)
-    if ctn_selected:
-        mask &= details_df['Study'].map(ctn_group_map).isin(ctn_selected)
-    if sourcing_selected:
-        mask &= details_df['Sourcing'].isin(sourcing_selected)
-    # 新增：Milestone in Next 5 weeks筛选
-    if milestone_next5w:
-        # 未来5周内有target milestone且该milestone的actual日期为空的study
-        now = pd.Timestamp.now()
-        five_weeks_later = now + pd.Timedelta(weeks=5)
-        milestone_plan_actual = [
-            # (plan_col, actual_col, week_offset)
-            ('study_fsa_plan_date', 'study_fsa_actual_date', 9),
-            ('study_fps_plan_date', 'study_fps_actual_date', 12),
-            ('site_sa_plan_date', 'site_sa_actual_date', 13),
-            ('site_sa_plan_date', 'site_sa_actual_date', 19),
-            ('study_imp_ready_plan_date', 'study_imp_ready_actual_date', 8.5),
-            ('study_sfr_plan_date', 'study_sfr_actual_date', 8.5),
-            ('study_hia_plan_date', 'study_hia_actual_date', 8.5),
-            ('ec_approval_plan_date', 'ec_approval_actual_date', 0),
-            ('contract_signoff_plan_date', 'contract_signoff_actual_date', 0),
-            ('country_package_ready_plan_date', 'country_package_ready_actual_date', -12),
-            ('main_contract_tmpl_plan_date', 'main_contract_tmpl_actual_date', -12)
-        ]
-        studies_with_milestone = set()
-        for idx, row in df.iterrows():
-            ctn_actual = row['study_ctn_actual_date'] if 'study_ctn_actual_date' in row else pd.NaT
-            ctn_plan = row['study_ctn_plan_date'] if 'study_ctn_plan_date' in row else pd.NaT
-            ctn_base = pd.to_datetime(ctn_actual) if pd.notna(ctn_actual) else (pd.to_datetime(ctn_plan) if pd.notna(ctn_plan) else None)
-            if ctn_base is None:
-                continue
-            for plan_col, actual_col, week_offset in milestone_plan_actual:
-                plan_date = row[plan_col] if plan_col in row else pd.NaT
-                actual_date = row[actual_col] if actual_col in row else pd.NaT
-                if pd.notna(plan_date):
-                    plan_date = pd.to_datetime(plan_date, errors='coerce')
-                    target = ctn_base + pd.Timedelta(weeks=week_offset)
-                    if now < target <= five_weeks_later and pd.isna(actual_date):
-                        studies_with_milestone.add(row['study_number'])
-                        break
-        mask &= details_df['Study'].isin(studies_with_milestone)
-    
-    # 获取筛选后的study列表
-    filtered_studies = details_df[mask]['Study'].tolist()
-    
-    # 全局过滤原始df（所有卡片都使用这个过滤后的df）
-    if filtered_studies:
-        df_filtered = df[df['study_number'].isin(filtered_studies)].copy()
-    else:
-        df_filtered = df.copy()  # 没选时显示全部
-    
-    # 更新details_df用于表格显示
-    filtered_details_df = details_df[mask].copy()
-    
-    # ==== 表格居中渲染 ====
-    def render_html_table(df, raw_df=None):
-        # ==== 25% SA和75% SA高亮study集合 ====
-        highlight_25sa_studies = set()
-        highlight_75sa_studies = set()
-        now = pd.Timestamp.now()
-        five_weeks_later = now + pd.Timedelta(weeks=5)
-        if raw_df is not None and 'study_number' in raw_df.columns:
-            for study in raw_df['study_number'].dropna().unique():
-                study_df = raw_df[raw_df['study_number'] == study]
-                # 计算CTN基准
-                ctn_actual = study_df['study_ctn_actual_date'].iloc[0] if 'study_ctn_actual_date' in study_df.columns else pd.NaT
-                ctn_plan = study_df['study_ctn_plan_date'].iloc[0] if 'study_ctn_plan_date' in study_df.columns else pd.NaT
-                ctn_base = pd.to_datetime(ctn_actual) if pd.notna(ctn_actual) else (pd.to_datetime(ctn_plan) if pd.notna(ctn_plan) else None)
-                if ctn_base is None:
-                    continue
-                # site_scope筛选
-                if all(col in study_df.columns for col in ['ssus', 'site_status', 'ssus_assignment_date', 'study_fsa_actual_date']):
-                    site_scope = study_df[
-                        (study_df['ssus'].notna()) |
-                        ((study_df['ssus'].isna()) & (study_df['site_status'] == 'Initiating')) |
-                        (
-                            (study_df['ssus_assignment_date'].notna()) &
-                            (study_df['study_fsa_actual_date'].notna()) &
-                            (pd.to_datetime(study_df['ssus_assignment_date'], errors='coerce') <= pd.to_datetime(study_df['study_fsa_actual_date'], errors='coerce'))
-                        )
-                    ].copy()
-                else:
-                    site_scope = study_df.copy()
-                n_sites = len(site_scope)
-                if n_sites == 0:
-                    continue
-                # 25% SA
-                n_25 = max(1, int(np.ceil(n_sites * 0.25)))
-                site_scope['sa_plan'] = pd.to_datetime(site_scope['site_sa_plan_date'], errors='coerce')
-                site_scope['sa_actual'] = pd.to_datetime(site_scope['site_sa_actual_date'], errors='coerce')
-                top_sites_25 = site_scope.sort_values('sa_plan').head(n_25)
-                sa_25_target = ctn_base + pd.Timedelta(weeks=13)
-                if now < sa_25_target <= five_weeks_later and top_sites_25['sa_actual'].isna().any():
-                    highlight_25sa_studies.add(study)
-                # 75% SA
-                n_75 = max(1, int(np.ceil(n_sites * 0.75)))
-                top_sites_75 = site_scope.sort_values('sa_plan').head(n_75)
-                sa_75_target = ctn_base + pd.Timedelta(weeks=19)
-                if now < sa_75_target <= five_weeks_later and top_sites_75['sa_actual'].isna().any():
-                    highlight_75sa_studies.add(study)
-        columns = list(df.columns)
-        column_widths = {
-            'No': '50px',
-            'TA': '110px',
-            'Study': '90px',
-            'Sourcing': '110px',
-            'CTN': '180px',
-            'Leading EC Approval': '200px',
-            'Leading Contract': '200px',
-            'Country Package': '200px',
-            'Country Contract': '200px',
-            'IMP': '200px',
-            'Facility': '200px',
-            'HGRAC': '200px',
-            'FSA': '200px',
-            'FPS': '200px',
-            '25% SA': '200px',
-            '75% SA': '200px'
-        }
-        fixed_columns = ['No', 'TA', 'Study', 'Sourcing', 'CTN']
-        fixed_bg = '#fff'
-        # 构建表头
-        new_headers = []
-        left_offset = 0
-        for idx, col in enumerate(columns):
-            th_style = (
-                f'border:1px solid #ccc;border-bottom:2px solid #ccc;padding:4px 8px;'
-                f'background:#e6f4ea;text-align:center;white-space:nowrap;overflow:hidden;'
-                f'text-overflow:ellipsis;width:{column_widths.get(col, "120px")};'
-                f'max-width:{column_widths.get(col, "120px")};vertical-align:middle;'
-            )
-            if col in fixed_columns:
-                th_style += (
-                    f'position:sticky;top:0;left:{left_offset}px;z-index:20;'
-                    f'background:#e6f4ea;box-shadow:2px 0 0 #ccc;'
+        with col_study:
+            study_selected = st.multiselect(
+                '', options=all_study_options, default=[], key='study_multiselect_final',
+                placeholder='Study', label_visibility='collapsed')
+        with col_ctn:
+            ctn_selected = st.multiselect(
+                '', options=ctn_options, default=[], key='ctn_multiselect_final',
+                placeholder='CTN', label_visibility='collapsed')
+        with col_ta:
+            ta_selected = st.multiselect(
+                '', options=all_ta_options, default=[], key='ta_multiselect_final',
+                placeholder='TA', label_visibility='collapsed')
+        with col_sourcing:
+            sourcing_selected = st.multiselect(
+                '', options=all_sourcing_options, default=[], key='sourcing_multiselect_final',
+                placeholder='Sourcing', label_visibility='collapsed')
+        with col_milestone:
+            milestone_next5w = st.checkbox(f'Milestone in Next {NEXT_MILESTONE_WEEKS} weeks', key='milestone_next5w')
+
+        # ==== 根据筛选过滤原始df（全局联动） ====
+        # 各筛选条件为汇总表上的study位图，求交即可
+        n_studies = len(study_summary)
+        selected = np.ones(n_studies, dtype=bool)
+        if study_selected:
+            selected &= postings_mask(filter_index['Study'], study_selected, n_studies)
+        if ta_selected:
+            selected &= postings_mask(filter_index['TA'], ta_selected, n_studies)
+        if ctn_selected:
+            selected &= np.isin(ctn_group.to_numpy(), ctn_selected)
+        if sourcing_selected:
+            selected &= postings_mask(filter_index['Sourcing'], sourcing_selected, n_studies)
+        # 新增：Milestone in Next 5 weeks筛选
+        if milestone_next5w:
+            # 未来5周内有target milestone且该milestone的actual日期为空的study
+            studies_with_milestone = studies_with_upcoming_milestone(df, now, NEXT_MILESTONE_WEEKS)
+            selected &= study_summary.index.isin(studies_with_milestone)
+
+        # 表格行的筛选位图
+        details_selected = selected[details_index['summary_pos']]
+        # 获取筛选后的study列表（供下方Tab使用）
+        filtered_studies = details_df['Study'].to_numpy()[details_selected].tolist()
+        # 没有匹配的study时卡片显示全部
+        if not selected.any():
+            selected[:] = True
+        # 筛选结果的缓存key（下方Tab按数据集+筛选结果缓存）
+        filter_key = hash_upload(np.packbits(selected).tobytes() + bytes([bool(filtered_studies)]))
+
+        # ==== 表格居中渲染 ====
+        def render_html_table(df, highlight=None):
+            columns = list(df.columns)
+            column_widths = {
+                'No': '50px',
+                'TA': '110px',
+                'Study': '90px',
+                'Sourcing': '110px',
+                'CTN': '180px',
+                'Leading EC Approval': '200px',
+                'Leading Contract': '200px',
+                'Country Package': '200px',
+                'Country Contract': '200px',
+                'IMP': '200px',
+                'Facility': '200px',
+                'HGRAC': '200px',
+                'FSA': '200px',
+                'FPS': '200px',
+                '25% SA': '200px',
+                '75% SA': '200px'
+            }
+            fixed_columns = ['No', 'TA', 'Study', 'Sourcing', 'CTN']
+            fixed_bg = '#fff'
+            # 构建表头
+            new_headers = []
+            left_offset = 0
+            for idx, col in enumerate(columns):
+                th_style = (
+                    f'border:1px solid #ccc;border-bottom:2px solid #ccc;padding:4px 8px;'
+                    f'background:#e6f4ea;text-align:center;white-space:nowrap;overflow:hidden;'
+                    f'text-overflow:ellipsis;width:{column_widths.get(col, "120px")};'
+                    f'max-width:{column_widths.get(col, "120px")};vertical-align:middle;'
                 )
-                left_offset += int(column_widths[col][:-2])
-            else:
-                th_style += 'position:sticky;top:0;z-index:10;'
-            new_headers.append(f'<th style="{th_style}">{col}</th>')
-        html = '<div style="overflow-y:auto; max-height:480px; width:100%; border-top:2px solid #ccc; border-bottom:2px solid #ccc;">'
-        html += '<table style="width:100%;border-collapse:separate;border-spacing:0;table-layout:fixed;">'
-        html += '<thead><tr>' + ''.join(new_headers) + '</tr></thead><tbody>'
-        highlight_cols = {
-            'Country Package':    ('country_package_ready_plan_date', 'country_package_ready_actual_date', -12),
-            'Country Contract':   ('main_contract_tmpl_plan_date', 'main_contract_tmpl_actual_date', -12),
-            'IMP':                ('study_imp_ready_plan_date', 'study_imp_ready_actual_date', 8.5),
-            'Facility':           ('study_sfr_plan_date', 'study_sfr_actual_date', 8.5),
-            'HGRAC':              ('study_hia_plan_date', 'study_hia_actual_date', 8.5),
-            'FSA':                ('study_fsa_plan_date', 'study_fsa_actual_date', 9),
-            'FPS':                ('study_fps_plan_date', 'study_fps_actual_date', 12),
-            '25% SA':             ('site_sa_plan_date', 'site_sa_actual_date', 13),
-            '75% SA':             ('site_sa_plan_date', 'site_sa_actual_date', 19),
-            'Leading EC Approval':('ec_approval_plan_date', 'ec_approval_actual_date', 0),
-            'Leading Contract':   ('contract_signoff_plan_date', 'contract_signoff_actual_date', 0)
-        }
-        n_rows = len(df)
-        for row_idx, (_, row) in enumerate(df.iterrows()):
-            tr_style = ''
-            if row_idx == n_rows - 1:
-                tr_style += 'border-bottom:2px solid #ccc;'
-            html += f'<tr style="{tr_style}">'  # 应用tr的style
+                if col in fixed_columns:
+                    th_style += (
+                        f'position:sticky;top:0;left:{left_offset}px;z-index:20;'
+                        f'background:#e6f4ea;box-shadow:2px 0 0 #ccc;'
+                    )
+                    left_offset += int(column_widths[col][:-2])
+                else:
+                    th_style += 'position:sticky;top:0;z-index:10;'
+                new_headers.append(f'<th style="{th_style}">{col}</th>')
+            html = '<div style="overflow-y:auto; max-height:480px; width:100%; border-top:2px solid #ccc; border-bottom:2px solid #ccc;">'
+            html += '<table style="width:100%;border-collapse:separate;border-spacing:0;table-layout:fixed;">'
+            html += '<thead><tr>' + ''.join(new_headers) + '</tr></thead><tbody>'
+            # 固定列的sticky位置与各列基础样式只算一次
+            col_styles = []
             left_offset_td = 0
-            for col_idx, (col, cell) in enumerate(zip(df.columns, row)):
+            for col in columns:
                 style = f"border:1px solid #ccc;padding:4px 8px;text-align:center;width:{column_widths.get(col, '120px')};word-break:break-all;white-space:pre-line;max-height:120px;overflow-y:auto;vertical-align:middle;background:{fixed_bg};"
                 if col in fixed_columns:
                     style += f'position:sticky;left:{left_offset_td}px;z-index:5;background:{fixed_bg};box-shadow:2px 0 0 #ccc;'
                     left_offset_td += int(column_widths[col][:-2])
                 else:
                     style += 'z-index:1;'
-                # 新增：25% SA和75% SA集合高亮
-                if col == '25% SA' and row['Study'] in highlight_25sa_studies:
-                    style += "background:#fffde7;"
-                if col == '75% SA' and row['Study'] in highlight_75sa_studies:
-                    style += "background:#fffde7;"
-                # 判断是否需要高亮
-                if col in highlight_cols and raw_df is not None:
-                    plan_col, actual_col, week_offset = highlight_cols[col]
-                    study = row['Study'] if 'Study' in row else None
-                    if study and 'study_number' in raw_df.columns:
-                        orig_rows = raw_df[raw_df['study_number'] == study]
-                        if not orig_rows.empty:
-                            orig_row = orig_rows.iloc[0]
-                            ctn_actual = orig_row['study_ctn_actual_date'] if 'study_ctn_actual_date' in orig_row else pd.NaT
-                            ctn_plan = orig_row['study_ctn_plan_date'] if 'study_ctn_plan_date' in orig_row else pd.NaT
-                            ctn_base = pd.to_datetime(ctn_actual) if pd.notna(ctn_actual) else (pd.to_datetime(ctn_plan) if pd.notna(ctn_plan) else None)
-                            plan_date = orig_row[plan_col] if plan_col in orig_row else pd.NaT
-                            actual_date = orig_row[actual_col] if actual_col in orig_row else pd.NaT
-                            # 新增：CTN计划日期在未来5周内，且Leading EC Approval/Contract的actual为空，单元格高亮为黄色
-                            if col in ['Leading EC Approval', 'Leading Contract'] and pd.isna(ctn_actual) and pd.notna(ctn_plan) and ctn_base is not None:
-                                target = ctn_base + pd.Timedelta(weeks=week_offset)
-                                if now < target <= five_weeks_later and pd.isna(actual_date):
-                                    style += "background:#fffde7;"  # 更亮的黄色
-                            # 原有高亮逻辑
-                            if pd.isna(actual_date) and ctn_base is not None:
-                                target = ctn_base + pd.Timedelta(weeks=week_offset)
-                                # 调试YO45758的FPS
-                                if study == 'YO45758' and col == 'FPS':
-                                    print(f"YO45758 FPS Debug:")
-                                    print(f"  plan_date: {plan_date}")
-                                    print(f"  actual_date: {actual_date}")
-                                    print(f"  ctn_base: {ctn_base}")
-                                    print(f"  target: {target}")
-                                    print(f"  now: {now}")
-                                    print(f"  five_weeks_later: {five_weeks_later}")
-                                    print(f"  condition: now <= target <= five_weeks_later = {now <= target <= five_weeks_later}")
-                                # 修改：检查Target日期是否在未来5周内，而不是plan_date
-                                if now <= target <= five_weeks_later:
-                                    style += "background:#fff9e5;"  # 浅黄色
-                if col in ['TA', 'Study', 'Sourcing']:
-                    html += f'<td style="{style}font-weight:bold;">{cell}</td>'
-                else:
-                    html += f'<td style="{style}">{cell}</td>'
-            html += '</tr>'
-        html += '</tbody></table></div>'
-        return html
-    st.markdown(render_html_table(filtered_details_df, raw_df=df), unsafe_allow_html=True)
-    
-    # ==== 所有卡片使用过滤后的df ====
-    # 将df替换为df_filtered，这样所有卡片都显示筛选后的数据
-    df = df_filtered
-else:
-    st.markdown('<div class="card-content">请上传包含 study_number, study_ctn_plan_date, study_ctn_actual_date 字段的CSV</div>', unsafe_allow_html=True)
+                col_styles.append(style)
+            study_pos = columns.index('Study')
+            # 只含当前页study的高亮表
+            highlight = highlight.to_dict('index') if highlight is not None else {}
+            n_rows = len(df)
+            for row_idx, row in enumerate(df.itertuples(index=False)):
+                tr_style = ''
+                if row_idx == n_rows - 1:
+                    tr_style += 'border-bottom:2px solid #ccc;'
+                html += f'<tr style="{tr_style}">'  # 应用tr的style
+                study = row[study_pos]
+                # 高亮只需按study查表
+                row_highlight = highlight.get(study, {})
+                for col, style, cell in zip(columns, col_styles, row):
+                    style += row_highlight.get(col, '')
+                    if col in ['TA', 'Study', 'Sourcing']:
+                        html += f'<td style="{style}font-weight:bold;">{cell}</td>'
+                    else:
+                        html += f'<td style="{style}">{cell}</td>'
+                html += '</tr>'
+            html += '</tbody></table></div>'
+            return html
+        # ==== 服务端排序与分页：只生成并发送当前页的行 ====
+        col_sort, col_desc, col_size, col_page, _ = st.columns([1, 1, 1, 1, 4])
+        with col_sort:
+            sort_by = st.selectbox('Sort by', DETAILS_SORT_OPTIONS, key='details_sort_by')
+        with col_desc:
+            st.markdown('<div style="height:28px;"></div>', unsafe_allow_html=True)
+            sort_desc = st.checkbox('Descending', key='details_sort_desc')
+        with col_size:
+            page_size = st.selectbox('Rows per page', DETAILS_PAGE_SIZES, key='details_page_size')
+        n_pages = max(1, -(-len(filtered_studies) // page_size))
+        with col_page:
+            page = st.number_input(f'Page (1-{n_pages})', min_value=1, max_value=n_pages, value=1, step=1, key='details_page')
+        page = min(int(page), n_pages)
+        # 按缓存的全表顺序取筛选行，只取当前页
+        order = details_index['orders'][sort_by, bool(sort_desc)]
+        page_df = details_df.iloc[order[details_selected[order]][(page - 1) * page_size:page * page_size]]
+        # milestone状态与高亮只为当前页的study计算；高亮基于筛选前的口径，按plan日期排序取SA分位
+        page_summary = study_summary.loc[page_df['Study']]
+        milestone_matrix = evaluate_milestones(page_summary, sa_quantiles, now)
+        highlight = build_highlight_matrix(page_summary, get_sa_quantiles(dataset_key, df, sort_by='sa_plan'), now)
+        page_rows = pd.DataFrame([details_row(no, study) for no, study in zip(page_df['No'], page_df['Study'])], columns=DETAILS_COLUMNS)
+        st.markdown(render_html_table(page_rows, highlight=highlight), unsafe_allow_html=True)
+        
+        # ==== 所有卡片使用过滤后的df ====
+        # 全部选中时直接沿用原df（不复制）；否则按行位置数组取子集（iloc按位置取行是take，会复制选中的行，不是视图），
+        # 只省去了逐study比较生成布尔掩码的开销；汇总表同样按study位图取子集
+        if not selected.all():
+            df = df.iloc[np.flatnonzero(selected[filter_index['row_study']])]
+            study_summary = study_summary.iloc[np.flatnonzero(selected)]
+    else:
+        st.markdown('<div class="card-content">请上传包含 study_number, study_ctn_plan_date, study_ctn_actual_date 字段的CSV</div>', unsafe_allow_html=True)
 
-# 在表格下方增加5个卡片，风格与第一行一致，内容留空
-st.markdown("---")
-cards = st.columns(5)
-for j, card in enumerate(cards):
-    with card:
-        if j == 1:
-            # 原卡片6内容（Site Selection & SSUS Assignment）
-            st.markdown('<div class="stCardTitle">Site Selection & SSUS Assignment</div>', unsafe_allow_html=True)
-            st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">vs country package ready date</div>', unsafe_allow_html=True)
-            if df is not None and 'site_select_actual_date' in df.columns and 'study_number' in df.columns and 'ssus_assignment_date' in df.columns and 'country_package_ready_actual_date' in df.columns:
-                # 计算每个study的country_package_ready_date（优先actual，无则plan）
-                study_package_dates = {}
-                for study, group in df.groupby('study_number'):
-                    actual_dates = group['country_package_ready_actual_date'].dropna()
-                    plan_dates = group['country_package_ready_plan_date'].dropna() if 'country_package_ready_plan_date' in group.columns else []
-                    if not actual_dates.empty:
-                        study_package_dates[study] = actual_dates.min()
-                    elif len(plan_dates) > 0:
-                        study_package_dates[study] = plan_dates.min()
-                # 只保留有country_package_ready_date的study的数据
-                df_valid = df[df['study_number'].isin(study_package_dates.keys())].copy()
-                
-                # Site Selection vs country package ready
-                site_selection_deltas = []
-                for study, group in df_valid.groupby('study_number'):
-                    package_date = study_package_dates[study]
-                    for _, row in group.iterrows():
-                        if pd.notna(row['site_select_actual_date']):
-                            delta_weeks = (row['site_select_actual_date'] - package_date).days / 7
-                            site_selection_deltas.append(delta_weeks)
-                
-                # SSUS Assignment vs country package ready
-                ssus_deltas = []
-                for study, group in df_valid.groupby('study_number'):
-                    package_date = study_package_dates[study]
-                    for _, row in group.iterrows():
-                        if pd.notna(row['ssus_assignment_date']):
-                            delta_weeks = (row['ssus_assignment_date'] - package_date).days / 7
-                            ssus_deltas.append(delta_weeks)
-                
-                # 分组统计
-                bins = [-float('inf'), 0, 2, 4, 8, float('inf')]
-                labels = ['Before Package Ready', '≤2w', '2-4w', '4-8w', '>8w']
-                
-                # Site Selection分组
-                if site_selection_deltas:
-                    cats_site = pd.cut(site_selection_deltas, bins=bins, labels=labels, right=True, include_lowest=True)
-                    value_counts_site = pd.value_counts(cats_site, sort=False)
-                    values_site = value_counts_site.values.tolist()
-                else:
-                    values_site = [0] * len(labels)
-                
-                # SSUS Assignment分组
-                if ssus_deltas:
-                    cats_ssus = pd.cut(ssus_deltas, bins=bins, labels=labels, right=True, include_lowest=True)
-                    value_counts_ssus = pd.value_counts(cats_ssus, sort=False)
-                    values_ssus = value_counts_ssus.values.tolist()
+    # 在表格下方增加5个卡片，风格与第一行一致，内容留空
+    st.markdown("---")
+    cards = st.columns(5)
+    for j, card in enumerate(cards):
+        with card:
+            if j == 1:
+                # 原卡片6内容（Site Selection & SSUS Assignment）
+                st.markdown('<div class="stCardTitle">Site Selection & SSUS Assignment</div>', unsafe_allow_html=True)
+                st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">vs country package ready date</div>', unsafe_allow_html=True)
+                if df is not None and 'site_select_actual_date' in df.columns and 'study_number' in df.columns and 'ssus_assignment_date' in df.columns and 'country_package_ready_actual_date' in df.columns:
+                    # Site Selection / SSUS Assignment 相对 country package ready 的周数分布
+                    labels = PACKAGE_READY_WEEK_LABELS
+                    values_site, values_ssus = package_ready_week_counts(df, ['site_select_actual_date', 'ssus_assignment_date'])
+
+                    st.markdown('<div style="display:flex;justify-content:flex-start;margin-left:106px;">', unsafe_allow_html=True)
+                    bar_fig = go.Figure(go.Bar(
+                        x=labels,
+                        y=values_site,
+                        name='Site Selection',
+                        marker_color='#1976d2',
+                        text=values_site,
+                        textposition='auto',
+                        offsetgroup=0,
+                        textfont=dict(size=12, color='white', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
+                    ))
+                    bar_fig.add_trace(go.Bar(
+                        x=labels,
+                        y=values_ssus,
+                        name='SSUS Assignment',
+                        marker_color='#ffb300',
+                        text=values_ssus,
+                        textposition='auto',
+                        offsetgroup=1,
+                        textfont=dict(size=12, color='black', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
+                    ))
+                    bar_fig.update_layout(
+                        barmode='group',
+                        height=270,  # 或更大
+                        width=480,   # 或更大
+                        margin=dict(l=0, r=0, t=20, b=0),
+                        yaxis=dict(title='', showticklabels=False, showgrid=False, tickfont=dict(size=16, color='#222')),
+                        xaxis=dict(
+                            tickfont=dict(
+                                size=14,
+                                color='#222'
+                            )
+                        ),
+                        legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5),
+                        font=dict(family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
+                    )
+                    st.plotly_chart(bar_fig, use_container_width=False, key='card_10_bar')
+                    st.markdown('</div>', unsafe_allow_html=True)
                 else:
-                    values_ssus = [0] * len(labels)
-                
-                st.markdown('<div style="display:flex;justify-content:flex-start;margin-left:106px;">', unsafe_allow_html=True)
-                bar_fig = go.Figure(go.Bar(
-                    x=labels,
-                    y=values_site,
-                    name='Site Selection',
-                    marker_color='#1976d2',
-                    text=values_site,
-                    textposition='auto',
-                    offsetgroup=0,
-                    textfont=dict(size=12, color='white', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
-                ))
-                bar_fig.add_trace(go.Bar(
-                    x=labels,
-                    y=values_ssus,
-                    name='SSUS Assignment',
-                    marker_color='#ffb300',
-                    text=values_ssus,
-                    textposition='auto',
-                    offsetgroup=1,
-                    textfont=dict(size=12, color='black', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
-                ))
-                bar_fig.update_layout(
-                    barmode='group',
-                    height=270,  # 或更大
-                    width=480,   # 或更大
-                    margin=dict(l=0, r=0, t=20, b=0),
-                    yaxis=dict(title='', showticklabels=False, showgrid=False, tickfont=dict(size=16, color='#222')),
-                    xaxis=dict(
-                        tickfont=dict(
-                            size=14,
-                            color='#222'
-                        )
-                    ),
-                    legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5),
-                    font=dict(family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
-                )
-                st.plotly_chart(bar_fig, use_container_width=False, key='card_10_bar')
-                st.markdown('</div>', unsafe_allow_html=True)
-            else:
-                st.markdown('<div class="card-content">请上传包含 study_number, site_select_actual_date, ssus_assignment_date, country_package_ready_actual_date 字段的CSV</div>', unsafe_allow_html=True)
-        elif j == 0:
-            # 原卡片7内容（Total Site）
-            st.markdown('<div class="stCardTitle" style="margin-bottom:1px;">Total Site</div>', unsafe_allow_html=True)
-            st.markdown('<style>div[data-testid="column"]:nth-child(1) > div {max-width:280px; min-width:280px; padding-top:4px; padding-bottom:4px;}</style>', unsafe_allow_html=True)
-            if df is not None and 'study_site_number' in df.columns:
-                total_site = df['study_site_number'].nunique()
-                st.markdown(f'<div class="stCardNumber" style="font-size:24px;margin-top:1px;margin-bottom:1px;">{total_site}</div>', unsafe_allow_html=True)
-                st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:0px;">Count of Process Complete</div>', unsafe_allow_html=True)
-                steps = [
-                    ('GCP', 'site_gcp_actual_date'),
-                    ('EC', 'ec_approval_actual_date'),
-                    ('Main Contract', 'contract_signoff_actual_date'),
-                    ('Commitment Letter', 'comm_ltr_obt_actual_date'),
-                    ('SSU Last Step', None),
-                    ('Activation', 'site_sa_actual_date')
-                ]
-                def get_last_step(row):
-                    ec = row.get('ec_approval_actual_date')
-                    contract = row.get('contract_signoff_actual_date')
-                    comm = row.get('comm_ltr_obt_actual_date')
-                    crc_type = str(row.get('crc_contract_type', '')).strip()
-                    crc_impact = str(row.get('crc_contract_impact_sa', '')).strip().upper()
-                    crc = row.get('crc_contract_signoff_actual_date') if (crc_type == '三方' and crc_impact == 'YES') else None
-
-                    steps = [ec, contract, comm]
-                    if crc is not None:
-                        steps.append(crc)
-
-                    if pd.notna(row.get('site_sa_actual_date')):
-                        # 宽松：只要有一个非空
-                        steps_non_na = [d for d in steps if pd.notna(d)]
-                        return max(steps_non_na) if steps_non_na else pd.NaT
-                    else:
-                        # 严格：所有纳入的步骤都必须非空
-                        if all(pd.notna(d) for d in steps):
-                            return max(steps)
-                        else:
-                            return pd.NaT
-                df['ssu_last_step_actual'] = df.apply(get_last_step, axis=1)
-                result = []
-                for step_name, col in steps:
-                    if step_name == 'SSU Last Step':
-                        complete = df['ssu_last_step_actual'].notna().sum()
-                    else:
-                        complete = df[col].notna().sum() if col in df.columns else 0
-                    result.append({'step': step_name, 'Complete': complete})
-                st.markdown('<style>.progress-row{display:flex;align-items:center;margin-bottom:12px;}.progress-row:last-child{margin-bottom:0px;}.progress-label{width:100px;text-align:right;font-size:16px;white-space:nowrap;}.progress-bar-wrap{flex:0 0 180px;max-width:180px;min-width:180px;margin:0 1px;}.progress-bar-bg{background:#eee;border-radius:8px;height:16px;position:relative;width:180px;}.progress-bar-fill{background:#43a047;height:16px;border-radius:8px 0 0 8px;position:absolute;top:0;left:0;}.progress-bar-text{position:absolute;top:0;left:50%;transform:translateX(-50%);font-size:12px;color:#222;font-family:Microsoft YaHei, Open Sans, verdana, arial, sans-serif;font-weight:bold;line-height:16px;}</style>', unsafe_allow_html=True)
-                for r in result:
-                    percent = r['Complete'] / total_site if total_site else 0
-                    percent_width = int(percent * 100)
-                    st.markdown(f'''
+                    st.markdown('<div class="card-content">请上传包含 study_number, site_select_actual_date, ssus_assignment_date, country_package_ready_actual_date 字段的CSV</div>', unsafe_allow_html=True)
+            elif j == 0:
+                # 原卡片7内容（Total Site）
+                st.markdown('<div class="stCardTitle" style="margin-bottom:1px;">Total Site</div>', unsafe_allow_html=True)
+                st.markdown('<style>div[data-testid="column"]:nth-child(1) > div {max-width:280px; min-width:280px; padding-top:4px; padding-bottom:4px;}</style>', unsafe_allow_html=True)
+                if df is not None and 'study_site_number' in df.columns:
+                    total_site = df['study_site_number'].nunique()
+                    st.markdown(f'<div class="stCardNumber" style="font-size:24px;margin-top:1px;margin-bottom:1px;">{total_site}</div>', unsafe_allow_html=True)
+                    st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:0px;">Count of Process Complete</div>', unsafe_allow_html=True)
+                    result = ssu_funnel_counts(df)
+                    st.markdown('<style>.progress-row{display:flex;align-items:center;margin-bottom:12px;}.progress-row:last-child{margin-bottom:0px;}.progress-label{width:100px;text-align:right;font-size:16px;white-space:nowrap;}.progress-bar-wrap{flex:0 0 180px;max-width:180px;min-width:180px;margin:0 1px;}.progress-bar-bg{background:#eee;border-radius:8px;height:16px;position:relative;width:180px;}.progress-bar-fill{background:#43a047;height:16px;border-radius:8px 0 0 8px;position:absolute;top:0;left:0;}.progress-bar-text{position:absolute;top:0;left:50%;transform:translateX(-50%);font-size:12px;color:#222;font-family:Microsoft YaHei, Open Sans, verdana, arial, sans-serif;font-weight:bold;line-height:16px;}</style>', unsafe_allow_html=True)
+                    for r in result:
+                        percent = r['Complete'] / total_site if total_site else 0
+                        percent_width = int(percent * 100)
+                        st.markdown(f'''
                     <div class="progress-row">
                         <div class="progress-label">{r['step']}</div>
                         <div class="progress-bar-wrap">
@@ -2187,194 +2760,164 @@ for j, card in enumerate(cards):
                         </div>
                     </div>
                     ''', unsafe_allow_html=True)
-                # Total Site卡片内容保持不变，移除tab
-            else:
-                st.markdown('<div class="card-content">请上传包含 study_site_number 字段的CSV</div>', unsafe_allow_html=True)
-        elif j == 2:
-            st.markdown('<div class="stCardTitle">Country Package & Main Contract Template</div>', unsafe_allow_html=True)
-            st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">vs CTN date</div>', unsafe_allow_html=True)
-            if df is not None and 'study_number' in df.columns and 'country_package_ready_actual_date' in df.columns and 'main_contract_tmpl_actual_date' in df.columns and ('study_ctn_actual_date' in df.columns or 'study_ctn_plan_date' in df.columns):
-                # 只保留有country_package_ready_actual_date或main_contract_tmpl_actual_date的study
-                study_df = df.drop_duplicates(subset=['study_number'], keep='first').copy()
-                # 计算CTN日期（优先actual）
-                study_df['ctn_date'] = study_df['study_ctn_actual_date']
-                study_df.loc[study_df['ctn_date'].isna(), 'ctn_date'] = study_df['study_ctn_plan_date']
-                # 只保留ctn_date非空的
-                study_df = study_df[study_df['ctn_date'].notna()].copy()
-                # 计算country_package_ready_actual_date与ctn_date的周差
-                bins = [-float('inf'), -12, -8, -4, 0, float('inf')]
-                labels = ['before CTN-12w', '-12~-8w', '-8~-4w', '-4~0w', 'after CTN']
-                # Country Package
-                cp_deltas = (study_df['country_package_ready_actual_date'] - study_df['ctn_date']).dt.days / 7
-                cp_cats = pd.cut(cp_deltas, bins=bins, labels=labels, right=True, include_lowest=True)
-                cp_counts = cp_cats.value_counts(sort=False)
-                cp_values = cp_counts.values.tolist()
-                # Main Contract
-                mc_deltas = (study_df['main_contract_tmpl_actual_date'] - study_df['ctn_date']).dt.days / 7
-                if not mc_deltas.empty:
-                    mc_cats = pd.cut(mc_deltas, bins=bins, labels=labels, right=True, include_lowest=True)
-                    mc_counts = mc_cats.value_counts(sort=False)
-                    mc_values = mc_counts.values.tolist()
+                    # Total Site卡片内容保持不变，移除tab
                 else:
-                    mc_values = [0] * len(labels)
-                # 绘制分组柱状图
-                st.markdown('<div style="display:flex;justify-content:flex-start;margin-left:106px;">', unsafe_allow_html=True)
-                bar_fig = go.Figure(go.Bar(
-                    x=labels,
-                    y=cp_values,
-                    name='Country Package',
-                    marker_color='#1976d2',
-                    text=cp_values,
-                    textposition='auto',
-                    offsetgroup=0,
-                    textfont=dict(size=12, color='white', family='Arial')
-                ))
-                bar_fig.add_trace(go.Bar(
-                    x=labels,
-                    y=mc_values,
-                    name='Main Contract',
-                    marker_color='#ffb300',
-                    text=mc_values,
-                    textposition='auto',
-                    offsetgroup=1,
-                    textfont=dict(size=12, color='black', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
-                ))
-                bar_fig.update_layout(
-                    barmode='group',
-                    height=270,
-                    width=480,
-                    margin=dict(l=0, r=0, t=20, b=0),
-                    yaxis=dict(title='', showticklabels=False, showgrid=False, tickfont=dict(size=16, color='#222')),
-                    xaxis=dict(
-                        tickfont=dict(
-                            size=16,
-                            color='#222'
-                        )
-                    ),
-                    legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5, font=dict(size=16, color='#6D4C41')),
-                    font=dict(size=18, color='#6D4C41')
-                )
-                st.plotly_chart(bar_fig, use_container_width=False, key='card_7_bar')
-                st.markdown('</div>', unsafe_allow_html=True)
-            else:
-                st.markdown('<div class="card-content">请上传包含 study_number, country_package_ready_actual_date, main_contract_tmpl_actual_date, study_ctn_actual_date/study_ctn_plan_date 字段的CSV</div>', unsafe_allow_html=True)
-        elif j == 3:
-            st.markdown('<div class="stCardTitle">Site Process Median Duration</div>', unsafe_allow_html=True)
-            st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">Mdn duration of each process</div>', unsafe_allow_html=True)
-            if df is not None:
-                flows = [
-                    ('CTN-GCP', 'site_gcp_actual_date', 'study_ctn_actual_date'),
-                    ('CTN-EC', 'ec_approval_actual_date', 'study_ctn_actual_date'),
-                    ('CTN-Contract', 'contract_signoff_actual_date', 'study_ctn_actual_date'),
-                    ('CTN-SA', 'site_sa_actual_date', 'study_ctn_actual_date'),
-                    ('GCP-EC', 'ec_approval_actual_date', 'site_gcp_actual_date'),
-                    ('GCP-Contract', 'contract_signoff_actual_date', 'site_gcp_actual_date'),
-                    ('Comm Ltr-HGRAC', 'comm_ltr_obt_actual_date', 'study_hia_actual_date'),
-                ]
-                medians = []
-                for flow_name, end_col, start_col in flows:
-                    if end_col in df.columns and start_col in df.columns:
-                        valid = df[end_col].notna() & df[start_col].notna()
-                        days = (df.loc[valid, end_col] - df.loc[valid, start_col]).dt.days
-                        if not days.empty:
-                            median_val = int(np.median(days))
-                        else:
-                            median_val = None
+                    st.markdown('<div class="card-content">请上传包含 study_site_number 字段的CSV</div>', unsafe_allow_html=True)
+            elif j == 2:
+                st.markdown('<div class="stCardTitle">Country Package & Main Contract Template</div>', unsafe_allow_html=True)
+                st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">vs CTN date</div>', unsafe_allow_html=True)
+                if df is not None and 'study_number' in df.columns and 'country_package_ready_actual_date' in df.columns and 'main_contract_tmpl_actual_date' in df.columns and ('study_ctn_actual_date' in df.columns or 'study_ctn_plan_date' in df.columns):
+                    # 只保留有country_package_ready_actual_date或main_contract_tmpl_actual_date的study
+                    study_df = study_summary.reset_index()
+                    # 计算CTN日期（优先actual）
+                    study_df['ctn_date'] = study_df['study_ctn_actual_date']
+                    study_df.loc[study_df['ctn_date'].isna(), 'ctn_date'] = study_df['study_ctn_plan_date']
+                    # 只保留ctn_date非空的
+                    study_df = study_df[study_df['ctn_date'].notna()].copy()
+                    # 计算country_package_ready_actual_date与ctn_date的周差
+                    bins = [-float('inf'), -12, -8, -4, 0, float('inf')]
+                    labels = ['before CTN-12w', '-12~-8w', '-8~-4w', '-4~0w', 'after CTN']
+                    # Country Package
+                    cp_deltas = (study_df['country_package_ready_actual_date'] - study_df['ctn_date']).dt.days / 7
+                    cp_cats = pd.cut(cp_deltas, bins=bins, labels=labels, right=True, include_lowest=True)
+                    cp_counts = cp_cats.value_counts(sort=False)
+                    cp_values = cp_counts.values.tolist()
+                    # Main Contract
+                    mc_deltas = (study_df['main_contract_tmpl_actual_date'] - study_df['ctn_date']).dt.days / 7
+                    if not mc_deltas.empty:
+                        mc_cats = pd.cut(mc_deltas, bins=bins, labels=labels, right=True, include_lowest=True)
+                        mc_counts = mc_cats.value_counts(sort=False)
+                        mc_values = mc_counts.values.tolist()
                     else:
-                        median_val = None
-                    medians.append(median_val)
-                # 用横向bar图展示
-                import plotly.graph_objects as go
-                bar_fig = go.Figure(
-                    go.Bar(
-                        y=[f[0] for f in flows],
-                        x=[m if m is not None else 0 for m in medians],
-                        text=[str(m) if m is not None else '—' for m in medians],
-                        textposition='inside',
+                        mc_values = [0] * len(labels)
+                    # 绘制分组柱状图
+                    st.markdown('<div style="display:flex;justify-content:flex-start;margin-left:106px;">', unsafe_allow_html=True)
+                    bar_fig = go.Figure(go.Bar(
+                        x=labels,
+                        y=cp_values,
+                        name='Country Package',
                         marker_color='#1976d2',
-                        orientation='h',
-                        textfont=dict(size=12, color='white', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
+                        text=cp_values,
+                        textposition='auto',
+                        offsetgroup=0,
+                        textfont=dict(size=12, color='white', family='Arial')
+                    ))
+                    bar_fig.add_trace(go.Bar(
+                        x=labels,
+                        y=mc_values,
+                        name='Main Contract',
+                        marker_color='#ffb300',
+                        text=mc_values,
+                        textposition='auto',
+                        offsetgroup=1,
+                        textfont=dict(size=12, color='black', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
+                    ))
+                    bar_fig.update_layout(
+                        barmode='group',
+                        height=270,
+                        width=480,
+                        margin=dict(l=0, r=0, t=20, b=0),
+                        yaxis=dict(title='', showticklabels=False, showgrid=False, tickfont=dict(size=16, color='#222')),
+                        xaxis=dict(
+                            tickfont=dict(
+                                size=16,
+                                color='#222'
+                            )
+                        ),
+                        legend=dict(orientation='h', yanchor='bottom', y=1.02, xanchor='center', x=0.5, font=dict(size=16, color='#6D4C41')),
+                        font=dict(size=18, color='#6D4C41')
                     )
-                )
-                bar_fig.update_layout(
-                    height=330,
-                    width=570,
-                    margin=dict(l=0, r=0, t=20, b=0),
-                    xaxis=dict(title='', showgrid=True, tickfont=dict(size=16, color='#222')),
-                    yaxis=dict(title='', tickfont=dict(size=16, color='#222')),
-                    font=dict(size=18, color='#6D4C41')
-                )
-                st.plotly_chart(bar_fig, use_container_width=False, key='card_8_bar')
-            else:
-                st.markdown('<div class="card-content">请上传包含相关actual date字段的CSV</div>', unsafe_allow_html=True)
-        elif j == 4:
-            st.markdown('<div class="stCardTitle">Leading Site Process Median Duration</div>', unsafe_allow_html=True)
-            st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">Mdn duration of each process (leading site)</div>', unsafe_allow_html=True)
-            if df is not None:
-                flows = [
-                    ('Package-Country to Site', 'site_package_actual_date', 'country_package_ready_actual_date'),
-                    ('Site package-GCP', 'site_gcp_actual_date', 'site_package_actual_date'),
-                    ('GCP-EC', 'ec_approval_actual_date', 'site_gcp_actual_date'),
-                    ('GCP-Contract', 'contract_signoff_actual_date', 'site_gcp_actual_date'),
-                    ('Comm Ltr-CTN', 'comm_ltr_obt_actual_date', 'study_ctn_actual_date'),
-                    ('CTN-SA', 'site_sa_actual_date', 'study_ctn_actual_date'),
-                ]
-                # 只保留leading site
-                if 'leading_site_or_not' in df.columns:
-                    df_lead = df[df['leading_site_or_not'].astype(str).str.upper() == 'YES'].copy()
+                    st.plotly_chart(bar_fig, use_container_width=False, key='card_7_bar')
+                    st.markdown('</div>', unsafe_allow_html=True)
                 else:
-                    df_lead = df.copy()  # 没有该字段则全用
-                medians = []
-                for flow_name, end_col, start_col in flows:
-                    if end_col in df_lead.columns and start_col in df_lead.columns:
-                        valid = df_lead[end_col].notna() & df_lead[start_col].notna()
-                        days = (df_lead.loc[valid, end_col] - df_lead.loc[valid, start_col]).dt.days
-                        if not days.empty:
-                            median_val = int(np.median(days))
-                        else:
-                            median_val = None
+                    st.markdown('<div class="card-content">请上传包含 study_number, country_package_ready_actual_date, main_contract_tmpl_actual_date, study_ctn_actual_date/study_ctn_plan_date 字段的CSV</div>', unsafe_allow_html=True)
+            elif j == 3:
+                st.markdown('<div class="stCardTitle">Site Process Median Duration</div>', unsafe_allow_html=True)
+                st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">Mdn duration of each process</div>', unsafe_allow_html=True)
+                if df is not None:
+                    flows = SITE_DURATION_FLOWS
+                    if duration_sketches is not None:
+                        durations = sketch_duration_stats(duration_sketches['site'], flows, study_summary.index)
                     else:
-                        median_val = None
-                    medians.append(median_val)
-                # 用横向bar图展示
-                import plotly.graph_objects as go
-                bar_fig = go.Figure(
-                    go.Bar(
-                        y=[f[0] for f in flows],
-                        x=[m if m is not None else 0 for m in medians],
-                        text=[str(m) if m is not None else '—' for m in medians],
-                        textposition='inside',
-                        marker_color='#1976d2',
-                        orientation='h',
-                        textfont=dict(size=12, color='white', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
+                        durations = duration_stats(df, flows)
+                    medians = [int(m) if n else None for m, n in zip(durations['p50'], durations['count'])]
+                    # 用横向bar图展示
+                    bar_fig = go.Figure(
+                        go.Bar(
+                            y=[f[0] for f in flows],
+                            x=[m if m is not None else 0 for m in medians],
+                            text=[str(m) if m is not None else '—' for m in medians],
+                            textposition='inside',
+                            marker_color='#1976d2',
+                            orientation='h',
+                            textfont=dict(size=12, color='white', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
+                        )
                     )
-                )
-                bar_fig.update_layout(
-                    height=330,
-                    width=570,
-                    margin=dict(l=0, r=0, t=20, b=0),
-                    xaxis=dict(title='', showgrid=True, tickfont=dict(size=16, color='#222')),
-                    yaxis=dict(title='', tickfont=dict(size=16, color='#222')),
-                    font=dict(size=18, color='#6D4C41')
-                )
-                st.plotly_chart(bar_fig, use_container_width=False, key='card_9_bar')
+                    bar_fig.update_layout(
+                        height=330,
+                        width=570,
+                        margin=dict(l=0, r=0, t=20, b=0),
+                        xaxis=dict(title='', showgrid=True, tickfont=dict(size=16, color='#222')),
+                        yaxis=dict(title='', tickfont=dict(size=16, color='#222')),
+                        font=dict(size=18, color='#6D4C41')
+                    )
+                    st.plotly_chart(bar_fig, use_container_width=False, key='card_8_bar')
+                    if duration_sketches is not None:
+                        st.markdown(duration_sketch_note(durations), unsafe_allow_html=True)
+                else:
+                    st.markdown('<div class="card-content">请上传包含相关actual date字段的CSV</div>', unsafe_allow_html=True)
+            elif j == 4:
+                st.markdown('<div class="stCardTitle">Leading Site Process Median Duration</div>', unsafe_allow_html=True)
+                st.markdown('<div style="text-align:center;color:#222;font-size:13px;margin-bottom:4px;">Mdn duration of each process (leading site)</div>', unsafe_allow_html=True)
+                if df is not None:
+                    flows = LEADING_DURATION_FLOWS
+                    # 只保留leading site；没有该字段则全用
+                    if duration_sketches is not None:
+                        durations = sketch_duration_stats(duration_sketches['leading'], flows, study_summary.index)
+                    else:
+                        df_lead = df[is_leading_site(df)] if 'leading_site_or_not' in df.columns else df
+                        durations = duration_stats(df_lead, flows)
+                    medians = [int(m) if n else None for m, n in zip(durations['p50'], durations['count'])]
+                    # 用横向bar图展示
+                    bar_fig = go.Figure(
+                        go.Bar(
+                            y=[f[0] for f in flows],
+                            x=[m if m is not None else 0 for m in medians],
+                            text=[str(m) if m is not None else '—' for m in medians],
+                            textposition='inside',
+                            marker_color='#1976d2',
+                            orientation='h',
+                            textfont=dict(size=12, color='white', family='Microsoft YaHei, Open Sans, verdana, arial, sans-serif')
+                        )
+                    )
+                    bar_fig.update_layout(
+                        height=330,
+                        width=570,
+                        margin=dict(l=0, r=0, t=20, b=0),
+                        xaxis=dict(title='', showgrid=True, tickfont=dict(size=16, color='#222')),
+                        yaxis=dict(title='', tickfont=dict(size=16, color='#222')),
+                        font=dict(size=18, color='#6D4C41')
+                    )
+                    st.plotly_chart(bar_fig, use_container_width=False, key='card_9_bar')
+                    if duration_sketches is not None:
+                        st.markdown(duration_sketch_note(durations), unsafe_allow_html=True)
+                else:
+                    st.markdown('<div class="card-content">请上传包含相关actual date字段的CSV</div>', unsafe_allow_html=True)
             else:
-                st.markdown('<div class="card-content">请上传包含相关actual date字段的CSV</div>', unsafe_allow_html=True)
-        else:
-            with st.container():
-                st.markdown(f"""
+                with st.container():
+                    st.markdown(f"""
                 <div class="stCardTitle">卡片 {j+6}</div>
                 <div class="card-content">
                     内容区域 {j+6}
                 </div>
                 """, unsafe_allow_html=True)
 
-# ==== Leading Site Details 独立区域 ====
-st.markdown("---")
-st.markdown('<div style="margin-top:-25px;padding-top:0;"></div>', unsafe_allow_html=True)
+    # ==== Leading Site Details 独立区域 ====
+    st.markdown("---")
+    st.markdown('<div style="margin-top:-25px;padding-top:0;"></div>', unsafe_allow_html=True)
 
-# 添加tab样式
-st.markdown('''
+    # 添加tab样式
+    st.markdown('''
 <style>
 /* 放大tab字体、加粗、深咖啡色 */
 div[data-baseweb="tab"] button {
@@ -2388,7 +2931,7 @@ div[data-baseweb="tab-list"] {
 }
 </style>
 ''', unsafe_allow_html=True)
-st.markdown('''
+    st.markdown('''
 <style>
 /* 兼容新版Streamlit tab标题样式 */
 div[data-baseweb="tab-list"] button[role="tab"] {
@@ -2398,7 +2941,7 @@ div[data-baseweb="tab-list"] button[role="tab"] {
 }
 </style>
 ''', unsafe_allow_html=True)
-st.markdown('''
+    st.markdown('''
 <style>
 /* Streamlit 1.18+ tab标题样式 */
 div[data-baseweb="tab-list"] button[role="tab"] > div {
@@ -2421,440 +2964,54 @@ div[data-baseweb="tab-list"] button[role="tab"] * {
 </style>
 ''', unsafe_allow_html=True)
 
-st.markdown('<div style="margin-top:-30px;">', unsafe_allow_html=True)
-tabs = st.tabs(["Leading Site", "HGRAC", "IMP"])
-st.markdown('</div>', unsafe_allow_html=True)
-with tabs[0]:
-    if df is not None and 'leading_site_or_not' in df.columns:
-        # 获取所有leading site数据
-        leading_sites = df[df['leading_site_or_not'].astype(str).str.upper() == 'YES'].copy()
-        
-        if not leading_sites.empty:
-            # 生成Leading Site Details表格数据
-            leading_details = []
-            for idx, row in leading_sites.iterrows():
-                # 序号 - 将在排序后重新赋值
-                seq_num = idx + 1
-                
-                # TA, Study - 从study details表格获取相同逻辑
-                study = row['study_number']
-                study_df = df[df['study_number'] == study]
-                ta = study_df['clintrack_ta_desc'].iloc[0] if study_df is not None and not study_df.empty and 'clintrack_ta_desc' in study_df.columns else ''
-                study_no = study
-                sourcing = study_df['sourcing_strategy'].iloc[0] if study_df is not None and not study_df.empty and 'sourcing_strategy' in study_df.columns else ''
-                
-                # Site信息
-                site_number_raw = row['study_site_number'] if 'study_site_number' in row else ''
-                # 去掉小数点，转换为整数
-                try:
-                    if pd.notna(site_number_raw) and str(site_number_raw).strip() != '':
-                        site_number = str(int(float(site_number_raw)))
-                    else:
-                        site_number = ''
-                except (ValueError, TypeError):
-                    site_number = str(site_number_raw) if pd.notna(site_number_raw) else ''
-                site_name = row['site_name'] if 'site_name' in row else ''
-                
-                # 日期字段处理函数
-                def format_date_display(actual_date, plan_date, study=None, is_ec_approval=False, is_contract_signoff=False):
-                    # 灯颜色定义
-                    COLOR_GREEN = '#43a047'
-                    COLOR_YELLOW = '#ffb300'
-                    COLOR_RED = '#e53935'
-                    
-                    # 灯逻辑判断函数
-                    def get_status_color(actual, plan, target, now):
-                        if pd.notna(actual):
-                            if target is not None and actual > target:
-                                return COLOR_RED  # actual超期
-                            else:
-                                return COLOR_GREEN  # actual未超期
-                        else:
-                            if target is not None and now > target:
-                                return COLOR_RED  # 没有actual且已超期
-                            elif pd.notna(plan) and plan > target:
-                                return COLOR_YELLOW  # plan大于目标日期且actual为空，黄灯
-                            else:
-                                return ''  # 其他情况无灯
-                    
-                    def status_light(color):
-                        return f"<span style='display:inline-block;width:14px;height:14px;border-radius:50%;background:{color};margin-right:2px;vertical-align:middle;'></span>"
-                    
-                    # 对于EC Approval和Contract Signoff，添加红黄绿灯
-                    if (is_ec_approval or is_contract_signoff) and study:
-                        # 获取该study的CTN基准日期
-                        study_row = df[df['study_number'] == study]
-                        if not study_row.empty:
-                            study_row = study_row.drop_duplicates(subset=['study_number'], keep='first')
-                            ctn_actual = study_row['study_ctn_actual_date'].iloc[0] if 'study_ctn_actual_date' in study_row.columns else pd.NaT
-                            ctn_plan = study_row['study_ctn_plan_date'].iloc[0] if 'study_ctn_plan_date' in study_row.columns else pd.NaT
-                            ctn_base = pd.to_datetime(ctn_actual) if pd.notna(ctn_actual) else (pd.to_datetime(ctn_plan) if pd.notna(ctn_plan) else None)
-                            
-                            if ctn_base is not None:
-                                now = pd.Timestamp.now()
-                                target = ctn_base  # threshold=0, target=ctn_base
-                                color = get_status_color(actual_date, plan_date, target, now)
-                                
-                                if pd.notna(actual_date):
-                                    weeks_str, _ = week_diff_str(actual_date, ctn_base, threshold=0, reverse=False)
-                                    date_color = '#222'
-                                    weeks_color = 'red' if color == COLOR_RED else '#888'
-                                    return status_light(color) + f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(actual_date)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-                                elif pd.notna(plan_date):
-                                    weeks_str, _ = week_diff_str(plan_date, ctn_base, threshold=0, reverse=False)
-                                    date_color = 'red' if plan_date < now else '#1976d2'
-                                    weeks_color = 'red' if color == COLOR_RED else '#888'
-                                    return status_light(color) + f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(plan_date)} (<span style='color:{weeks_color}'>{weeks_str}</span>)</span>"
-                                else:
-                                    return status_light(color)
-                    
-                    # 原有逻辑（非EC Approval和Contract Signoff）
-                    if pd.notna(actual_date):
-                        date_color = '#222'  # 黑色
-                        return f"<span style='color:{date_color};font-weight:bold'>A:{safe_date_str(actual_date)}</span>"
-                    elif pd.notna(plan_date):
-                        now = pd.Timestamp.now()
-                        date_color = 'red' if plan_date < now else '#1976d2'  # 红色或蓝色
-                        return f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(plan_date)}</span>"
-                    else:
-                        return ""
-                
-                # 各日期字段
-                site_package = format_date_display(
-                    row.get('site_package_actual_date'), 
-                    row.get('site_package_plan_date')
-                )
-                gcp_acceptance = format_date_display(
-                    row.get('site_gcp_actual_date'), 
-                    row.get('site_gcp_plan_date')
-                )
-                ec_submission = format_date_display(
-                    row.get('ec_sub_actual_date'), 
-                    row.get('ec_sub_plan_date')
-                )
-                ec_meeting = format_date_display(
-                    row.get('ec_meeting_actual_date'), 
-                    row.get('ec_meeting_plan_date')
-                )
-                ec_approval = format_date_display(
-                    row.get('ec_approval_actual_date'), 
-                    row.get('ec_approval_plan_date'),
-                    study=study_no,
-                    is_ec_approval=True
-                )
-                contract_gcp_review = format_date_display(
-                    row.get('draft_contract_gcp_review_actual_date'), 
-                    row.get('draft_contract_gcp_review_plan_date')
-                )
-                contract_negotiation = format_date_display(
-                    row.get('main_contract_neg_comp_actual_date'), 
-                    row.get('main_contract_neg_comp_plan_date')
-                )
-                contract_signoff = format_date_display(
-                    row.get('contract_signoff_actual_date'), 
-                    row.get('contract_signoff_plan_date'),
-                    study=study_no,
-                    is_contract_signoff=True
-                )
-                comm_ltr_sent = format_date_display(
-                    row.get('comm_ltr_sent_actual_date'), 
-                    row.get('comm_ltr_sent_plan_date')
-                )
-                comm_ltr_obtain = format_date_display(
-                    row.get('comm_ltr_obt_actual_date'), 
-                    row.get('comm_ltr_obt_plan_date')
-                )
-                site_activation = format_date_display(
-                    row.get('site_sa_actual_date'), 
-                    row.get('site_sa_plan_date')
-                )
-                
-                leading_details.append({
-                    'No': seq_num,
-                    'TA': ta,
-                    'Study': study_no,
-                    'Site#': site_number,
-                    'Site Name': site_name,
-                    'Site Package Ready': site_package,
-                    'GCP Acceptance': gcp_acceptance,
-                    'EC Submission': ec_submission,
-                    'EC Meeting': ec_meeting,
-                    'EC Approval': ec_approval,
-                    'Contract GCP Review': contract_gcp_review,
-                    'Contract Neg. Compl.': contract_negotiation,
-                    'Contract Signoff': contract_signoff,
-                    'Commt. Ltr Sent': comm_ltr_sent,
-                    'Commt. Ltr Obtain': comm_ltr_obtain,
-                    'SA': site_activation
-                })
-            
-            # 转为DataFrame
-            leading_details_df = pd.DataFrame(leading_details)
-            
-            # 排序：按study CTN日期升序排列
-            def get_ctn_sort_val_for_leading(row):
-                study = row['Study']
-                study_row = df[df['study_number'] == study]
-                if study_row is not None and not study_row.empty:
-                    study_row = study_row.drop_duplicates(subset=['study_number'], keep='first')
-                    ctn_actual = study_row['study_ctn_actual_date'].iloc[0] if study_row is not None and not study_row.empty and 'study_ctn_actual_date' in study_row.columns else pd.NaT
-                    ctn_plan = study_row['study_ctn_plan_date'].iloc[0] if study_row is not None and not study_row.empty and 'study_ctn_plan_date' in study_row.columns else pd.NaT
-                    if pd.notna(ctn_actual):
-                        return pd.to_datetime(ctn_actual, errors='coerce')
-                    elif pd.notna(ctn_plan):
-                        return pd.to_datetime(ctn_plan, errors='coerce')
-                return pd.NaT
-            
-            leading_details_df['ctn_sort'] = leading_details_df.apply(get_ctn_sort_val_for_leading, axis=1)
-            leading_details_df = leading_details_df.sort_values('ctn_sort', ascending=True, na_position='last').reset_index(drop=True)
-            leading_details_df['No'] = range(1, len(leading_details_df) + 1)
-            leading_details_df = leading_details_df.drop(columns=['ctn_sort'])
-            
-            # 应用筛选器（与Study Details表格联动）
-            if 'filtered_studies' in locals() and filtered_studies:
-                leading_details_df = leading_details_df[leading_details_df['Study'].isin(filtered_studies)].copy()
-                leading_details_df['No'] = range(1, len(leading_details_df) + 1)
-            
-            # 渲染表格（优化列宽）
-            def render_leading_site_table(df):
-                # 定义列宽
-                column_widths = {
-                    'No': '60px',
-                    'TA': '80px',
-                    'Study': '100px',
-                    'Site#': '60px',
-                    'Site Name': '220px',
-                    'Site Package Ready': '180px',
-                    'GCP Acceptance': '180px',
-                    'EC Submission': '180px',
-                    'EC Meeting': '180px',
-                    'EC Approval': '180px',
-                    'Contract GCP Review': '180px',
-                    'Contract Neg. Compl.': '180px',
-                    'Contract Signoff': '180px',
-                    'Commt. Ltr Sent': '180px',
-                    'Commt. Ltr Obtain': '180px',
-                    'SA': '180px'
-                }
-                
-                # 前5列固定
-                fixed_columns = ['No', 'TA', 'Study', 'Site#', 'Site Name']
-                fixed_bg = '#fff'
-                
-                # 构建表头
-                columns = list(df.columns)
-                new_headers = []
-                left_offset = 0
-                for idx, col in enumerate(columns):
-                    th_style = (
-                        f'border:1px solid #ccc;border-bottom:2px solid #ccc;padding:4px 8px;'
-                        f'background:#e6f4ea;text-align:center;white-space:nowrap;overflow:hidden;'
-                        f'text-overflow:ellipsis;width:{column_widths.get(col, "120px")};'
-                        f'max-width:{column_widths.get(col, "120px")};vertical-align:middle;'
-                    )
-                    if col in fixed_columns:
-                        th_style += (
-                            f'position:sticky;top:0;left:{left_offset}px;z-index:20;'
-                            f'background:#e6f4ea;box-shadow:2px 0 0 #ccc;'
-                        )
-                        left_offset += int(column_widths[col][:-2])
-                    else:
-                        th_style += 'position:sticky;top:0;z-index:10;'
-                    new_headers.append(f'<th style="{th_style}">{col}</th>')
-                
-                html = '<div style="overflow-y:auto; max-height:480px; width:100%; border-top:2px solid #ccc; border-bottom:2px solid #ccc;">'
-                html += '<table style="width:100%;border-collapse:separate;border-spacing:0;table-layout:fixed;">'
-                html += '<thead><tr>' + ''.join(new_headers) + '</tr></thead><tbody>'
-                
-                n_rows = len(df)
-                for row_idx, (_, row) in enumerate(df.iterrows()):
-                    tr_style = ''
-                    if row_idx == n_rows - 1:
-                        tr_style += 'border-bottom:2px solid #ccc;'
-                    html += f'<tr style="{tr_style}">'
-                    
-                    left_offset_td = 0
-                    for col_idx, (col, cell) in enumerate(zip(df.columns, row)):
-                        style = f"border:1px solid #ccc;padding:4px 8px;text-align:center;width:{column_widths.get(col, '120px')};word-break:break-all;white-space:pre-line;max-height:120px;overflow-y:auto;vertical-align:middle;background:{fixed_bg};"
-                        
-                        if col in fixed_columns:
-                            style += f'position:sticky;left:{left_offset_td}px;z-index:5;background:{fixed_bg};box-shadow:2px 0 0 #ccc;'
-                            left_offset_td += int(column_widths[col][:-2])
-                        else:
-                            style += 'z-index:1;'
-                        
-                        if col == 'TA':
-                            html += f'<td style="{style}font-weight:bold;white-space:normal;word-break:break-word;">{cell}</td>'
-                        elif col in ['Study', 'Site Name']:
-                            html += f'<td style="{style}font-weight:bold;white-space:nowrap;">{cell}</td>'
-                        elif col == 'Site Name':
-                            html += f'<td style="{style}white-space:normal;word-wrap:break-word;">{cell}</td>'
-                        else:
-                            html += f'<td style="{style}white-space:nowrap;">{cell}</td>'
-                    html += '</tr>'
-                html += '</tbody></table></div>'
-                return html
-            
-            st.markdown(render_leading_site_table(leading_details_df), unsafe_allow_html=True)
+    st.markdown('<div style="margin-top:-30px;">', unsafe_allow_html=True)
+    # on_change='rerun'：只执行当前选中Tab的内容
+    tabs = st.tabs(["Leading Site", "HGRAC", "IMP"], key='details_tabs', on_change='rerun')
+    st.markdown('</div>', unsafe_allow_html=True)
+    with tabs[0]:
+        if not tabs[0].open:
+            pass
+        elif df is not None and 'leading_site_or_not' in df.columns:
+            html = leading_site_tab_html(dataset_key, filter_key, df, study_summary, filtered_studies)
+            if html is not None:
+                st.markdown(html, unsafe_allow_html=True)
+            else:
+                st.markdown('<div class="card-content">没有找到Leading Site数据</div>', unsafe_allow_html=True)
         else:
-            st.markdown('<div class="card-content">没有找到Leading Site数据</div>', unsafe_allow_html=True)
-    else:
-        st.markdown('<div class="card-content">请上传包含 leading_site_or_not 字段的CSV</div>', unsafe_allow_html=True)
-with tabs[1]:
-    if df is not None:
-        # 获取CSV中的study numbers
-        study_numbers = df['study_number'].unique().tolist()
-        # 从数据库获取HGRAC数据
-        hgrac_df = get_hgrac_data(study_numbers)
-        
-        if not hgrac_df.empty:
-            # 生成HGRAC表格数据
-            hgrac_details = []
-            for idx, row in hgrac_df.iterrows():
-                # 序号 - 将在排序后重新赋值
-                seq_num = idx + 1
-                
-                # 基本信息
-                ta = row.get('ta', '')
-                study = row.get('study_number', '')
-                
-                # CTN日期处理
-                ctn_actual = row.get('ctn_actual_date')
-                ctn_plan = row.get('ctn_plan_date')
-                if pd.notna(ctn_actual):
-                    ctn_display = f"<span style='color:#222;font-weight:bold'>A:{safe_date_str(ctn_actual)}</span>"
-                elif pd.notna(ctn_plan):
-                    now = pd.Timestamp.now()
-                    date_color = 'red' if ctn_plan < now else '#1976d2'
-                    ctn_display = f"<span style='color:{date_color};font-weight:bold'>P:{safe_date_str(ctn_plan)}</span>"
-                else:
-                    ctn_display = ""
-                
-                # 审批类型
-                approval_type = row.get('filling_or_approval', '')
-                
-                # Leading EC Approval
-                leading_ec_approval = row.get('leading_site_ec_approval_actual_date')
-                if pd.notna(leading_ec_approval):
-                    leading_ec_display = f"<span style='color:#222;font-weight:bold'>{safe_date_str(leading_ec_approval)}</span>"
-                else:
-                    leading_ec_display = ""
-                
-                # Leading Contract
-                leading_contract = row.get('leading_site_contract_signoff_actual_date')
-                if pd.notna(leading_contract):
-                    leading_contract_display = f"<span style='color:#222;font-weight:bold'>{safe_date_str(leading_contract)}</span>"
-                else:
-                    leading_contract_display = ""
-                
-                # 申请书定稿
-                application_final = row.get('application_final_date')
-                if pd.notna(application_final):
-                    application_final_display = f"<span style='color:#222;font-weight:bold'>{safe_date_str(application_final)}</span>"
-                else:
-                    application_final_display = ""
-                
-                # 线上递交
-                first_science = row.get('first_science_date')
-                if pd.notna(first_science):
-                    first_science_display = f"<span style='color:#222;font-weight:bold'>{safe_date_str(first_science)}</span>"
-                else:
-                    first_science_display = ""
-                
-                # 受理日期
-                official_date = row.get('official_date')
-                if pd.notna(official_date):
-                    official_display = f"<span style='color:#222;font-weight:bold'>{safe_date_str(official_date)}</span>"
-                else:
-                    official_display = ""
-                
-                # 批准 - 优先取public_date，如果为空则取publish_date
-                public_date = row.get('public_date')
-                publish_date = row.get('publish_date')
-                approval_date = public_date if pd.notna(public_date) else publish_date
-                if pd.notna(approval_date):
-                    approval_display = f"<span style='color:#222;font-weight:bold'>{safe_date_str(approval_date)}</span>"
+            st.markdown('<div class="card-content">请上传包含 leading_site_or_not 字段的CSV</div>', unsafe_allow_html=True)
+    with tabs[1]:
+        if not tabs[1].open:
+            pass
+        elif df is not None:
+            # 获取CSV中的study numbers
+            study_numbers = df['study_number'].unique().tolist()
+            # 后台预取未完成时先显示占位，取数完成后替换为表格
+            hgrac_notice = st.empty()
+            hgrac_slot = st.empty()
+            if hgrac_prefetch is not None and not hgrac_prefetch.done():
+                hgrac_slot.markdown('<div class="card-content">HGRAC数据加载中...</div>', unsafe_allow_html=True)
+            try:
+                if hgrac_prefetch is not None:
+                    hgrac_prefetch.result()
+                hgrac_df, hgrac_version = get_hgrac_data(study_numbers)
+                html = hgrac_tab_html(dataset_key, filter_key, hgrac_version, hgrac_df, filtered_studies)
+            except Exception as e:
+                hgrac_slot.error(f"HGRAC数据查询失败: {e}")
+            else:
+                # 上游不可用时降级：仍显示本地库数据并提示
+                notice = hgrac_degraded_notice()
+                if notice:
+                    hgrac_notice.warning(notice)
+                if html is not None:
+                    hgrac_slot.markdown(html, unsafe_allow_html=True)
                 else:
-                    approval_display = ""
-                
-                hgrac_details.append({
-                    'No': seq_num,
-                    'TA': ta,
-                    'Study': study,
-                    'CTN': ctn_display,
-                    '审批类型': approval_type,
-                    'Leading EC Approval': leading_ec_display,
-                    'Leading Contract': leading_contract_display,
-                    '申请书定稿': application_final_display,
-                    '线上递交': first_science_display,
-                    '受理日期': official_display,
-                    '批准': approval_display
-                })
-            
-            # 转为DataFrame
-            hgrac_details_df = pd.DataFrame(hgrac_details)
-            
-            # 排序：按CTN日期升序排列
-            def get_ctn_sort_val_for_hgrac(row):
-                study = row['Study']
-                study_row = hgrac_df[hgrac_df['study_number'] == study]
-                if study_row is not None and not study_row.empty:
-                    ctn_actual = study_row['ctn_actual_date'].iloc[0] if 'ctn_actual_date' in study_row.columns else pd.NaT
-                    ctn_plan = study_row['ctn_plan_date'].iloc[0] if 'ctn_plan_date' in study_row.columns else pd.NaT
-                    if pd.notna(ctn_actual):
-                        return pd.to_datetime(ctn_actual, errors='coerce')
-                    elif pd.notna(ctn_plan):
-                        return pd.to_datetime(ctn_plan, errors='coerce')
-                return pd.NaT
-            
-            hgrac_details_df['ctn_sort'] = hgrac_details_df.apply(get_ctn_sort_val_for_hgrac, axis=1)
-            hgrac_details_df = hgrac_details_df.sort_values('ctn_sort', ascending=True, na_position='last').reset_index(drop=True)
-            hgrac_details_df['No'] = range(1, len(hgrac_details_df) + 1)
-            hgrac_details_df = hgrac_details_df.drop(columns=['ctn_sort'])
-            
-            # 应用筛选器（与Study Details表格联动）
-            if 'filtered_studies' in locals() and filtered_studies:
-                hgrac_details_df = hgrac_details_df[hgrac_details_df['Study'].isin(filtered_studies)].copy()
-                hgrac_details_df['No'] = range(1, len(hgrac_details_df) + 1)
-            
-            # 渲染HGRAC表格
-            def render_hgrac_table(df):
-                # 定义列宽
-                column_widths = {
-                    'No': '60px',
-                    'TA': '80px',
-                    'Study': '100px',
-                    'CTN': '120px',
-                    '审批类型': '100px',
-                    'Leading EC Approval': '160px',
-                    'Leading Contract': '160px',
-                    '申请书定稿': '120px',
-                    '线上递交': '120px',
-                    '受理日期': '120px',
-                    '批准': '120px'
-                }
-                
-                html = '<div style="overflow-x:auto;width:100%;">'
-                html += '<table style="width:100%;border-collapse:collapse;table-layout:fixed;">'
-                html += '<tr>' + ''.join([f'<th style="border:1px solid #ccc;padding:4px 8px;background:#f7f7f7;text-align:center;font-weight:bold;white-space:nowrap;width:{column_widths.get(col, "120px")};">{col}</th>' for col in df.columns]) + '</tr>'
-                for _, row in df.iterrows():
-                    html += '<tr>'
-                    for col, cell in zip(df.columns, row):
-                        if col in ['TA', 'Study']:
-                            html += f'<td style="border:1px solid #ccc;padding:4px 8px;text-align:center;font-weight:bold;white-space:nowrap;width:{column_widths.get(col, "120px")};">{cell}</td>'
-                        else:
-                            html += f'<td style="border:1px solid #ccc;padding:4px 8px;text-align:center;white-space:nowrap;width:{column_widths.get(col, "120px")};">{cell}</td>'
-                    html += '</tr>'
-                html += '</table></div>'
-                return html
-            
-            st.markdown(render_hgrac_table(hgrac_details_df), unsafe_allow_html=True)
+                    hgrac_slot.markdown('<div class="card-content">没有找到HGRAC数据</div>', unsafe_allow_html=True)
         else:
-            st.markdown('<div class="card-content">没有找到HGRAC数据</div>', unsafe_allow_html=True)
-    else:
-        st.markdown('<div class="card-content">请先上传CSV文件以获取Study信息</div>', unsafe_allow_html=True)
-with tabs[2]:
-    st.write("(IMP内容待补充)")
+            st.markdown('<div class="card-content">请先上传CSV文件以获取Study信息</div>', unsafe_allow_html=True)
+    with tabs[2]:
+        st.write("(IMP内容待补充)")
+
+filtered_sections(df, study_summary, dataset_key, filter_index, hgrac_prefetch, duration_sketches)
 
 st.markdown("---")
 st.info("💡 卡片已创建完成，请告诉我每个卡片需要展示的内容！") 
\ No newline at end of file
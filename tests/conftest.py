@@ -0,0 +1,76 @@
+import io
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# 导入dashboard会以bare模式执行整个页面（没有上传文件）：快照目录指向空的临时目录，不读取HGRAC配置
+os.environ['DASHBOARD_SNAPSHOT_DIR'] = tempfile.mkdtemp(prefix='dashboard-snapshots-')
+os.environ['HGRAC_DB_CONFIG'] = os.path.join(os.environ['DASHBOARD_SNAPSHOT_DIR'], 'hgrac_db.toml')
+
+TAS = ['Oncology', 'Neuro', 'Immunology', 'Ophthalmology']
+SOURCINGS = ['FSO', 'Partial', 'Insourced']
+STUDY_MILESTONES = [
+    ('study_fsa', 30, 90), ('study_fps', 50, 120), ('study_imp_ready', 20, 80), ('study_sfr', 20, 80),
+    ('study_hia', 20, 80), ('country_package_ready', -120, -40), ('main_contract_tmpl', -120, -40),
+]
+SITE_MILESTONES = [
+    ('site_sa', 40, 200), ('ec_approval', -30, 60), ('contract_signoff', -30, 80), ('site_gcp', -60, 20),
+    ('comm_ltr_obt', 0, 90), ('site_package', -60, 0), ('ec_sub', -50, 10), ('ec_meeting', -40, 30),
+]
+
+def build_export(n_studies=30, seed=0, start=0):
+    # 模拟CTMS导出：每个study若干site行，日期随机缺失，study编号故意不按字典序出现
+    rng = np.random.default_rng(seed)
+    base = pd.Timestamp('2026-01-01')
+    def date(ctn, lo, hi, p_na):
+        return '' if rng.random() < p_na else (ctn + pd.Timedelta(days=int(rng.integers(lo, hi)))).strftime('%Y-%m-%d')
+    rows = []
+    for i in rng.permutation(n_studies) + start:
+        study = f"YO{40000 + i}" if i % 7 else f"{40000 + i}"
+        ctn = base + pd.Timedelta(days=int(rng.integers(-300, 200)))
+        study_dates = {}
+        for name, lo, hi in STUDY_MILESTONES:
+            study_dates[f'{name}_actual_date'] = date(ctn, lo, hi, 0.5)
+            study_dates[f'{name}_plan_date'] = date(ctn, lo, hi, 0.1)
+        for site in range(int(rng.integers(1, 12))):
+            row = {
+                'Study Number': study,
+                'Study CTN Plan Date': ctn.strftime('%Y-%m-%d'),
+                'study_ctn_actual_date': ctn.strftime('%Y-%m-%d') if ctn < base and i % 3 else '[NULL]',
+                'clintrack_ta_desc': TAS[i % len(TAS)],
+                'sourcing_strategy': SOURCINGS[i % len(SOURCINGS)],
+                'site_no': site + 1,
+                'study_site_number': i * 100 + site,
+                'site_name': f"医院{i}-{site}",
+                'leading_site_or_not': 'Yes' if site == 0 else 'No',
+                'ssus': rng.choice(['A', '']),
+                'site_status': rng.choice(['Initiating', 'Active']),
+                'ssus_assignment_date': date(ctn, -60, 60, 0.3),
+                **study_dates,
+            }
+            for name, lo, hi in SITE_MILESTONES:
+                row[f'{name}_actual_date'] = date(ctn, lo, hi, 0.5)
+                row[f'{name}_plan_date'] = date(ctn, lo, hi, 0.15)
+            rows.append(row)
+    return pd.DataFrame(rows)
+
+def export_bytes(frame):
+    buffer = io.StringIO()
+    frame.to_csv(buffer, index=False)
+    return buffer.getvalue().encode('utf-8')
+
+@pytest.fixture(scope='session')
+def dashboard():
+    import dashboard
+    return dashboard
+
+@pytest.fixture(scope='session')
+def export():
+    return build_export()
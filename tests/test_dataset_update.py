@@ -0,0 +1,68 @@
+import itertools
+
+import pandas as pd
+import pytest
+
+from conftest import build_export, export_bytes
+
+FRACS = (0.25, 0.75)
+_keys = itertools.count()
+
+def load(dashboard, frame):
+    return dashboard.load_dataset.__wrapped__(f'update-{next(_keys)}', export_bytes(frame))
+
+def edit_export(export):
+    # 改动部分site的激活日期、删除一家site、新增一个study
+    edited = export.copy()
+    changed_sites = edited.index[::17]
+    edited.loc[changed_sites, 'site_sa_actual_date'] = '2026-06-30'
+    dropped = edited.index[5]
+    added = build_export(n_studies=1, seed=9, start=500)
+    return pd.concat([edited.drop(index=dropped), added], ignore_index=True), changed_sites, dropped, added
+
+@pytest.fixture
+def base(dashboard, export):
+    return load(dashboard, export)
+
+def assert_incremental_matches_full(dashboard, update, base_key, base, expected):
+    pd.testing.assert_frame_equal(update['df'], expected)
+    assert dashboard.get_dataset_lineage()[update['key']]['base_key'] == base_key
+    # 沿用上一版、只重算受影响study的结果与整体重算一致
+    dashboard.get_study_summary(base_key, base)
+    dashboard.get_sa_quantiles(base_key, base, FRACS)
+    pd.testing.assert_frame_equal(dashboard.get_study_summary(update['key'], update['df']), dashboard.build_study_summary(expected))
+    quantiles = dashboard.get_sa_quantiles(update['key'], update['df'], FRACS)
+    full = dashboard.site_activation_quantiles(expected, FRACS)
+    for frac in FRACS:
+        pd.testing.assert_frame_equal(quantiles[frac], full[frac], check_index_type=False)
+
+def test_full_export_update_matches_full_recompute(dashboard, export, base):
+    edited, changed_sites, dropped, added = edit_export(export)
+    upload = load(dashboard, edited)
+    base_key = f'base-{next(_keys)}'
+    update = dashboard.get_dataset_update.__wrapped__(f'full-{next(_keys)}', base_key, False, base, upload)
+    expected_changed = set(export.loc[changed_sites.union([dropped]), 'Study Number']) | set(added['Study Number'])
+    assert set(map(str, update['affected'])) == expected_changed
+    assert_incremental_matches_full(dashboard, update, base_key, base, upload)
+
+def test_unchanged_export_affects_nothing(dashboard, export, base):
+    assert dashboard.changed_studies(base, load(dashboard, export)) == []
+
+def test_delta_csv_update_matches_full_recompute(dashboard, export, base):
+    # 增量CSV：同key的行原位替换，新key追加在末尾
+    replaced = export.index[::11]
+    merged = export.copy()
+    merged.loc[replaced, 'site_sa_actual_date'] = '2026-07-15'
+    new_site = export.loc[[export.index[0]]].assign(study_site_number=99999, site_name='新site')
+    added = build_export(n_studies=1, seed=11, start=600)
+    delta = pd.concat([merged.loc[replaced], new_site, added], ignore_index=True)
+    merged = pd.concat([merged, new_site, added], ignore_index=True)
+    base_key = f'base-{next(_keys)}'
+    update = dashboard.get_dataset_update.__wrapped__(f'delta-{next(_keys)}', base_key, True, base, load(dashboard, delta))
+    assert set(map(str, update['affected'])) == set(delta['Study Number'])
+    assert_incremental_matches_full(dashboard, update, base_key, base, load(dashboard, merged))
+
+def test_delta_csv_with_other_columns_is_rejected(dashboard, export, base):
+    delta = load(dashboard, export.head(3).drop(columns='site_name'))
+    with pytest.raises(ValueError):
+        dashboard.merge_dataset_delta(base, delta)
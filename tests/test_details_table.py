@@ -0,0 +1,20 @@
+import numpy as np
+
+from conftest import export_bytes
+
+def test_cached_orders_match_filter_then_sort(dashboard, export):
+    df = dashboard.load_dataset.__wrapped__('details', export_bytes(export))
+    summary = dashboard.build_study_summary(df)
+    index = dashboard.get_details_index.__wrapped__('details', df, summary)
+    details = index['df']
+    assert details['No'].tolist() == list(range(1, len(details) + 1))
+    ctn = details['Study'].map(summary['ctn_base'])
+    assert ctn.dropna().is_monotonic_increasing and ctn.isna().tolist() == sorted(ctn.isna().tolist())
+    selected = np.random.default_rng(1).random(len(summary)) < 0.4
+    mask = selected[index['summary_pos']]
+    for sort_by in dashboard.DETAILS_SORT_OPTIONS:
+        sort_col = 'No' if sort_by == 'CTN' else sort_by
+        for desc in (False, True):
+            order = index['orders'][sort_by, desc]
+            expected = details[mask].sort_values(sort_col, ascending=not desc, kind='stable', na_position='last')
+            assert details.iloc[order[mask[order]]]['Study'].tolist() == expected['Study'].tolist()
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import build_export, export_bytes
+
+@pytest.fixture(scope='module')
+def dataset(dashboard):
+    return dashboard.load_dataset.__wrapped__('sketch', export_bytes(build_export(n_studies=60, seed=3)))
+
+def frame_sketches(dashboard, df, chunk_rows):
+    sketches = {'site': None, 'leading': None}
+    for start in range(0, len(df), chunk_rows):
+        sketches = dashboard.fold_duration_sketches(sketches, df.iloc[start:start + chunk_rows])
+    return sketches
+
+def exact_columns(dashboard, approx):
+    return approx[['count'] + [name for name, _ in dashboard.DURATION_QUANTILES]]
+
+def flow_sets(dashboard, df):
+    return [('site', dashboard.SITE_DURATION_FLOWS, df), ('leading', dashboard.LEADING_DURATION_FLOWS, df[dashboard.is_leading_site(df)])]
+
+def test_sketch_stats_match_exact_duration_stats(dashboard, dataset):
+    sketches = frame_sketches(dashboard, dataset, 50)
+    for key, flows, frame in flow_sets(dashboard, dataset):
+        approx = dashboard.sketch_duration_stats(sketches[key], flows)
+        assert (approx['clipped'] == 0).all()
+        assert not approx[[f'{name}_clipped' for name, _ in dashboard.DURATION_QUANTILES]].to_numpy().any()
+        pd.testing.assert_frame_equal(exact_columns(dashboard, approx), dashboard.duration_stats(frame, flows), check_dtype=False)
+
+def test_sketch_stats_for_selected_studies(dashboard, dataset):
+    sketches = frame_sketches(dashboard, dataset, 50)
+    studies = dataset['study_number'].astype(str).unique()[::3]
+    for key, flows, frame in flow_sets(dashboard, dataset):
+        approx = dashboard.sketch_duration_stats(sketches[key], flows, groups=studies)
+        exact = dashboard.duration_stats(frame[frame['study_number'].astype(str).isin(studies)], flows)
+        pd.testing.assert_frame_equal(exact_columns(dashboard, approx), exact, check_dtype=False)
+
+def test_sketch_clips_to_max_days_and_reports_clipped(dashboard, dataset, monkeypatch):
+    # 截断后的分位数等于截断样本的精确分位数，截断样本数单独报告
+    monkeypatch.setattr(dashboard, 'DURATION_SKETCH_MAX_DAYS', 30)
+    flows = dashboard.SITE_DURATION_FLOWS
+    approx = dashboard.sketch_duration_stats(frame_sketches(dashboard, dataset, 50)['site'], flows)
+    days = dashboard.flow_days(dataset, flows)
+    for j, (name, _, _) in enumerate(flows):
+        values = days[:, j][~np.isnan(days[:, j])]
+        assert approx.loc[name, 'count'] == len(values)
+        assert approx.loc[name, 'clipped'] == np.count_nonzero(np.abs(values) > 30)
+        expected = np.quantile(np.clip(values, -30, 30), [q for _, q in dashboard.DURATION_QUANTILES])
+        np.testing.assert_allclose(approx.loc[name, [p for p, _ in dashboard.DURATION_QUANTILES]].to_numpy(dtype=float), expected)
+    assert approx['clipped'].sum() > 0
+
+def test_chunk_size_does_not_change_sketch(dashboard, dataset):
+    small, whole = frame_sketches(dashboard, dataset, 7), frame_sketches(dashboard, dataset, len(dataset))
+    for key, flows, _ in flow_sets(dashboard, dataset):
+        pd.testing.assert_frame_equal(dashboard.sketch_duration_stats(small[key], flows), dashboard.sketch_duration_stats(whole[key], flows))
+
+def test_quantiles_not_using_clipped_samples_are_exact(dashboard, dataset, monkeypatch):
+    monkeypatch.setattr(dashboard, 'DURATION_SKETCH_MAX_DAYS', 30)
+    flows = dashboard.SITE_DURATION_FLOWS
+    approx = dashboard.sketch_duration_stats(frame_sketches(dashboard, dataset, 50)['site'], flows)
+    exact = dashboard.duration_stats(dataset, flows)
+    flagged = 0
+    for name, _ in dashboard.DURATION_QUANTILES:
+        clipped = approx[f'{name}_clipped'].to_numpy(dtype=bool)
+        flagged += clipped.sum()
+        np.testing.assert_allclose(approx[name].to_numpy(dtype=float)[~clipped], exact[name].to_numpy(dtype=float)[~clipped])
+        # 用到截断样本的分位数：真实值比显示值更极端
+        shown, true = approx[name].to_numpy(dtype=float)[clipped], exact[name].to_numpy(dtype=float)[clipped]
+        assert (np.abs(true) >= np.abs(shown)).all()
+    assert flagged > 0
+
+def test_sketch_note_names_flows_with_clipped_medians(dashboard, dataset, monkeypatch):
+    monkeypatch.setattr(dashboard, 'DURATION_SKETCH_MAX_DAYS', 30)
+    flows = dashboard.SITE_DURATION_FLOWS
+    approx = dashboard.sketch_duration_stats(frame_sketches(dashboard, dataset, 50)['site'], flows)
+    note = dashboard.duration_sketch_note(approx)
+    for name in approx.index:
+        assert (name in note) == bool(approx.loc[name, 'p50_clipped'])
+    monkeypatch.setattr(dashboard, 'DURATION_SKETCH_MAX_DAYS', 3650)
+    exact_note = dashboard.duration_sketch_note(dashboard.sketch_duration_stats(frame_sketches(dashboard, dataset, 50)['site'], flows))
+    assert '无截断样本' in exact_note
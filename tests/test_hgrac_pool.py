@@ -0,0 +1,48 @@
+import sqlite3
+
+import pytest
+
+CONFIG = '''[hgrac]
+driver = "sqlite3"
+table = "hgrac"
+[hgrac.connect]
+database = "upstream.db"
+'''
+
+@pytest.fixture
+def config(tmp_path):
+    sqlite3.connect(tmp_path / 'upstream.db').close()
+    path = tmp_path / 'hgrac_db.toml'
+    path.write_text(CONFIG)
+    return str(path)
+
+def is_closed(conn):
+    try:
+        conn.execute('SELECT 1')
+    except sqlite3.ProgrammingError:
+        return True
+    return False
+
+def test_closing_pool_closes_idle_and_returned_connections(dashboard, config):
+    pool = dashboard.get_hgrac_pool.__wrapped__(config, 0)
+    with dashboard.hgrac_connection(pool) as idle:
+        pass
+    with dashboard.hgrac_connection(pool) as busy:
+        assert busy is idle
+        with dashboard.hgrac_connection(pool) as other:
+            pass
+        # 使用中的连接不受影响，归还时才关闭
+        dashboard.close_hgrac_pool(pool)
+        assert is_closed(other) and not is_closed(busy)
+    assert is_closed(busy)
+    assert pool['idle'].empty()
+
+def test_config_change_releases_previous_pool(dashboard, config):
+    dashboard.get_hgrac_pool.clear()
+    old = dashboard.get_hgrac_pool(config, 1)
+    with dashboard.hgrac_connection(old) as conn:
+        pass
+    new = dashboard.get_hgrac_pool(config, 2)
+    assert new is not old and old['closed'] and is_closed(conn)
+    assert dashboard.get_hgrac_pool(config, 2) is new
+    dashboard.get_hgrac_pool.clear()
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import time
+from collections import Counter
+from contextlib import closing
+
+import pytest
+
+CONFIG = '''[hgrac]
+driver = "sqlite3"
+table = "hgrac"
+local_store = "local.db"
+watermark_column = "last_modified"
+reconcile_interval = 3600
+[hgrac.connect]
+database = "upstream.db"
+'''
+
+def upstream_rows(dashboard, n_studies=6):
+    rows = []
+    for i in range(n_studies):
+        for j in range(1 + i % 3):
+            row = dict.fromkeys(dashboard.HGRAC_COLUMNS)
+            row.update(ta='Oncology', study_number=f'YO{41000 + i}', filling_or_approval='filling' if j else None,
+                       ctn_actual_date=f'2025-0{1 + j}-1{i}', last_modified='2025-01-01 00:00:00')
+            rows.append(row)
+    return rows
+
+@pytest.fixture
+def hgrac(dashboard, tmp_path):
+    columns = dashboard.HGRAC_COLUMNS + ['last_modified']
+    upstream = sqlite3.connect(tmp_path / 'upstream.db')
+    upstream.execute(f"CREATE TABLE hgrac ({', '.join(columns)})")
+    upstream.executemany(f"INSERT INTO hgrac VALUES ({', '.join(['?'] * len(columns))})",
+                         [tuple(row[col] for col in columns) for row in upstream_rows(dashboard)])
+    upstream.commit()
+    config = tmp_path / 'hgrac_db.toml'
+    config.write_text(CONFIG)
+    pool = dashboard.get_hgrac_pool.__wrapped__(str(config), os.path.getmtime(config))
+    yield pool, upstream
+    upstream.close()
+
+def table_rows(path, columns):
+    with closing(sqlite3.connect(path)) as conn:
+        return Counter(conn.execute(f"SELECT {', '.join(columns)} FROM hgrac").fetchall())
+
+def in_sync(dashboard, pool, upstream):
+    columns = dashboard.HGRAC_COLUMNS
+    return Counter(upstream.execute(f"SELECT {', '.join(columns)} FROM hgrac").fetchall()) == table_rows(pool['store'], columns)
+
+def mark_fetched(pool, studies):
+    pool['fetched_at'].update(dict.fromkeys(studies, time.monotonic()))
+
+def test_first_sync_copies_upstream(dashboard, hgrac):
+    pool, upstream = hgrac
+    mark_fetched(pool, ['YO41000'])
+    dashboard.sync_hgrac_store(pool)
+    assert in_sync(dashboard, pool, upstream)
+    assert dashboard.hgrac_store_watermark(pool['store']) == '2025-01-01 00:00:00'
+    assert pool['fetched_at'] == {}
+
+def test_resync_is_idempotent(dashboard, hgrac):
+    pool, upstream = hgrac
+    dashboard.sync_hgrac_store(pool)
+    mark_fetched(pool, ['YO41000', 'YO41001'])
+    dashboard.sync_hgrac_store(pool)
+    dashboard.sync_hgrac_store(pool)
+    assert in_sync(dashboard, pool, upstream)
+    assert set(pool['fetched_at']) == {'YO41000', 'YO41001'}
+
+def test_change_at_watermark_timestamp_is_synced(dashboard, hgrac):
+    # 与水位同一时间戳、但在上次同步之后才提交的改动
+    pool, upstream = hgrac
+    dashboard.sync_hgrac_store(pool)
+    mark_fetched(pool, ['YO41001', 'YO41002'])
+    upstream.execute("UPDATE hgrac SET filling_or_approval = 'approval' WHERE study_number = 'YO41001'")
+    upstream.commit()
+    dashboard.sync_hgrac_store(pool)
+    assert in_sync(dashboard, pool, upstream)
+    assert set(pool['fetched_at']) == {'YO41002'}
+
+def test_duplicate_upstream_rows_are_kept_once_each(dashboard, hgrac):
+    pool, upstream = hgrac
+    dashboard.sync_hgrac_store(pool)
+    upstream.execute("INSERT INTO hgrac SELECT * FROM hgrac WHERE study_number = 'YO41002'")
+    upstream.execute("UPDATE hgrac SET last_modified = '2025-03-01 00:00:00' WHERE study_number = 'YO41002'")
+    upstream.commit()
+    dashboard.sync_hgrac_store(pool)
+    dashboard.sync_hgrac_store(pool)
+    assert in_sync(dashboard, pool, upstream)
+    assert dashboard.hgrac_store_watermark(pool['store']) == '2025-03-01 00:00:00'
+
+def test_upstream_delete_is_removed_on_reconcile(dashboard, hgrac):
+    pool, upstream = hgrac
+    dashboard.sync_hgrac_store(pool)
+    upstream.execute("DELETE FROM hgrac WHERE study_number = 'YO41003'")
+    upstream.commit()
+    # 增量同步看不到删除
+    dashboard.sync_hgrac_store(pool)
+    assert not in_sync(dashboard, pool, upstream)
+    mark_fetched(pool, ['YO41003', 'YO41004'])
+    with closing(sqlite3.connect(pool['store'])) as conn, conn:
+        conn.execute("UPDATE hgrac_sync SET value = '0' WHERE key = 'reconciled_at'")
+    dashboard.sync_hgrac_store(pool)
+    assert in_sync(dashboard, pool, upstream)
+    assert set(pool['fetched_at']) == {'YO41004'}
+
+def test_local_rows_are_served_after_sync(dashboard, hgrac):
+    pool, upstream = hgrac
+    dashboard.sync_hgrac_store(pool)
+    rows = dashboard.fetch_hgrac_rows(pool, ['YO41002', 'YO41005'])
+    assert sorted(rows['study_number']) == ['YO41002'] * 3 + ['YO41005'] * 3
+    assert str(rows['ctn_actual_date'].dtype).startswith('datetime64')
@@ -0,0 +1,36 @@
+import pandas as pd
+
+from conftest import export_bytes
+
+def study_sort_order(df):
+    return df.drop_duplicates('study_number').sort_values('study_number', kind='stable')['study_number'].astype(str).tolist()
+
+def test_concat_chunks_sorts_merged_categories(dashboard):
+    chunks = [
+        pd.DataFrame({'study_number': pd.Categorical(['YO40002', 'YO40003'])}),
+        pd.DataFrame({'study_number': pd.Categorical(['40001', 'YO40002'])}),
+    ]
+    merged = dashboard.concat_chunks(chunks)
+    assert list(merged['study_number'].cat.categories) == ['40001', 'YO40002', 'YO40003']
+    assert merged.sort_values('study_number')['study_number'].tolist() == ['40001', 'YO40002', 'YO40002', 'YO40003']
+
+def test_chunked_study_sort_order_matches_single_pass(dashboard, export, monkeypatch):
+    raw = export_bytes(export)
+    monkeypatch.setattr(dashboard, 'INGEST_CHUNK_ROWS', 37)
+    single = dashboard.load_dataset.__wrapped__('single', raw)
+    chunked = dashboard.load_dataset_chunked.__wrapped__('chunked', raw)['df']
+    assert list(chunked['study_number'].cat.categories) == list(single['study_number'].cat.categories)
+    assert study_sort_order(chunked) == study_sort_order(single) == sorted(study_sort_order(single))
+
+def test_chunked_load_matches_single_pass(dashboard, export, monkeypatch):
+    raw = export_bytes(export)
+    monkeypatch.setattr(dashboard, 'INGEST_CHUNK_ROWS', 37)
+    single = dashboard.load_dataset.__wrapped__('single', raw)
+    chunked = dashboard.load_dataset_chunked.__wrapped__('chunked', raw)
+    pd.testing.assert_frame_equal(chunked['df'], single)
+    pd.testing.assert_frame_equal(chunked['summary'], dashboard.build_study_summary(single))
+
+def test_chunked_load_of_header_only_csv(dashboard, export):
+    raw = export_bytes(export.head(0))
+    chunked = dashboard.load_dataset_chunked.__wrapped__('empty', raw)
+    assert len(chunked['df']) == 0 and len(chunked['summary']) == 0
@@ -0,0 +1,52 @@
+import math
+
+import pandas as pd
+import pytest
+
+from conftest import build_export, export_bytes
+
+FRACS = (0.25, 0.75)
+
+@pytest.fixture(scope='module')
+def dataset(dashboard):
+    return dashboard.load_dataset.__wrapped__('sa', export_bytes(build_export(n_studies=60, seed=5)))
+
+def naive_quantiles(dashboard, df, frac, sort_by, scope_fallback):
+    # 逐study排序取前ceil(n*frac)家site，作为向量化引擎的对照
+    df = df[dashboard.site_scope_mask(df, scope_fallback)].copy()
+    df['sa_date'] = df['site_sa_actual_date'].fillna(df['site_sa_plan_date'])
+    sort_col = 'sa_date' if sort_by == 'sa_date' else 'site_sa_plan_date'
+    rows = {}
+    for study, sites in df.groupby(df['study_number'].astype(str), sort=False):
+        n_frac = max(1, math.ceil(len(sites) * frac))
+        top = sites.sort_values(sort_col, kind='stable', na_position='last').head(n_frac)
+        rows[study] = {
+            'n_sites': len(sites),
+            'n_frac': n_frac,
+            'actual_complete': bool(top['site_sa_actual_date'].notna().all()),
+            'date_complete': bool(top['sa_date'].notna().all()),
+            'no_dates': bool((top['site_sa_actual_date'].isna() & top['site_sa_plan_date'].isna()).all()),
+            'actual_max': top['site_sa_actual_date'].max(),
+            'date_max': top['sa_date'].max(),
+            'plan_min': top['site_sa_plan_date'].min(),
+        }
+    return pd.DataFrame.from_dict(rows, orient='index')
+
+@pytest.mark.parametrize('sort_by', ['sa_date', 'sa_plan'])
+@pytest.mark.parametrize('scope_fallback', [True, False])
+def test_quantiles_match_per_study_loop(dashboard, dataset, sort_by, scope_fallback):
+    df = dataset if scope_fallback else dataset.drop(columns='ssus')
+    result = dashboard.site_activation_quantiles(df, FRACS, sort_by=sort_by, scope_fallback=scope_fallback)
+    for frac in FRACS:
+        expected = naive_quantiles(dashboard, df, frac, sort_by, scope_fallback)
+        # 没有scope内site的study不参与对照
+        actual = result[frac][result[frac]['n_sites'] > 0]
+        actual.index = actual.index.astype(str)
+        pd.testing.assert_frame_equal(actual.loc[expected.index], expected, check_dtype=False, check_names=False)
+        assert set(actual.index) == set(expected.index)
+
+def test_scope_excludes_sites(dashboard, dataset):
+    scope = dashboard.site_scope_mask(dataset)
+    assert 0 < scope.sum() < len(dataset)
+    n_sites = dashboard.site_activation_quantiles(dataset, FRACS)[0.25]['n_sites']
+    assert n_sites.sum() == scope.sum()
@@ -0,0 +1,22 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from conftest import export_bytes
+
+def test_leading_site_rows_sorted_by_ctn(dashboard, export):
+    # 每个study的CTN日期互不相同（map结果为category的情形），且与study编号顺序无关
+    studies = export['Study Number'].unique()
+    ctn_dates = pd.Series(pd.Timestamp('2025-01-01') + pd.to_timedelta(np.arange(len(studies))[::-1] * 3, unit='D'), index=studies)
+    export = export.assign(**{
+        'Study CTN Plan Date': export['Study Number'].map(ctn_dates).dt.strftime('%Y-%m-%d'),
+        'study_ctn_actual_date': '',
+    })
+    df = dashboard.load_dataset.__wrapped__('tabs', export_bytes(export))
+    summary = dashboard.build_study_summary(df)
+    html = dashboard.leading_site_tab_html.__wrapped__('tabs', 'all', df, summary, None)
+    leading = df[dashboard.is_leading_site(df)]
+    site_study = dict(zip(leading['site_name'].astype(str), leading['study_number'].astype(str)))
+    shown = [site_study[name] for name in re.findall(r'>(医院\d+-\d+)</td>', html)]
+    assert shown == list(ctn_dates.sort_values().index)